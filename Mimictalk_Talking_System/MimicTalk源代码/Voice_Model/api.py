@@ -25,6 +25,8 @@
 
 `-hb` - `cnhubert路径`
 `-b` - `bert路径`
+`-rcs` - `内存中缓存的参考音频特征条数, 默认64`
+`-rcd` - `参考音频特征的磁盘缓存目录, 默认为空不落盘`
 
 ## 调用:
 
@@ -150,6 +152,9 @@ sys.path.append(now_dir)
 sys.path.append("%s/GPT_SoVITS" % (now_dir))
 
 import signal
+import hashlib
+import threading
+from collections import OrderedDict
 from text.LangSegmenter import LangSegmenter
 from time import time as ttime
 import torch
@@ -370,9 +375,10 @@ speaker_list = {}
 
 
 class Sovits:
-    def __init__(self, vq_model, hps):
+    def __init__(self, vq_model, hps, key=""):
         self.vq_model = vq_model
         self.hps = hps
+        self.key = key  # 权重文件的标识, 参考音频特征缓存按它区分不同的SoVITS模型
 
 
 from process_ckpt import get_sovits_version_from_path_fast, load_sovits_new
@@ -460,7 +466,8 @@ def get_sovits_weights(sovits_path):
         # torch.save(vq_model.state_dict(),"merge_win.pth")
         vq_model.eval()
 
-    sovits = Sovits(vq_model, hps)
+    stat = os.stat(sovits_path)
+    sovits = Sovits(vq_model, hps, key="%s:%s:%s" % (os.path.abspath(sovits_path), stat.st_mtime_ns, stat.st_size))
     return sovits
 
 
@@ -667,6 +674,148 @@ def get_spepc(hps, filename, dtype, device, is_v2pro=False):
     return spec, audio
 
 
+class RefFeatureCache:
+    """
+    参考音频特征缓存, 同一说话人的参考音频会被反复用于大量句子:
+    prompt semantic / refer spec / sv embedding / 参考mel 按 (参考音频内容hash, 模型) 缓存,
+    提示文本的 phones/bert 按 (提示文本, 语种, 版本) 缓存.
+    内存中按LRU淘汰, 指定 cache_dir 时额外落盘, 重启服务后依然命中.
+    参考音频文件的内容hash同样按LRU只保留最近 max_file_hashes 个, 每次上传的参考音频路径不同, 不能无限增长.
+    """
+
+    def __init__(self, max_items=64, cache_dir="", max_file_hashes=256):
+        self.max_items = max_items
+        self.max_file_hashes = max_file_hashes
+        self.cache_dir = cache_dir
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.file_hashes = OrderedDict()  # (abspath, mtime, size) => 文件内容hash
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        stat_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if stat_key in self.file_hashes:
+                self.file_hashes.move_to_end(stat_key)
+                return self.file_hashes[stat_key]
+        # 在锁外计算hash, 不阻塞其它请求的缓存读取
+        hasher = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+        file_hash = hasher.hexdigest()
+        with self.lock:
+            self.file_hashes[stat_key] = file_hash
+            while len(self.file_hashes) > self.max_file_hashes:
+                self.file_hashes.popitem(last=False)
+        return file_hash
+
+    def get_or_compute(self, kind, key_parts, compute_fn):
+        key = "%s_%s" % (kind, hashlib.sha1(repr(key_parts).encode("utf-8")).hexdigest())
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        value = self.load(key)
+        if value is None:
+            value = compute_fn()
+            self.save(key, value)
+        with self.lock:
+            self.items[key] = value
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return value
+
+    def load(self, key):
+        if not self.cache_dir:
+            return None
+        path = os.path.join(self.cache_dir, key + ".pt")
+        if not os.path.exists(path):
+            return None
+        try:
+            return torch.load(path, map_location=device, weights_only=True)
+        except Exception as e:
+            logger.warning(f"参考音频特征缓存读取失败, 重新计算: {path}, {e}")
+            return None
+
+    def save(self, key, value):
+        if not self.cache_dir:
+            return
+        path = os.path.join(self.cache_dir, key + ".pt")
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        try:
+            torch.save(value, tmp_path)
+            os.replace(tmp_path, path)  # 先写临时文件再改名, 避免读到写了一半的缓存
+        except Exception as e:
+            logger.warning(f"参考音频特征缓存写入失败: {path}, {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def get_prompt_semantic(sovits, ref_wav_path, dtype):
+    vq_model = sovits.vq_model
+
+    def compute():
+        zero_wav = torch.zeros(int(sovits.hps.data.sampling_rate * 0.3), dtype=dtype, device=device)
+        wav16k, sr = librosa.load(ref_wav_path, sr=16000)
+        wav16k = torch.from_numpy(wav16k).to(dtype).to(device)
+        wav16k = torch.cat([wav16k, zero_wav])
+        ssl_content = ssl_model.model(wav16k.unsqueeze(0))["last_hidden_state"].transpose(1, 2)  # .float()
+        codes = vq_model.extract_latent(ssl_content)
+        return codes[0, 0].unsqueeze(0).to(device)
+
+    key_parts = (ref_feature_cache.file_hash(ref_wav_path), sovits.key, str(dtype), cnhubert_base_path)
+    return ref_feature_cache.get_or_compute("prompt", key_parts, compute)
+
+
+def get_ref_spec(sovits, ref_wav_path, dtype, is_v2pro=False):
+    """
+    return: refer spec, 以及 v2Pro 的 sv embedding (其它版本为None)
+    """
+
+    def compute():
+        refer, audio_tensor = get_spepc(sovits.hps, ref_wav_path, dtype, device, is_v2pro)
+        sv_emb = None
+        if is_v2pro:
+            if sv_cn_model == None:
+                init_sv_cn()
+            sv_emb = sv_cn_model.compute_embedding3(audio_tensor)
+        return {"refer": refer, "sv_emb": sv_emb}
+
+    key_parts = (ref_feature_cache.file_hash(ref_wav_path), sovits.key, str(dtype), is_v2pro)
+    value = ref_feature_cache.get_or_compute("spec", key_parts, compute)
+    return value["refer"], value["sv_emb"]
+
+
+def get_ref_mel(ref_wav_path, version):
+    # v3/v4 的参考mel, 与合成的文本无关
+    def compute():
+        ref_audio, sr = torchaudio.load(ref_wav_path)
+        ref_audio = ref_audio.to(device).float()
+        if ref_audio.shape[0] == 2:
+            ref_audio = ref_audio.mean(0).unsqueeze(0)
+        tgt_sr = 24000 if version == "v3" else 32000
+        if sr != tgt_sr:
+            ref_audio = resample(ref_audio, sr, tgt_sr, device)
+        mel2 = mel_fn(ref_audio) if version == "v3" else mel_fn_v4(ref_audio)
+        return norm_spec(mel2)
+
+    key_parts = (ref_feature_cache.file_hash(ref_wav_path), version)
+    return ref_feature_cache.get_or_compute("mel", key_parts, compute)
+
+
+def get_prompt_phones_and_bert(prompt_text, prompt_language, version):
+    def compute():
+        phones, bert, norm_text = get_phones_and_bert(prompt_text, prompt_language, version)
+        return {"phones": phones, "bert": bert, "norm_text": norm_text}
+
+    key_parts = (prompt_text, prompt_language, version, bert_path, is_half)
+    value = ref_feature_cache.get_or_compute("phones", key_parts, compute)
+    return value["phones"], value["bert"], value["norm_text"]
+
+
 def pack_audio(audio_bytes, data, rate):
     if media_type == "ogg":
         audio_bytes = pack_ogg(audio_bytes, data, rate)
@@ -869,50 +1018,37 @@ def get_tts_wav(
     dtype = torch.float16 if is_half == True else torch.float32
     zero_wav = np.zeros(int(hps.data.sampling_rate * 0.3), dtype=np.float16 if is_half == True else np.float32)
     with torch.no_grad():
-        wav16k, sr = librosa.load(ref_wav_path, sr=16000)
-        wav16k = torch.from_numpy(wav16k)
-        zero_wav_torch = torch.from_numpy(zero_wav)
-        if is_half == True:
-            wav16k = wav16k.half().to(device)
-            zero_wav_torch = zero_wav_torch.half().to(device)
-        else:
-            wav16k = wav16k.to(device)
-            zero_wav_torch = zero_wav_torch.to(device)
-        wav16k = torch.cat([wav16k, zero_wav_torch])
-        ssl_content = ssl_model.model(wav16k.unsqueeze(0))["last_hidden_state"].transpose(1, 2)  # .float()
-        codes = vq_model.extract_latent(ssl_content)
-        prompt_semantic = codes[0, 0]
-        prompt = prompt_semantic.unsqueeze(0).to(device)
+        # 参考音频的特征只与参考音频本身有关, 从缓存中取, 同一参考音频只计算一次
+        prompt = get_prompt_semantic(infer_sovits, ref_wav_path, dtype)
 
         is_v2pro = version in {"v2Pro", "v2ProPlus"}
         if version not in {"v3", "v4"}:
             refers = []
             if is_v2pro:
                 sv_emb = []
-                if sv_cn_model == None:
-                    init_sv_cn()
             if inp_refs:
                 for path in inp_refs:
                     try:  #####这里加上提取sv的逻辑，要么一堆sv一堆refer，要么单个sv单个refer
-                        refer, audio_tensor = get_spepc(hps, path.name, dtype, device, is_v2pro)
+                        refer, emb = get_ref_spec(infer_sovits, path.name, dtype, is_v2pro)
                         refers.append(refer)
                         if is_v2pro:
-                            sv_emb.append(sv_cn_model.compute_embedding3(audio_tensor))
+                            sv_emb.append(emb)
                     except Exception as e:
                         logger.error(e)
             if len(refers) == 0:
-                refers, audio_tensor = get_spepc(hps, ref_wav_path, dtype, device, is_v2pro)
-                refers = [refers]
+                refer, emb = get_ref_spec(infer_sovits, ref_wav_path, dtype, is_v2pro)
+                refers = [refer]
                 if is_v2pro:
-                    sv_emb = [sv_cn_model.compute_embedding3(audio_tensor)]
+                    sv_emb = [emb]
         else:
-            refer, audio_tensor = get_spepc(hps, ref_wav_path, dtype, device)
+            refer, _ = get_ref_spec(infer_sovits, ref_wav_path, dtype)
+            ref_mel = get_ref_mel(ref_wav_path, version)
 
     t1 = ttime()
     # os.environ['version'] = version
     prompt_language = dict_language[prompt_language.lower()]
     text_language = dict_language[text_language.lower()]
-    phones1, bert1, norm_text1 = get_phones_and_bert(prompt_text, prompt_language, version)
+    phones1, bert1, norm_text1 = get_prompt_phones_and_bert(prompt_text, prompt_language, version)
     texts = text.split("\n")
     audio_bytes = BytesIO()
 
@@ -974,16 +1110,7 @@ def get_tts_wav(
             phoneme_ids1 = torch.LongTensor(phones2).to(device).unsqueeze(0)
 
             fea_ref, ge = vq_model.decode_encp(prompt.unsqueeze(0), phoneme_ids0, refer)
-            ref_audio, sr = torchaudio.load(ref_wav_path)
-            ref_audio = ref_audio.to(device).float()
-            if ref_audio.shape[0] == 2:
-                ref_audio = ref_audio.mean(0).unsqueeze(0)
-
-            tgt_sr = 24000 if version == "v3" else 32000
-            if sr != tgt_sr:
-                ref_audio = resample(ref_audio, sr, tgt_sr, device)
-            mel2 = mel_fn(ref_audio) if version == "v3" else mel_fn_v4(ref_audio)
-            mel2 = norm_spec(mel2)
+            mel2 = ref_mel
             T_min = min(mel2.shape[2], fea_ref.shape[2])
             mel2 = mel2[:, :, :T_min]
             fea_ref = fea_ref[:, :, :T_min]
@@ -1213,6 +1340,8 @@ parser.add_argument("-cp", "--cut_punc", type=str, default="", help="文本切
 # 切割常用分句符为 `python ./api.py -cp ".?!。？！"`
 parser.add_argument("-hb", "--hubert_path", type=str, default=g_config.cnhubert_path, help="覆盖config.cnhubert_path")
 parser.add_argument("-b", "--bert_path", type=str, default=g_config.bert_path, help="覆盖config.bert_path")
+parser.add_argument("-rcs", "--ref_cache_size", type=int, default=64, help="内存中缓存的参考音频特征条数")
+parser.add_argument("-rcd", "--ref_cache_dir", type=str, default="", help="参考音频特征的磁盘缓存目录, 默认不落盘")
 
 args = parser.parse_args()
 sovits_path = args.sovits_path
@@ -1223,6 +1352,7 @@ host = args.bind_addr
 cnhubert_base_path = args.hubert_path
 bert_path = args.bert_path
 default_cut_punc = args.cut_punc
+ref_feature_cache = RefFeatureCache(max_items=args.ref_cache_size, cache_dir=args.ref_cache_dir)
 
 # 应用参数配置
 default_refer = DefaultRefer(args.default_refer_path, args.default_refer_text, args.default_refer_language)
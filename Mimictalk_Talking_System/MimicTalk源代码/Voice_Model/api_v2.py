@@ -410,6 +410,12 @@ async def tts_handle(req: dict):
         return JSONResponse(status_code=400, content={"message": "tts failed", "Exception": str(e), "traceback": traceback.format_exc()})
 
 
+@APP.get("/health")
+async def health():
+    # 模型在启动时加载, 能响应即说明已就绪, 供后端轮询启动状态
+    return JSONResponse(status_code=200, content={"message": "ok"})
+
+
 @APP.get("/control")
 async def control(command: str = None):
     if command is None:
@@ -5,6 +5,12 @@ import numpy as np
 import cv2
 import os
 import copy
+import math
+import tqdm
+import itertools
+from multiprocessing import shared_memory
+from utils.commons.video_reader import VideoFrameReader
+from utils.commons.multiprocess_utils import MultiprocessManager
 
 # simplified mediapipe ldm at https://github.com/k-m-irfan/simplified_mediapipe_face_landmarks
 index_lm141_from_lm478 = [70,63,105,66,107,55,65,52,53,46] + [300,293,334,296,336,285,295,282,283,276] + [33,246,161,160,159,158,157,173,133,155,154,153,145,144,163,7] + [263,466,388,387,386,385,384,398,362,382,381,380,374,373,390,249] + [78,191,80,81,82,13,312,311,310,415,308,324,318,402,317,14,87,178,88,95] + [61,185,40,39,37,0,267,269,270,409,291,375,321,405,314,17,84,181,91,146] + [10,338,297,332,284,251,389,356,454,323,361,288,397,365,379,378,400,377,152,148,176,149,150,136,172,58,132,93,234,127,162,21,54,103,67,109] + [468,469,470,471,472] + [473,474,475,476,477] + [64,4,294]
@@ -30,16 +36,69 @@ index_mouth_from_lm68 = list(range(48, 68))
 
 
 def read_video_to_frames(video_name):
-    frames = []
-    cap = cv2.VideoCapture(video_name)
-    while cap.isOpened():
-        ret, frame_bgr = cap.read()
-        if frame_bgr is None:
-            break
-        frames.append(frame_bgr)
-    frames = np.stack(frames)
-    frames = np.flip(frames, -1) # BGR ==> RGB
-    return frames
+    # [T, H, W, 3] RGB, prefer iterating VideoFrameReader(video_name) when only sequential access is needed
+    return VideoFrameReader(video_name, rgb=True).read_all()
+
+def landmarks_to_np(face_landmarks):
+    """
+    mediapipe landmarks ==> [N, 2] normalized xy, float32 as stored by mediapipe
+    """
+    xys = itertools.chain.from_iterable((l.x, l.y) for l in face_landmarks)
+    return np.fromiter(xys, dtype=np.float32, count=2*len(face_landmarks)).reshape([-1, 2])
+
+def shared_lm478_arrays(shm, num_frames):
+    """
+    views of the shared memory: normalized lm478 [2, T, 478, 2] and detected flags [2, T], index 0 for IMAGE mode and 1 for VIDEO mode
+    """
+    lms = np.ndarray([2, num_frames, 478, 2], dtype=np.float32, buffer=shm.buf)
+    valid = np.ndarray([2, num_frames], dtype=np.bool_, buffer=shm.buf, offset=lms.nbytes)
+    return lms, valid
+
+def job_extract_lm478_for_frame_range(video_name, shm_name, num_frames, start, end, mode='image', fps=25, anti_smooth_factor=20):
+    """
+    被 MediapipeLandmarker.multiprocess_extract_lm478_from_video_name所使用, 处理视频中[start, end)的帧, 结果直接写入共享内存.
+    end=None时一直读到视频结束, 超出共享内存(num_frames)的帧只计数不写入.
+    return: the number of frames read
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    lms, valid = shared_lm478_arrays(shm, num_frames)
+    try:
+        landmarker = MediapipeLandmarker()
+        mode_idx = 0 if mode == 'image' else 1
+        options = landmarker.image_mode_options if mode == 'image' else landmarker.video_mode_options
+        num_read = 0
+        with vision.FaceLandmarker.create_from_options(options) as detector:
+            # the IMAGE mode shards start in the middle of the video, the landmarks must land on the exact frame index
+            reader = VideoFrameReader(video_name, rgb=True, start=start, max_frames=None if end is None else end-start, accurate_seek=True)
+            for i, frame in enumerate(reader, start=start):
+                num_read += 1
+                if i >= num_frames:
+                    continue
+                frame = mp.Image(image_format=mp.ImageFormat.SRGB, data=np.ascontiguousarray(frame, dtype=np.uint8))
+                if mode == 'image':
+                    result = detector.detect(image=frame)
+                else:
+                    result = detector.detect_for_video(image=frame, timestamp_ms=int((1000/fps)*anti_smooth_factor*i))
+                if len(result.face_landmarks) > 0:
+                    lms[mode_idx, i] = landmarks_to_np(result.face_landmarks[0])
+                    valid[mode_idx, i] = True
+        return num_read
+    finally:
+        del lms, valid # the views must be released before closing the shared memory
+        shm.close()
+
+def fill_undetected_lm478(lms, valid):
+    """
+    lms: [T, 478, 2], valid: [T], use the previous frame results for the undetected frames (the next detected one for the leading frames)
+    """
+    detected_ids = np.nonzero(valid)[0]
+    if len(detected_ids) == 0:
+        raise ValueError("failed detect ldm in all frames")
+    for i in np.nonzero(~valid)[0]:
+        print(f"Warning: failed detect ldm in idx={i}, use previous frame results.")
+    src_ids = np.maximum.accumulate(np.where(valid, np.arange(len(valid)), -1))
+    src_ids[src_ids < 0] = detected_ids[0]
+    return lms[src_ids]
 
 class MediapipeLandmarker:
     def __init__(self):
@@ -75,14 +134,16 @@ class MediapipeLandmarker:
         img_lm478 = np.array(img_face_landmarks)[:, :2] * np.array([W, H]).reshape([1,2]) # [478, 2]
         return img_lm478
 
-    def extract_lm478_from_video_name(self, video_name, fps=25, anti_smooth_factor=2):
-        frames = read_video_to_frames(video_name)
+    def extract_lm478_from_video_name(self, video_name, fps=25, anti_smooth_factor=2, num_workers=1):
+        if num_workers > 1:
+            return self.multiprocess_extract_lm478_from_video_name(video_name, fps, anti_smooth_factor, num_workers)
+        frames = VideoFrameReader(video_name, rgb=True)
         img_lm478, vid_lm478 = self.extract_lm478_from_frames(frames, fps, anti_smooth_factor)
         return img_lm478, vid_lm478
 
     def extract_lm478_from_frames(self, frames, fps=25, anti_smooth_factor=20):
         """
-        frames: RGB, uint8
+        frames: RGB, uint8, [T, H, W, 3] array or any iterable of [H, W, 3] frames, e.g., VideoFrameReader
         anti_smooth_factor: float, 对video模式的interval进行修改, 1代表无修改, 越大越接近image mode
         """
         img_mpldms = []
@@ -90,8 +151,9 @@ class MediapipeLandmarker:
         img_landmarker = vision.FaceLandmarker.create_from_options(self.image_mode_options)
         vid_landmarker = vision.FaceLandmarker.create_from_options(self.video_mode_options)
 
-        for i in range(len(frames)):
-            frame = mp.Image(image_format=mp.ImageFormat.SRGB, data=frames[i].astype(np.uint8))
+        for i, frame in enumerate(frames):
+            H, W, _ = frame.shape
+            frame = mp.Image(image_format=mp.ImageFormat.SRGB, data=np.ascontiguousarray(frame, dtype=np.uint8))
             img_face_landmarker_result = img_landmarker.detect(image=frame)
             vid_face_landmarker_result = vid_landmarker.detect_for_video(image=frame, timestamp_ms=int((1000/fps)*anti_smooth_factor*i))
             try:
@@ -99,17 +161,74 @@ class MediapipeLandmarker:
                 vid_ldm_i = vid_face_landmarker_result.face_landmarks[0]
             except:
                 print(f"Warning: failed detect ldm in idx={i}, use previous frame results.")
-            img_face_landmarks = np.array([[l.x, l.y, l.z] for l in img_ldm_i])
-            vid_face_landmarks = np.array([[l.x, l.y, l.z] for l in vid_ldm_i])
+            img_face_landmarks = landmarks_to_np(img_ldm_i)
+            vid_face_landmarks = landmarks_to_np(vid_ldm_i)
             img_mpldms.append(img_face_landmarks)
             vid_mpldms.append(vid_face_landmarks)
         img_lm478 = np.stack(img_mpldms)[..., :2]
         vid_lm478 = np.stack(vid_mpldms)[..., :2]
-        bs, H, W, _ = frames.shape
         img_lm478 = np.array(img_lm478)[..., :2] * np.array([W, H]).reshape([1,1,2]) # [T, 478, 2]
         vid_lm478 = np.array(vid_lm478)[..., :2] * np.array([W, H]).reshape([1,1,2]) # [T, 478, 2]
         return img_lm478, vid_lm478
 
+    def multiprocess_extract_lm478_from_video_name(self, video_name, fps=25, anti_smooth_factor=20, num_workers=None):
+        """
+        并行处理单个长视频
+        the stateful VIDEO mode tracker runs through the whole video in one worker, pipelined with the IMAGE mode detection,
+        which is sharded by frame range over the other workers; each worker decodes its own frames and writes
+        the landmarks into a preallocated shared-memory array, so neither frames nor results are pickled.
+        """
+        if num_workers is None:
+            num_workers = int(os.getenv('N_PROC', os.cpu_count()))
+        num_workers = max(2, num_workers) # one for VIDEO mode, the others for IMAGE mode
+        reader = VideoFrameReader(video_name)
+        num_frames, H, W = len(reader), reader.height, reader.width
+        assert num_frames > 0, f"got no frames from {video_name}"
+
+        shm = shared_memory.SharedMemory(create=True, size=num_frames * 2 * (478 * 2 * 4 + 1))
+        lms, valid = shared_lm478_arrays(shm, num_frames)
+        manager = None
+        frame_count_underestimated = False
+        try:
+            valid[:] = False
+            job_kwargs = {'video_name': video_name, 'shm_name': shm.name, 'num_frames': num_frames, 'fps': fps, 'anti_smooth_factor': anti_smooth_factor}
+            num_shards = min(num_workers - 1, num_frames)
+            shard_size = math.ceil(num_frames / num_shards)
+            manager = MultiprocessManager(num_workers=num_shards + 1)
+            # the VIDEO mode job is the longest, submit it first; it reads through the whole video like the single-process path
+            manager.add_job(job_extract_lm478_for_frame_range, {**job_kwargs, 'start': 0, 'end': None, 'mode': 'video'})
+            for start in range(0, num_frames, shard_size):
+                manager.add_job(job_extract_lm478_for_frame_range, {**job_kwargs, 'start': start, 'end': min(start + shard_size, num_frames), 'mode': 'image'})
+            num_read = {}
+            for job_id, res in tqdm.tqdm(manager.get_results(), total=len(manager), desc='extracting lm478 from a video in multi-process'):
+                if res is None:
+                    raise RuntimeError(f"failed to extract lm478 from {video_name}, see the traceback of the worker above")
+                num_read[job_id] = res
+            # the frame count in the container may be inexact, the VIDEO mode job counts the frames actually decoded
+            num_video_frames = num_read[0]
+            num_image_frames = sum(res for job_id, res in num_read.items() if job_id > 0)
+            if num_video_frames > num_frames:
+                frame_count_underestimated = True
+            else:
+                if num_image_frames != num_video_frames:
+                    raise RuntimeError(f"the IMAGE mode shards read {num_image_frames} frames of {video_name}, but the video has {num_video_frames}")
+                num_frames = num_video_frames
+                img_lm478 = fill_undetected_lm478(lms[0, :num_frames], valid[0, :num_frames])
+                vid_lm478 = fill_undetected_lm478(lms[1, :num_frames], valid[1, :num_frames])
+        finally:
+            if manager is not None:
+                manager.close()
+            del lms, valid
+            shm.close()
+            shm.unlink()
+        if frame_count_underestimated:
+            # the shards and the shared memory do not cover the frames past the reported count, rather than dropping them
+            print(f"| {video_name} has more frames than its container reports ({num_frames}), fallback to a single process.")
+            return self.extract_lm478_from_video_name(video_name, fps, anti_smooth_factor, num_workers=1)
+        img_lm478 = img_lm478 * np.array([W, H]).reshape([1,1,2]) # [T, 478, 2]
+        vid_lm478 = vid_lm478 * np.array([W, H]).reshape([1,1,2]) # [T, 478, 2]
+        return img_lm478, vid_lm478
+
     def combine_vid_img_lm478_to_lm68(self, img_lm478, vid_lm478):
         img_lm68 = img_lm478[:, index_lm68_from_lm478]
         vid_lm68 = vid_lm478[:, index_lm68_from_lm478]
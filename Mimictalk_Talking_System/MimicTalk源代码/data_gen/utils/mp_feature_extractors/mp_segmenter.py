@@ -169,11 +169,11 @@ class MediapipeSegmenter:
     def multiprocess_cal_seg_map_for_a_video(self, imgs, num_workers=4):
         """
         并行处理单个长视频
-        imgs: list of rgb array in 0~255
+        imgs: list of rgb array in 0~255, or any iterable of frames, e.g., VideoFrameReader
         """
         segmap_masks = []
         segmap_images = []
-        img_lst = [(self.options, imgs[i]) for i in range(len(imgs))]
+        img_lst = [(self.options, np.ascontiguousarray(img)) for img in imgs]
         for (i, res) in multiprocess_run_tqdm(job_cal_seg_map_for_image, args=img_lst, num_workers=num_workers, desc='extracting from a video in multi-process'):
             segmap_mask, segmap_image = res
             segmap_masks.append(segmap_mask)
@@ -181,13 +181,16 @@ class MediapipeSegmenter:
         return segmap_masks, segmap_images
         
     def _cal_seg_map_for_video(self, imgs, segmenter=None, return_onehot_mask=True, return_segmap_image=True):
+        """
+        imgs: list of rgb array in 0~255, or any iterable of frames, e.g., VideoFrameReader, consumed one frame at a time
+        """
         segmenter = vision.ImageSegmenter.create_from_options(self.video_options) if segmenter is None else segmenter
         assert return_onehot_mask or return_segmap_image # you should at least return one
         segmap_masks = []
         segmap_images = []
-        for i in tqdm.trange(len(imgs), desc="extracting segmaps from a video..."):
-            img = imgs[i]
-            mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=img)
+        total = len(imgs) if hasattr(imgs, '__len__') else None
+        for i, img in enumerate(tqdm.tqdm(imgs, total=total, desc="extracting segmaps from a video...")):
+            mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=np.ascontiguousarray(img))
             out = segmenter.segment_for_video(mp_image, 40 * i)
             segmap = out.category_mask.numpy_view().copy() # [H, W]
 
@@ -3,38 +3,61 @@ import soundfile as sf
 import numpy as np
 import torch
 import os
+import threading
 from utils.commons.hparams import set_hparams, hparams
 
 
 wav2vec2_processor = None
 hubert_model = None
+hubert_lock = threading.Lock() # concurrent requests may extract hubert at the same time
 
 
-def get_hubert_from_16k_wav(wav_16k_name):
+def get_hubert_from_16k_wav(wav_16k_name, **kwargs):
     speech_16k, _ = sf.read(wav_16k_name)
-    hubert = get_hubert_from_16k_speech(speech_16k)
+    hubert = get_hubert_from_16k_speech(speech_16k, **kwargs)
     return hubert
 
-@torch.no_grad()
-def get_hubert_from_16k_speech(speech, device="cuda:0"):
+
+def load_hubert_model(device="cuda:0", fp16=False):
     global hubert_model, wav2vec2_processor
-    local_path = '/home/tiger/.cache/huggingface/hub/models--facebook--hubert-large-ls960-ft/snapshots/ece5fabbf034c1073acae96d5401b25be96709d8'
-    if hubert_model is None:
-        print("Loading the HuBERT Model...")
-        print("Loading the Wav2Vec2 Processor...")
-        if os.path.exists(local_path):
-            hubert_model = HubertModel.from_pretrained(local_path)
-            wav2vec2_processor = Wav2Vec2Processor.from_pretrained(local_path)
-        else:
-            hubert_model = HubertModel.from_pretrained("facebook/hubert-large-ls960-ft")
-            wav2vec2_processor = Wav2Vec2Processor.from_pretrained("facebook/hubert-large-ls960-ft")
-    hubert_model = hubert_model.to(device)
+    with hubert_lock:
+        local_path = '/home/tiger/.cache/huggingface/hub/models--facebook--hubert-large-ls960-ft/snapshots/ece5fabbf034c1073acae96d5401b25be96709d8'
+        if hubert_model is None:
+            print("Loading the HuBERT Model...")
+            print("Loading the Wav2Vec2 Processor...")
+            if os.path.exists(local_path):
+                hubert_model = HubertModel.from_pretrained(local_path)
+                wav2vec2_processor = Wav2Vec2Processor.from_pretrained(local_path)
+            else:
+                hubert_model = HubertModel.from_pretrained("facebook/hubert-large-ls960-ft")
+                wav2vec2_processor = Wav2Vec2Processor.from_pretrained("facebook/hubert-large-ls960-ft")
+            hubert_model.eval()
+        # half precision is only worthwhile on GPU
+        dtype = torch.float16 if fp16 and torch.device(device).type == 'cuda' else torch.float32
+        # only move the model when the device/dtype changes, instead of at every call
+        param = next(hubert_model.parameters())
+        if param.device != torch.device(device) or param.dtype != dtype:
+            hubert_model = hubert_model.to(device=device, dtype=dtype)
+        return hubert_model, wav2vec2_processor
+
+
+@torch.no_grad()
+def iter_hubert_from_16k_speech(speech, device="cuda:0", batch_size=8, fp16=False, num_threads=None):
+    """
+    Yield the hubert features of speech chunk by chunk, each chunk is a [t, 1024] float tensor on cpu.
+    The equal-length clips are stacked into batches of batch_size, only one batch lives on the device at a time,
+        so the peak memory is bounded regardless of the audio length.
+    """
+    if num_threads is not None and torch.device(device).type == 'cpu':
+        torch.set_num_threads(num_threads)
+    hubert_model, wav2vec2_processor = load_hubert_model(device, fp16)
+    dtype = next(hubert_model.parameters()).dtype
 
     if speech.ndim ==2:
         speech = speech[:, 0] # [T, 2] ==> [T,]
     
+    # normalized over the whole utterance on cpu, the clips are moved to the device batch by batch
     input_values_all = wav2vec2_processor(speech, return_tensors="pt", sampling_rate=16000).input_values # [1, T]
-    input_values_all = input_values_all.to(device)
     # For long audio sequence, due to the memory limitation, we cannot process them in one run
     # HuBERT process the wav with a CNN of stride [5,2,2,2,2,2], making a stride of 320
     # Besides, the kernel is [10,3,3,3,3,2,2], making 400 a fundamental unit to get 1 time step.
@@ -42,35 +65,51 @@ def get_hubert_from_16k_speech(speech, device="cuda:0"):
     # We have the equation to calculate out time step: T = floor((t-k)/s)
     # To prevent overlap, we set each clip length of (K+S*(N-1)), where N is the expected length T of this clip
     # The start point of next clip should roll back with a length of (kernel-stride) so it is stride * N
+    # So all the full clips have the same length and can be stacked into one batch
     kernel = 400
     stride = 320
     clip_length = stride * 1000
-    num_iter = input_values_all.shape[1] // clip_length
-    expected_T = (input_values_all.shape[1] - (kernel-stride)) // stride
-    res_lst = []
-    for i in range(num_iter):
-        if i == 0:
-            start_idx = 0
-            end_idx = clip_length - stride + kernel
-        else:
-            start_idx = clip_length * i
-            end_idx = start_idx + (clip_length - stride + kernel)
-        input_values = input_values_all[:, start_idx: end_idx]
+    clip_window = clip_length - stride + kernel
+    num_samples = input_values_all.shape[1]
+    num_iter = num_samples // clip_length
+    # when num_samples % clip_length < kernel - stride, the last full clip lacks some look-ahead samples,
+    # it is shorter than the others and runs on its own, like the clips did before batching
+    num_batched = num_iter
+    if num_iter > 0 and clip_length * (num_iter - 1) + clip_window > num_samples:
+        num_batched = num_iter - 1
+    for batch_start in range(0, num_batched, batch_size):
+        clip_idxs = range(batch_start, min(batch_start + batch_size, num_batched))
+        input_values = torch.cat([input_values_all[:, clip_length * i: clip_length * i + clip_window] for i in clip_idxs], dim=0)
+        input_values = input_values.to(device=device, dtype=dtype)
+        hidden_states = hubert_model.forward(input_values).last_hidden_state # [B, T=pts//320, hid=1024]
+        yield hidden_states.reshape([-1, hidden_states.shape[-1]]).float().cpu()
+    for i in range(num_batched, num_iter):
+        input_values = input_values_all[:, clip_length * i: clip_length * i + clip_window].to(device=device, dtype=dtype)
         hidden_states = hubert_model.forward(input_values).last_hidden_state # [B=1, T=pts//320, hid=1024]
-        res_lst.append(hidden_states[0])
+        yield hidden_states[0].float().cpu()
     if num_iter > 0:
         input_values = input_values_all[:, clip_length * num_iter:]
     else:
         input_values = input_values_all
 
     if input_values.shape[1] >= kernel: # if the last batch is shorter than kernel_size, skip it            
+        input_values = input_values.to(device=device, dtype=dtype)
         hidden_states = hubert_model(input_values).last_hidden_state # [B=1, T=pts//320, hid=1024]
-        res_lst.append(hidden_states[0])
-    ret = torch.cat(res_lst, dim=0).cpu() # [T, 1024]
+        yield hidden_states[0].float().cpu()
+
+
+@torch.no_grad()
+def get_hubert_from_16k_speech(speech, device="cuda:0", batch_size=8, fp16=False, num_threads=None):
+    num_samples = speech.shape[0]
+    kernel = 400
+    stride = 320
+    expected_T = (num_samples - (kernel-stride)) // stride
+    res_lst = list(iter_hubert_from_16k_speech(speech, device=device, batch_size=batch_size, fp16=fp16, num_threads=num_threads))
+    ret = torch.cat(res_lst, dim=0) # [T, 1024]
 
     assert abs(ret.shape[0] - expected_T) <= 1
     if ret.shape[0] < expected_T: # if skipping the last short 
-        ret = torch.cat([ret, ret[:, -1:, :].repeat([1,expected_T-ret.shape[0],1])], dim=1)
+        ret = torch.cat([ret, ret[-1:, :].repeat([expected_T-ret.shape[0], 1])], dim=0)
     else:
         ret = ret[:expected_T]
 
@@ -81,12 +120,15 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('--video_id', type=str, default='May', help='')
+    parser.add_argument('--batch_size', type=int, default=8, help='number of 20s clips per forward')
+    parser.add_argument('--fp16', action='store_true', help='run hubert in half precision on GPU')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch threads when running on CPU')
     args = parser.parse_args()
     ### Process Single Long Audio for NeRF dataset
     person_id = args.video_id
     wav_16k_name = f"data/processed/videos/{person_id}/aud.wav"
     hubert_npy_name = f"data/processed/videos/{person_id}/aud_hubert.npy"
     speech_16k, _ = sf.read(wav_16k_name)
-    hubert_hidden = get_hubert_from_16k_speech(speech_16k)
+    hubert_hidden = get_hubert_from_16k_speech(speech_16k, batch_size=args.batch_size, fp16=args.fp16, num_threads=args.num_threads)
     np.save(hubert_npy_name, hubert_hidden.detach().numpy())
     print(f"Saved at {hubert_npy_name}")
@@ -11,6 +11,7 @@ import cv2
 import argparse
 import tqdm
 from utils.commons.multiprocess_utils import multiprocess_run_tqdm
+from utils.commons.video_reader import VideoFrameReader
 from data_gen.utils.mp_feature_extractors.face_landmarker import MediapipeLandmarker
 
 from deep_3drecon.deep_3drecon_models.bfm import ParametricFaceModel
@@ -71,15 +72,7 @@ def set_requires_grad(tensor_list):
         tensor.requires_grad = True
 
 def read_video_to_frames(img_name):
-    frames = []
-    cap = cv2.VideoCapture(img_name)
-    while cap.isOpened():
-        ret, frame_bgr = cap.read()
-        if frame_bgr is None:
-            break
-        frame_rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
-        frames.append(frame_rgb)
-    return np.stack(frames)
+    return VideoFrameReader(img_name, rgb=True).read_all()
     
 @torch.enable_grad()
 def fit_3dmm_for_a_image(img_name, debug=False, keypoint_mode='mediapipe', device="cuda:0", save=True):
@@ -34,17 +34,17 @@ if __name__ == '__main__':
     import imageio
     import cv2
     import torch
-    from data_gen.utils.process_video.extract_lm2d import extract_lms_mediapipe_job, read_video_to_frames, index_lm68_from_lm468
+    from utils.commons.video_reader import VideoFrameReader
     from data_gen.utils.process_video.fit_3dmm_landmark import fit_3dmm_for_a_video
     from data_util.face3d_helper import Face3DHelper
 
     face3d_helper = Face3DHelper()
     video_name = 'data/raw/videos/May_10s.mp4'
-    frames = read_video_to_frames(video_name)
+    frames = VideoFrameReader(video_name, rgb=True)
     coeff = fit_3dmm_for_a_video(video_name, save=False)
     area_percent = get_eye_area_percent(torch.tensor(coeff['id']), torch.tensor(coeff['exp']), face3d_helper)
     writer = imageio.get_writer("1.mp4", fps=25)
     for idx, frame in enumerate(frames):
-        frame = cv2.putText(frame, f"{area_percent[idx]:.2f}", org=(128,128), fontFace=cv2.FONT_HERSHEY_COMPLEX, fontScale=1, color=(255,0,0), thickness=1)
+        frame = cv2.putText(np.ascontiguousarray(frame), f"{area_percent[idx]:.2f}", org=(128,128), fontFace=cv2.FONT_HERSHEY_COMPLEX, fontScale=1, color=(255,0,0), thickness=1)
         writer.append_data(frame)
     writer.close()
\ No newline at end of file
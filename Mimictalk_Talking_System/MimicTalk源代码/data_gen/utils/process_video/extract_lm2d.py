@@ -56,7 +56,7 @@ def load_file(name):
 
 face_landmarker = None
     
-def extract_landmark_job(video_name, nerf=False):
+def extract_landmark_job(video_name, nerf=False, num_workers=1):
     try:
         if nerf:
             out_name = video_name.replace("/raw/", "/processed/").replace(".mp4","/lms_2d.npy")
@@ -72,7 +72,7 @@ def extract_landmark_job(video_name, nerf=False):
         global face_landmarker
         if face_landmarker is None:
             face_landmarker = MediapipeLandmarker()
-        img_lm478, vid_lm478 = face_landmarker.extract_lm478_from_video_name(video_name)
+        img_lm478, vid_lm478 = face_landmarker.extract_lm478_from_video_name(video_name, num_workers=num_workers)
         lm478 = face_landmarker.combine_vid_img_lm478_to_lm478(img_lm478, vid_lm478)
         np.save(out_name, lm478)
         return True
@@ -103,6 +103,7 @@ if __name__ == '__main__':
     parser.add_argument("--vid_dir", default='nerf')
     parser.add_argument("--ds_name", default='data/raw/videos/May.mp4')
     parser.add_argument("--num_workers", default=2, type=int)
+    parser.add_argument("--frame_workers", default=1, type=int) # ds_name=nerf only, >1 splits the frames of the video over that many processes
     parser.add_argument("--process_id", default=0, type=int)
     parser.add_argument("--total_process", default=1, type=int)
     parser.add_argument("--reset", action="store_true")
@@ -154,11 +155,16 @@ if __name__ == '__main__':
         vid_names = get_todo_vid_names(vid_names)
     print(f"todo videos number: {len(vid_names)}")
 
-    fail_cnt = 0
-    job_args = [(vid_name, ds_name=='nerf') for vid_name in vid_names]
-    for (i, res) in multiprocess_run_tqdm(extract_landmark_job, job_args, num_workers=args.num_workers, desc=f"Root {args.process_id}: extracing MP-based landmark2d"): 
-        if res is False:
-            fail_cnt += 1
-        print(f"finished {i + 1} / {len(vid_names)} = {(i + 1) / len(vid_names):.4f}, failed {fail_cnt} / {i + 1} = {fail_cnt / (i + 1):.4f}")
-        sys.stdout.flush()
-        pass
\ No newline at end of file
+    if ds_name.lower() == 'nerf':
+        # a single video, which may be parallelized over its frames with --frame_workers
+        if vid_names:
+            extract_landmark_job(vid_names[0], nerf=True, num_workers=args.frame_workers)
+    else:
+        fail_cnt = 0
+        job_args = [(vid_name, ds_name=='nerf') for vid_name in vid_names]
+        for (i, res) in multiprocess_run_tqdm(extract_landmark_job, job_args, num_workers=args.num_workers, desc=f"Root {args.process_id}: extracing MP-based landmark2d"): 
+            if res is False:
+                fail_cnt += 1
+            print(f"finished {i + 1} / {len(vid_names)} = {(i + 1) / len(vid_names):.4f}, failed {fail_cnt} / {i + 1} = {fail_cnt / (i + 1):.4f}")
+            sys.stdout.flush()
+            pass
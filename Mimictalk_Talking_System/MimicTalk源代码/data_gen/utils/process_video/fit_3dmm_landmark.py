@@ -18,7 +18,8 @@ import cv2
 import argparse
 import tqdm
 from utils.commons.multiprocess_utils import multiprocess_run_tqdm
-from data_gen.utils.mp_feature_extractors.face_landmarker import MediapipeLandmarker, read_video_to_frames
+from data_gen.utils.mp_feature_extractors.face_landmarker import MediapipeLandmarker
+from utils.commons.video_reader import VideoFrameReader
 from deep_3drecon.deep_3drecon_models.bfm import ParametricFaceModel
 from deep_3drecon.secc_renderer import SECC_Renderer
 from utils.commons.os_utils import multiprocess_glob
@@ -78,7 +79,7 @@ def cal_vel_loss(ldm):
     vel = ldm[1:] - ldm[:-1]
     return torch.mean(torch.abs(vel))
 
-def cal_lan_loss(proj_lan, gt_lan):
+def cal_lan_loss(proj_lan, gt_lan, mean:bool=True):
     # [B, 68, 2]
     loss = (proj_lan - gt_lan)** 2
     # use the ldm weights from deep3drecon, see deep_3drecon/deep_3drecon_models/losses.py
@@ -88,7 +89,9 @@ def cal_lan_loss(proj_lan, gt_lan):
     weights[:, -8:, :] =  3 # inner lip 8 points
     weights[:, 28:31, :] =  3 # nose 3 points
     loss = loss * weights
-    return torch.mean(loss)
+    if mean:
+        loss = torch.mean(loss)
+    return loss
 
 def cal_lan_loss_mp(proj_lan, gt_lan, mean:bool=True):
     # [B, 68, 2]
@@ -127,6 +130,95 @@ def set_requires_grad(tensor_list):
     for tensor in tensor_list:
         tensor.requires_grad = True
 
+def cal_lap_loss_batched(in_tensor):
+    # [W, T, ...] => [W], cal_lap_loss of each window
+    w, t = in_tensor.shape[:2]
+    in_tensor = in_tensor.reshape([w, t, -1]).permute(0,2,1).reshape([-1, 1, t]) # [w*c, 1, t]
+    in_tensor = torch.cat([in_tensor[:, :, 0:1], in_tensor, in_tensor[:, :, -1:]], dim=-1)
+    lap_kernel = torch.Tensor((-0.5, 1.0, -0.5)).reshape([1,1,3]).float().to(in_tensor.device) # [1, 1, kw]
+    out_tensor = F.conv1d(in_tensor, lap_kernel)
+    return (out_tensor**2).reshape([w, -1]).mean(dim=1)
+
+def cal_vel_loss_batched(ldm):
+    # [W, T, ...] => [W], cal_vel_loss of each window
+    vel = ldm[:, 1:] - ldm[:, :-1]
+    return vel.abs().reshape([ldm.shape[0], -1]).mean(dim=1)
+
+def get_fine_fit_windows(num_frames, window_size=50):
+    """
+    the start frame of each window of the fine fitting,
+        the last window is shifted back to end at the last frame, so it overlaps the previous one
+    """
+    window_size = min(window_size, num_frames)
+    starts = list(range(0, num_frames, window_size))
+    if starts[-1] + window_size > num_frames:
+        starts[-1] = num_frames - window_size
+    return starts, window_size
+
+def concat_lms_chunks(lms_chunks):
+    # concat a frame-chunked landmark stream on GPU, so only one chunk is on the host at a time
+    lms_chunks = [torch.as_tensor(np.asarray(chunk)[:, :468, :]).float().cuda() for chunk in lms_chunks]
+    return torch.cat(lms_chunks, dim=0)
+
+@torch.enable_grad()
+def fine_fit_3dmm_batched(lms, id_para, exp_para, euler_angle, trans, cal_lan_loss_fn, lambdas, id_mode='global',
+                          window_size=50, num_iters=50, lr=0.005, max_frames_per_step=None, debug=False):
+    """
+    the batched version of the windowed fine fitting in fit_3dmm_for_a_video:
+        all windows are optimized at once as one problem, the loss is the sum of the per-window losses,
+        so each window gets the same gradients as when it is fitted alone, and Adam keeps its state per element, i.e., per window.
+    The fitted windows are written back in order, so the last (overlapping) window wins on the overlapped frames.
+    args:
+        lms: [T, 468, 2], the gt landmarks
+        id_para: [1, 80] for id_mode=global, else [T, 80]; exp_para: [T, 64]; euler_angle, trans: [T, 3]
+        lambdas: dict of the loss weights, reg_id | reg_exp | reg_lap | reg_vel_id | reg_vel_exp
+        max_frames_per_step: optimize at most this number of frames at once to bound the memory, None for all windows
+    """
+    num_frames = exp_para.shape[0]
+    id_dim, exp_dim = id_para.shape[-1], exp_para.shape[-1]
+    starts, window_size = get_fine_fit_windows(num_frames, window_size)
+    num_windows_per_step = len(starts) if not max_frames_per_step else max(1, max_frames_per_step // window_size)
+    for step_i in range(0, len(starts), num_windows_per_step):
+        step_starts = starts[step_i: step_i+num_windows_per_step]
+        num_windows = len(step_starts)
+        sel_ids = torch.stack([torch.arange(start, start+window_size) for start in step_starts]).to(lms.device) # [W, B]
+        sel_lms = lms[sel_ids].reshape([num_windows*window_size, -1, 2]).detach()
+
+        sel_exp_para = exp_para.detach()[sel_ids].clone().requires_grad_(True) # [W, B, 64]
+        sel_euler_angle = euler_angle.detach()[sel_ids].clone().requires_grad_(True)
+        sel_trans = trans.detach()[sel_ids].clone().requires_grad_(True)
+        if id_mode == 'global':
+            sel_id_para = id_para.detach().reshape([1, 1, id_dim]).expand([num_windows, window_size, id_dim])
+            optimizer = torch.optim.Adam([sel_exp_para, sel_euler_angle, sel_trans], lr=lr)
+        else:
+            sel_id_para = id_para.detach()[sel_ids].clone().requires_grad_(True)
+            optimizer = torch.optim.Adam([sel_id_para, sel_exp_para, sel_euler_angle, sel_trans], lr=lr)
+
+        for j in range(num_iters):
+            proj_geo = face_model.compute_for_landmark_fit(
+                sel_id_para.reshape([-1, id_dim]), sel_exp_para.reshape([-1, exp_dim]), sel_euler_angle.reshape([-1, 3]), sel_trans.reshape([-1, 3]))
+            loss_lan = cal_lan_loss_fn(proj_geo[:, :, :2], sel_lms, mean=False).reshape([num_windows, -1]).mean(dim=1)
+            loss_lap = cal_lap_loss_batched(sel_id_para) + cal_lap_loss_batched(sel_exp_para) + cal_lap_loss_batched(sel_euler_angle) * 0.3 + cal_lap_loss_batched(sel_trans) * 0.3
+            loss_vel_id = cal_vel_loss_batched(sel_id_para)
+            loss_vel_exp = cal_vel_loss_batched(sel_exp_para)
+            loss_regid = (sel_id_para*sel_id_para).reshape([num_windows, -1]).mean(dim=1) # 正则化
+            loss_regexp = (sel_exp_para*sel_exp_para).reshape([num_windows, -1]).mean(dim=1)
+            loss = loss_lan + loss_regid * lambdas['reg_id'] + loss_regexp * lambdas['reg_exp'] + loss_lap * lambdas['reg_lap'] + loss_vel_id * lambdas['reg_vel_id'] + loss_vel_exp * lambdas['reg_vel_exp']
+
+            optimizer.zero_grad()
+            loss.sum().backward()
+            optimizer.step()
+
+        if debug:
+            print(f"windows {step_i}~{step_i+num_windows-1} | loss_lan: {loss_lan.mean().item():.2f}, loss_reg_id: {loss_regid.mean().item():.2f},loss_reg_exp: {loss_regexp.mean().item():.2f},loss_lap_ldm:{loss_lap.mean().item():.4f}")
+        for w, start in enumerate(step_starts):
+            if id_mode != 'global':
+                id_para.data[start:start+window_size] = sel_id_para.data[w]
+            exp_para.data[start:start+window_size] = sel_exp_para.data[w]
+            euler_angle.data[start:start+window_size] = sel_euler_angle.data[w]
+            trans.data[start:start+window_size] = sel_trans.data[w]
+    return id_para, exp_para, euler_angle, trans
+
 @torch.enable_grad()
 def fit_3dmm_for_a_video(
     video_name, 
@@ -135,9 +227,13 @@ def fit_3dmm_for_a_video(
     debug=False, 
     keypoint_mode='mediapipe',
     large_yaw_threshold=9999999.9,
-    save=True
+    save=True,
+    fine_mode='sequential', # sequential | batched, see fine_fit_3dmm_batched
+    fine_max_frames_per_step=None, # for fine_mode=batched, None to fit all windows at once
+    lms=None, # precomputed landmarks, [T, 468/478, 2] array or an iterable of frame chunks of it
 ) -> bool: # True: good, False: bad 
     assert video_name.endswith(".mp4"), "this function only support video as input"
+    assert fine_mode in ['sequential', 'batched'], f"fine mode {fine_mode} not supported!"
     if id_mode == 'global':
         LAMBDA_REG_ID = 0.2
         LAMBDA_REG_EXP = 0.6
@@ -151,17 +247,18 @@ def fit_3dmm_for_a_video(
         LAMBDA_REG_VEL_ID = 0.0 # laplcaian is all you need for temporal consistency
         LAMBDA_REG_VEL_EXP = 0.0 # laplcaian is all you need for temporal consistency
 
-    frames = read_video_to_frames(video_name) # [T, H, W, 3]
-    img_h, img_w = frames.shape[1], frames.shape[2]
+    frames = VideoFrameReader(video_name, rgb=True) # streamed [H, W, 3] frames, never decoded as a whole
+    img_h, img_w = frames.height, frames.width
     assert img_h == img_w
-    num_frames = len(frames)
 
     if nerf: # single video
         lm_name = video_name.replace("/raw/", "/processed/").replace(".mp4","/lms_2d.npy")
     else:
         lm_name = video_name.replace("/video/", "/lms_2d/").replace(".mp4", "_lms.npy")
 
-    if os.path.exists(lm_name):
+    if lms is not None:
+        lms = lms if isinstance(lms, (np.ndarray, torch.Tensor)) else concat_lms_chunks(lms)
+    elif os.path.exists(lm_name):
         lms = np.load(lm_name)
     else:
         print(f"lms_2d file not found, try to extract it from video... {lm_name}")
@@ -176,7 +273,8 @@ def fit_3dmm_for_a_video(
             print(f"get None lms_2d, please check whether each frame has one head, exiting... {lm_name}")
             return False
     lms = lms[:, :468, :]
-    lms = torch.FloatTensor(lms).cuda()
+    lms = torch.as_tensor(lms).float().cuda().clone()
+    num_frames = len(lms) # the frame count in the video container may be inexact
     lms[..., 1] = img_h - lms[..., 1] # flip the height axis
 
     if keypoint_mode == 'mediapipe':
@@ -290,72 +388,77 @@ def fit_3dmm_for_a_video(
     trans = trans_
     
     batch_size = 50
-    # "fine fitting the 3DMM in batches"
-    for i in range(int((num_frames-1)/batch_size+1)):
-        if (i+1)*batch_size > num_frames:
-            start_n = num_frames-batch_size
-            sel_ids = np.arange(max(num_frames-batch_size,0), num_frames)
-        else:
-            start_n = i*batch_size
-            sel_ids = np.arange(i*batch_size, i*batch_size+batch_size)
-        sel_lms = lms[sel_ids]
-
-        if id_mode == 'global':
-            sel_id_para = id_para.expand((sel_ids.shape[0], id_dim))
-        else:
-            sel_id_para = id_para.new_zeros((batch_size, id_dim), requires_grad=True)
-            sel_id_para.data = id_para[sel_ids].clone()
-        sel_exp_para = exp_para.new_zeros(
-            (batch_size, exp_dim), requires_grad=True)
-        sel_exp_para.data = exp_para[sel_ids].clone()
-        sel_euler_angle = euler_angle.new_zeros(
-            (batch_size, 3), requires_grad=True)
-        sel_euler_angle.data = euler_angle[sel_ids].clone()
-        sel_trans = trans.new_zeros((batch_size, 3), requires_grad=True)
-        sel_trans.data = trans[sel_ids].clone()
+    if fine_mode == 'batched':
+        lambdas = {'reg_id': LAMBDA_REG_ID, 'reg_exp': LAMBDA_REG_EXP, 'reg_lap': LAMBDA_REG_LAP, 'reg_vel_id': LAMBDA_REG_VEL_ID, 'reg_vel_exp': LAMBDA_REG_VEL_EXP}
+        id_para, exp_para, euler_angle, trans = fine_fit_3dmm_batched(lms, id_para, exp_para, euler_angle, trans, cal_lan_loss_fn, lambdas, id_mode=id_mode,
+                window_size=batch_size, max_frames_per_step=fine_max_frames_per_step, debug=debug)
+    else:
+        # "fine fitting the 3DMM in batches"
+        for i in range(int((num_frames-1)/batch_size+1)):
+            if (i+1)*batch_size > num_frames:
+                start_n = num_frames-batch_size
+                sel_ids = np.arange(max(num_frames-batch_size,0), num_frames)
+            else:
+                start_n = i*batch_size
+                sel_ids = np.arange(i*batch_size, i*batch_size+batch_size)
+            sel_lms = lms[sel_ids]
+
+            if id_mode == 'global':
+                sel_id_para = id_para.expand((sel_ids.shape[0], id_dim))
+            else:
+                sel_id_para = id_para.new_zeros((batch_size, id_dim), requires_grad=True)
+                sel_id_para.data = id_para[sel_ids].clone()
+            sel_exp_para = exp_para.new_zeros(
+                (batch_size, exp_dim), requires_grad=True)
+            sel_exp_para.data = exp_para[sel_ids].clone()
+            sel_euler_angle = euler_angle.new_zeros(
+                (batch_size, 3), requires_grad=True)
+            sel_euler_angle.data = euler_angle[sel_ids].clone()
+            sel_trans = trans.new_zeros((batch_size, 3), requires_grad=True)
+            sel_trans.data = trans[sel_ids].clone()
         
-        if id_mode == 'global':
-            set_requires_grad([sel_exp_para, sel_euler_angle, sel_trans])
-            optimizer_cur_batch = torch.optim.Adam(
-                [sel_exp_para, sel_euler_angle, sel_trans], lr=0.005)
-        else:
-            set_requires_grad([sel_id_para, sel_exp_para, sel_euler_angle, sel_trans])
-            optimizer_cur_batch = torch.optim.Adam(
-                [sel_id_para, sel_exp_para, sel_euler_angle, sel_trans], lr=0.005)
-
-        for j in range(50):
-            ret = {}
-            proj_geo = face_model.compute_for_landmark_fit(
-                sel_id_para, sel_exp_para, sel_euler_angle, sel_trans, ret)
-            loss_lan = cal_lan_loss_fn(
-                proj_geo[:, :, :2], lms[sel_ids].detach())
+            if id_mode == 'global':
+                set_requires_grad([sel_exp_para, sel_euler_angle, sel_trans])
+                optimizer_cur_batch = torch.optim.Adam(
+                    [sel_exp_para, sel_euler_angle, sel_trans], lr=0.005)
+            else:
+                set_requires_grad([sel_id_para, sel_exp_para, sel_euler_angle, sel_trans])
+                optimizer_cur_batch = torch.optim.Adam(
+                    [sel_id_para, sel_exp_para, sel_euler_angle, sel_trans], lr=0.005)
+
+            for j in range(50):
+                ret = {}
+                proj_geo = face_model.compute_for_landmark_fit(
+                    sel_id_para, sel_exp_para, sel_euler_angle, sel_trans, ret)
+                loss_lan = cal_lan_loss_fn(
+                    proj_geo[:, :, :2], lms[sel_ids].detach())
             
-            # loss_lap = cal_lap_loss(proj_geo)
-            loss_lap = cal_lap_loss(sel_id_para) + cal_lap_loss(sel_exp_para) + cal_lap_loss(sel_euler_angle) * 0.3 + cal_lap_loss(sel_trans) * 0.3
-            loss_vel_id = cal_vel_loss(sel_id_para)
-            loss_vel_exp = cal_vel_loss(sel_exp_para)
-            log_dict = {
-                'loss_vel_id': loss_vel_id,
-                'loss_vel_exp': loss_vel_exp,
-                'loss_vel_euler': cal_vel_loss(sel_euler_angle),
-                'loss_vel_trans': cal_vel_loss(sel_trans),
-            }
-            loss_regid = torch.mean(sel_id_para*sel_id_para) # 正则化
-            loss_regexp = torch.mean(sel_exp_para*sel_exp_para)
-            loss = loss_lan + loss_regid * LAMBDA_REG_ID + loss_regexp * LAMBDA_REG_EXP + loss_lap * LAMBDA_REG_LAP + loss_vel_id * LAMBDA_REG_VEL_ID + loss_vel_exp * LAMBDA_REG_VEL_EXP
-
-            optimizer_cur_batch.zero_grad()
-            loss.backward()
-            optimizer_cur_batch.step()
+                # loss_lap = cal_lap_loss(proj_geo)
+                loss_lap = cal_lap_loss(sel_id_para) + cal_lap_loss(sel_exp_para) + cal_lap_loss(sel_euler_angle) * 0.3 + cal_lap_loss(sel_trans) * 0.3
+                loss_vel_id = cal_vel_loss(sel_id_para)
+                loss_vel_exp = cal_vel_loss(sel_exp_para)
+                log_dict = {
+                    'loss_vel_id': loss_vel_id,
+                    'loss_vel_exp': loss_vel_exp,
+                    'loss_vel_euler': cal_vel_loss(sel_euler_angle),
+                    'loss_vel_trans': cal_vel_loss(sel_trans),
+                }
+                loss_regid = torch.mean(sel_id_para*sel_id_para) # 正则化
+                loss_regexp = torch.mean(sel_exp_para*sel_exp_para)
+                loss = loss_lan + loss_regid * LAMBDA_REG_ID + loss_regexp * LAMBDA_REG_EXP + loss_lap * LAMBDA_REG_LAP + loss_vel_id * LAMBDA_REG_VEL_ID + loss_vel_exp * LAMBDA_REG_VEL_EXP
+
+                optimizer_cur_batch.zero_grad()
+                loss.backward()
+                optimizer_cur_batch.step()
             
-        if debug:
-            print(f"batch {i} | loss_lan: {loss_lan.item():.2f}, loss_reg_id: {loss_regid.item():.2f},loss_reg_exp: {loss_regexp.item():.2f},loss_lap_ldm:{loss_lap.item():.4f}")
-            print("|--------" + ', '.join([f"{k}: {v:.4f}" for k,v in log_dict.items()]))
-        if id_mode != 'global':
-            id_para[sel_ids].data = sel_id_para.data.clone()
-        exp_para[sel_ids].data = sel_exp_para.data.clone()
-        euler_angle[sel_ids].data = sel_euler_angle.data.clone()
-        trans[sel_ids].data = sel_trans.data.clone()
+            if debug:
+                print(f"batch {i} | loss_lan: {loss_lan.item():.2f}, loss_reg_id: {loss_regid.item():.2f},loss_reg_exp: {loss_regexp.item():.2f},loss_lap_ldm:{loss_lap.item():.4f}")
+                print("|--------" + ', '.join([f"{k}: {v:.4f}" for k,v in log_dict.items()]))
+            if id_mode != 'global':
+                id_para[sel_ids].data = sel_id_para.data.clone()
+            exp_para[sel_ids].data = sel_exp_para.data.clone()
+            euler_angle[sel_ids].data = sel_euler_angle.data.clone()
+            trans[sel_ids].data = sel_trans.data.clone()
 
     coeff_dict = {'id': id_para.detach().cpu().numpy(), 'exp': exp_para.detach().cpu().numpy(),
                 'euler': euler_angle.detach().cpu().numpy(), 'trans': trans.detach().cpu().numpy()}
@@ -414,14 +517,15 @@ def fit_3dmm_for_a_video(
         lm68s[..., 1] = img_h - lm68s[..., 1] # flip the height axis
         lms[..., 1] = img_h - lms[..., 1] # flip the height axis
         lm68s = lm68s.astype(int)
-        for i in tqdm.trange(min(250, len(frames)), desc=f'rendering debug video to {debug_name}..'):
+        debug_frames = VideoFrameReader(video_name, rgb=True, max_frames=min(250, num_frames))
+        for i, frame in enumerate(tqdm.tqdm(debug_frames, desc=f'rendering debug video to {debug_name}..')):
             xy_cam3d_img = xy_camera_visualizer.extrinsic2pyramid(extrinsic[i], focal_len_scaled=0.25)
             xy_cam3d_img = cv2.resize(xy_cam3d_img, (512,512))
             xz_cam3d_img = xz_camera_visualizer.extrinsic2pyramid(extrinsic[i], focal_len_scaled=0.25)
             xz_cam3d_img = cv2.resize(xz_cam3d_img, (512,512))
             
-            img = copy.deepcopy(frames[i])
-            img2 = copy.deepcopy(frames[i])
+            img = np.ascontiguousarray(frame) # cv2 draws on contiguous arrays only
+            img2 = img.copy()
 
             img = draw_axes(img, euler_angle[i,0].item(), euler_angle[i,1].item(), euler_angle[i,2].item(), lm68s[i][4][0].item(), lm68s[i, 4][1].item(), size=50)
 
@@ -488,6 +592,8 @@ if __name__ == '__main__':
     parser.add_argument("--id_mode", default='global', type=str) # global | finegrained
     parser.add_argument("--keypoint_mode", default='mediapipe', type=str)
     parser.add_argument("--large_yaw_threshold", default=9999999.9, type=float) # could be 0.7
+    parser.add_argument("--fine_mode", default='sequential', type=str) # sequential | batched
+    parser.add_argument("--fine_max_frames_per_step", default=None, type=int) # for fine_mode=batched
     parser.add_argument("--debug", action='store_true')
     parser.add_argument("--reset", action='store_true')
     parser.add_argument("--load_names", action="store_true")
@@ -553,7 +659,8 @@ if __name__ == '__main__':
         img_name = vid_names[i]
         try:
             is_person_specific_data = ds_name=='nerf'
-            success = fit_3dmm_for_a_video(img_name, is_person_specific_data, args.id_mode, args.debug, large_yaw_threshold=args.large_yaw_threshold)
+            success = fit_3dmm_for_a_video(img_name, is_person_specific_data, args.id_mode, args.debug, large_yaw_threshold=args.large_yaw_threshold,
+                                            fine_mode=args.fine_mode, fine_max_frames_per_step=args.fine_max_frames_per_step)
             if not success:
                 failed_img_names.append(img_name)   
         except Exception as e:
@@ -114,6 +114,19 @@ class ParametricFaceModel:
         face_shape = id_part + exp_part + self.mean_shape.reshape([1, -1])
         return face_shape.reshape([batch_size, -1, 3])
     
+    def compute_id_shape(self, id_coeff):
+        """
+        Return:
+            id_shape         -- torch.tensor, size (B, N*3), mean shape plus the identity part, constant for a speaker
+
+        Parameters:
+            id_coeff         -- torch.tensor, size (B, 80), identity coeffs
+        """
+        if not self.initialized:
+            self.to(id_coeff.device)
+        id_part = torch.einsum('ij,aj->ai', self.id_base, id_coeff)
+        return id_part + self.mean_shape.reshape([1, -1])
+
     def compute_key_shape(self, id_coeff, exp_coeff):
         """
         Return:
@@ -346,6 +359,23 @@ class ParametricFaceModel:
         face_vertex = self.to_camera(face_shape_transformed)
         return face_vertex
     
+    def compute_face_vertex_with_id_shape(self, id_shape, exp, angle, trans):
+        """
+        same as compute_face_vertex, but with the identity part precomputed by compute_id_shape,
+        so only the expression basis and the rigid transform are applied per frame
+        Return:
+            face_vertex     -- torch.tensor, size (B, N, 3), in camera coordinate
+        Parameters:
+            id_shape        -- torch.tensor, size (1, N*3) or (B, N*3)
+        """
+        batch_size = exp.shape[0]
+        exp_part = torch.einsum('ij,aj->ai', self.exp_base, exp)
+        face_shape = (exp_part + id_shape).reshape([batch_size, -1, 3])
+        rotation = self.compute_rotation(angle, device=self.device)
+        face_shape_transformed = self.transform(face_shape, rotation, trans)
+        face_vertex = self.to_camera(face_shape_transformed)
+        return face_vertex
+    
     def compute_for_landmark_fit(self, id, exp, angles, trans, ret=None):
         """
         Return:
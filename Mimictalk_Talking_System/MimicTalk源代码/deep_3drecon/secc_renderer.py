@@ -8,15 +8,23 @@ from deep_3drecon.deep_3drecon_models.bfm import ParametricFaceModel
 
 
 class SECC_Renderer(nn.Module):
-    def __init__(self, rasterize_size=None, device="cuda"):
+    def __init__(self, rasterize_size=None, device=None, backend=None):
+        """
+        device: by default cuda if available, else cpu
+        backend: the rasterizer of MeshRenderer, by default 'torch' on CPU and 'pytorch3d' otherwise
+        """
         super().__init__()
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.face_model = ParametricFaceModel('deep_3drecon/BFM')
         self.fov = 2 * np.arctan(self.face_model.center / self.face_model.focal) * 180 / np.pi
         self.znear = 5.
         self.zfar = 15.
         if rasterize_size is None:
             rasterize_size = 2*self.face_model.center 
-        self.face_renderer = MeshRenderer(rasterize_fov=self.fov, znear=self.znear, zfar=self.zfar, rasterize_size=rasterize_size, use_opengl=False).cuda()
+        if backend is None:
+            backend = 'torch' if torch.device(device).type == 'cpu' else 'pytorch3d'
+        self.face_renderer = MeshRenderer(rasterize_fov=self.fov, znear=self.znear, zfar=self.zfar, rasterize_size=rasterize_size, use_opengl=False, backend=backend).to(device)
         face_feat = np.load("deep_3drecon/ncc_code.npy", allow_pickle=True)
         self.face_feat = torch.tensor(face_feat.T).unsqueeze(0).to(device=device)
 
@@ -29,7 +37,36 @@ class SECC_Renderer(nn.Module):
             if i not in del_index_re and i not in del_index_le:
                 face_buf_list.append(self.face_model.face_buf[i])
         face_buf_arr = np.array(face_buf_list)
-        self.face_buf = torch.tensor(face_buf_arr).to(device=device)
+        self.face_buf = torch.tensor(face_buf_arr, dtype=torch.int32).to(device=device) # int32 as the rasterizer takes
+        self.bound_id = None # [1, 80], see bind_identity
+        self.id_shape = None # [1, N*3], mean shape + identity part of bound_id
+        self.batched_topology = (0, None, None) # (bs, face_buf [bs, M, 3], face_feat [bs, N, 3])
+
+    def bind_identity(self, id):
+        """
+        precompute the mean + identity shape of a speaker, then the frames rendered with this id
+        only apply the expression basis and the rigid transform.
+        id: [1, 80] or [80]
+        """
+        self.bound_id = id.reshape([1, -1]).detach().clone()
+        self.id_shape = self.face_model.compute_id_shape(self.bound_id)
+
+    def unbind_identity(self):
+        self.bound_id = None
+        self.id_shape = None
+
+    def is_bound_identity(self, id):
+        if self.bound_id is None or id.requires_grad: # keep the gradient to id
+            return False
+        if id.device != self.bound_id.device or id.dtype != self.bound_id.dtype or id.shape[-1] != self.bound_id.shape[-1]:
+            return False
+        return torch.equal(id, self.bound_id.expand_as(id))
+
+    def get_batched_topology(self, bs):
+        # the rasterizer takes the triangles and NCC features per mesh, materialize them once and reuse them for the chunks of the same size
+        if self.batched_topology[0] != bs:
+            self.batched_topology = (bs, self.face_buf.unsqueeze(0).expand([bs, -1, -1]).contiguous(), self.face_feat.expand([bs, -1, -1]).contiguous())
+        return self.batched_topology[1], self.batched_topology[2]
     
     def forward(self, id, exp, euler, trans):
         """
@@ -46,9 +83,12 @@ class SECC_Renderer(nn.Module):
             bs = bs * t
             id, exp, euler, trans = id.reshape([bs,-1]), exp.reshape([bs,-1]), euler.reshape([bs,-1]), trans.reshape([bs,-1])
 
-        face_vertex = self.face_model.compute_face_vertex(id, exp, euler, trans)
-        face_mask, _, secc_face = self.face_renderer(
-                face_vertex, self.face_buf.unsqueeze(0).repeat([bs, 1, 1]), feat=self.face_feat.repeat([bs,1,1]))
+        if self.is_bound_identity(id):
+            face_vertex = self.face_model.compute_face_vertex_with_id_shape(self.id_shape, exp, euler, trans)
+        else:
+            face_vertex = self.face_model.compute_face_vertex(id, exp, euler, trans)
+        face_buf, face_feat = self.get_batched_topology(bs)
+        face_mask, _, secc_face = self.face_renderer(face_vertex, face_buf, feat=face_feat)
         secc_face = (secc_face - 0.5) / 0.5 # scale to -1~1 
 
         if is_btc_flag:
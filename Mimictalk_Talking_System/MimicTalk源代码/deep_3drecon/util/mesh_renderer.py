@@ -10,6 +10,7 @@ from typing import List
 from scipy.io import loadmat
 from torch import nn
 import traceback
+from deep_3drecon.util.torch_rasterizer import rasterize_meshes, faces_to_packed, interpolate_face_attributes
 
 try:
     import pytorch3d.ops
@@ -37,8 +38,13 @@ class MeshRenderer(nn.Module):
                 rasterize_fov,
                 znear=0.1,
                 zfar=10, 
-                rasterize_size=224,**args):
+                rasterize_size=224,
+                backend='pytorch3d', **args):
+        """
+        backend: 'pytorch3d', or 'torch' for the pure-PyTorch rasterizer that runs without pytorch3d, e.g., on CPU
+        """
         super(MeshRenderer, self).__init__()
+        assert backend in ['pytorch3d', 'torch'], f"unknown rasterizer backend {backend}"
 
         # x = np.tan(np.deg2rad(rasterize_fov * 0.5)) * znear
         # self.ndc_proj = torch.tensor(ndc_projection(x=x, n=znear, f=zfar)).matmul(
@@ -47,6 +53,7 @@ class MeshRenderer(nn.Module):
         self.fov = rasterize_fov
         self.znear = znear
         self.zfar = zfar
+        self.backend = backend
 
         self.rasterizer = None
     
@@ -71,10 +78,13 @@ class MeshRenderer(nn.Module):
             vertex[..., 0] = -vertex[..., 0]
 
 
+        if self.backend == 'torch':
+            return self.forward_torch(vertex[..., :3], tri, feat)
+
         # vertex_ndc = vertex @ ndc_proj.t()
         if self.rasterizer is None:
             self.rasterizer = MeshRasterizer()
-            print("create rasterizer on device cuda:%d"%device.index)
+            print("create rasterizer on device %s"%device)
         
         # ranges = None
         # if isinstance(tri, List) or len(tri.shape) == 3:
@@ -129,3 +139,20 @@ class MeshRenderer(nn.Module):
         
         return mask, depth, image
 
+    def forward_torch(self, vertex, tri, feat=None):
+        """
+        same as forward, rasterized by deep_3drecon.util.torch_rasterizer
+        vertex: [B, N, 3], with the x axis already flipped as in forward
+        """
+        rast_out, depth, bary = rasterize_meshes(vertex, tri, int(self.rasterize_size), self.fov)
+        mask = (rast_out > 0).float().unsqueeze(1)
+        depth = mask * depth.unsqueeze(1)
+
+        image = None
+        if feat is not None:
+            faces_packed = faces_to_packed(tri, vertex.shape[0], vertex.shape[1])
+            attributes = feat.reshape(-1, feat.shape[-1])[faces_packed]
+            image = interpolate_face_attributes(rast_out, bary, attributes).permute(0, 3, 1, 2)
+            image = mask * image
+        return mask, depth, image
+
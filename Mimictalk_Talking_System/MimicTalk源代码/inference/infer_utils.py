@@ -1,4 +1,7 @@
 import os
+import uuid
+import shutil
+import threading
 import torch
 import torch.nn.functional as F
 import librosa
@@ -8,6 +11,7 @@ import tqdm
 import copy
 import cv2
 from scipy.spatial.transform import Rotation
+from modules.eg3ds.volumetric_rendering.renderer import RENDER_BYTES_PER_SAMPLE
 
 
 def load_img_to_512_hwc_array(img_name):
@@ -101,48 +105,101 @@ def smooth_features_xd(in_tensor, kernel_size=7):
         return out_tensor.reshape([c1,c2,h,w,t]).permute(4,0,1,2,3)
 
 
+def get_render_batch_size(secc2video_model, device, render_batch_size=0, max_render_batch_size=16):
+    """
+    decide how many frames secc2video renders per forward pass
+    args:
+        secc2video_model: OSAvatarSECC_Img2plane(_Torso)
+        device: str or torch.device
+        render_batch_size: int. >0 means use it directly; 0 means auto
+    return:
+        render_batch_size: int
+    """
+    if render_batch_size > 0:
+        return render_batch_size
+    if torch.device(device).type != 'cpu':
+        return 1 # on GPU the other resident models share the memory, keep rendering frame by frame
+    res = secc2video_model.neural_rendering_resolution
+    rendering_kwargs = secc2video_model.rendering_kwargs
+    num_samples_per_ray = rendering_kwargs['depth_resolution'] + rendering_kwargs['depth_resolution_importance']
+    bytes_per_frame = res * res * num_samples_per_ray * RENDER_BYTES_PER_SAMPLE
+    if rendering_kwargs.get('ray_chunk_memory_mb', 0) > 0:
+        # the chunked rendering bounds the sample activations of a forward pass, whatever the batch size
+        bytes_per_frame = min(bytes_per_frame, rendering_kwargs['ray_chunk_memory_mb'] * 1024 * 1024)
+    try:
+        avail_bytes = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 1
+    # only use half of the available memory for the activations of the renderer
+    return int(max(1, min(max_render_batch_size, avail_bytes * 0.5 // bytes_per_frame)))
+
+
+class InferWorkspace:
+    """
+    Per-request scratch directory, so that concurrent jobs never write to the same temp file.
+    The directory and everything in it are removed on exit, unless keep=True.
+    usage:
+        with InferWorkspace() as workspace:
+            cropped_name = workspace.path('cropped_src_img_512.png')
+    """
+    def __init__(self, root_dir=None, job_id=None, keep=False):
+        self.root_dir = root_dir if root_dir is not None else os.getenv('INFER_WORKSPACE_DIR', 'temp/jobs')
+        self.job_id = job_id if job_id is not None else uuid.uuid4().hex
+        self.work_dir = os.path.join(self.root_dir, self.job_id)
+        self.keep = keep
+
+    def path(self, fname):
+        return os.path.join(self.work_dir, fname)
+
+    def __enter__(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.keep:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return False
+
+
+class RequestLocalState(threading.local):
+    """
+    The per-request attributes of an inference instance (inp, wav16k_name, workspace, ...),
+        stored per thread so that concurrent requests on one instance don't overwrite each other.
+    """
+    pass
+
+
+def request_local_property(name):
+    def getter(self):
+        try:
+            return getattr(self._request_state, name)
+        except AttributeError:
+            raise AttributeError(f"'{type(self).__name__}' has no request-local attribute '{name}', it is only set inside infer_once")
+    def setter(self, value):
+        setattr(self._request_state, name, value)
+    return property(getter, setter)
+
+
 def extract_audio_motion_from_ref_video(video_name):
-    def save_wav16k(audio_name):
-        supported_types = ('.wav', '.mp3', '.mp4', '.avi')
-        assert audio_name.endswith(supported_types), f"Now we only support {','.join(supported_types)} as audio source!"
-        wav16k_name = audio_name[:-4] + '_16k.wav'
-        extract_wav_cmd = f"ffmpeg -i {audio_name} -f wav -ar 16000 -v quiet -y {wav16k_name} -y"
-        os.system(extract_wav_cmd)
-        print(f"Extracted wav file (16khz) from {audio_name} to {wav16k_name}.")
-        return wav16k_name
-    
-    def get_f0( wav16k_name):
-        from data_gen.utils.process_audio.extract_mel_f0 import extract_mel_from_fname, extract_f0_from_wav_and_mel
-        wav, mel = extract_mel_from_fname(wav16k_name)
-        f0, f0_coarse = extract_f0_from_wav_and_mel(wav, mel)
-        f0 = f0.reshape([-1,1])
-        f0 = torch.tensor(f0)
-        return f0
-    
-    def get_hubert(wav16k_name):
-        from data_gen.utils.process_audio.extract_hubert import get_hubert_from_16k_wav
-        hubert = get_hubert_from_16k_wav(wav16k_name).detach().numpy()
-        len_mel = hubert.shape[0]
-        x_multiply = 8
-        if len_mel % x_multiply == 0:
-            num_to_pad = 0
-        else:
-            num_to_pad = x_multiply - len_mel % x_multiply
-        hubert = np.pad(hubert, pad_width=((0,num_to_pad), (0,0)))
-        hubert = torch.tensor(hubert)
-        return hubert
-
-    def get_exp(video_name):
-        from data_gen.utils.process_video.fit_3dmm_landmark import fit_3dmm_for_a_video
-        drv_motion_coeff_dict = fit_3dmm_for_a_video(video_name, save=False)
-        exp = torch.tensor(drv_motion_coeff_dict['exp'])
-        return exp
-    
-    wav16k_name = save_wav16k(video_name)
-    f0 = get_f0(wav16k_name)
-    hubert = get_hubert(wav16k_name)
-    os.system(f"rm {wav16k_name}")
-    exp = get_exp(video_name)
+    """
+    the exp/hubert/f0 of a talking style reference video, served by the RefClipStore after the first use
+    """
+    from inference.ref_clip_store import get_ref_clip_store
+    store = get_ref_clip_store()
+    hubert, f0 = store.get_audio_feats(video_name)
+    exp = store.get_coeff_dict(video_name)['exp']
+
+    len_mel = hubert.shape[0]
+    x_multiply = 8
+    if len_mel % x_multiply == 0:
+        num_to_pad = 0
+    else:
+        num_to_pad = x_multiply - len_mel % x_multiply
+    hubert = np.pad(hubert, pad_width=((0,num_to_pad), (0,0)))
+    hubert = torch.tensor(hubert)
+    f0 = torch.tensor(np.asarray(f0).reshape([-1,1]))
+    exp = torch.tensor(np.asarray(exp))
+
     target_length = min(len(exp), len(hubert)//2, len(f0)//2)
     exp = exp[:target_length]
     f0 = f0[:target_length*2]
@@ -0,0 +1,301 @@
+"""
+Adapter-only checkpoints of the speakers trained by train_mimictalk_on_a_video.
+A full checkpoint holds the frozen base secc2video weights, the LoRA tensors, the optimizer states and the triplane,
+while an adapter checkpoint only holds what differs between the speakers:
+    state_dict['model']: the lora_ tensors, state_dict['learnable_triplane']: the triplane (optionally fp16),
+    person_ds, lora_args, and base_ckpt/base_fingerprint: the base model it was trained against.
+It is saved under the usual model_ckpt_steps_*.ckpt names, so the speaker dirs are laid out as before.
+usage:
+    base_model = load_base_model(hp, lora_args, 'checkpoints/mimictalk_orig/os_secc2plane_torso', device)
+    checkpoint = get_last_checkpoint('checkpoints_mimictalk/German_20s')[0]
+    if is_adapter_checkpoint(checkpoint):
+        check_base_fingerprint(checkpoint, base_ckpt)
+        learnable_triplane = attach_adapter(base_model, checkpoint, device) # base_model now renders the speaker
+serve many speakers with one base model, swapping the adapters per request: see LoRAAdapterCache
+migrate the full checkpoints:
+    python inference/lora_adapter.py --ckpts checkpoints_mimictalk/German_20s --base_ckpt checkpoints/mimictalk_orig/os_secc2plane_torso
+"""
+import os
+import hashlib
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from utils.commons.ckpt_utils import load_ckpt, get_last_checkpoint
+from modules.commons.loralib.layers import LoRALayer
+
+
+ADAPTER_FORMAT_VERSION = 1
+
+_base_fingerprints = {} # (abspath, mtime, size) of the base ckpt => fingerprint
+
+
+def is_adapter_checkpoint(checkpoint):
+    return checkpoint is not None and 'adapter_format' in checkpoint
+
+
+def is_lora_key(key):
+    return 'lora_' in key
+
+
+def state_dict_fingerprint(state_dict):
+    """
+    hash of the names, shapes and values of the base weights, the lora_ tensors and the triplane are excluded
+    """
+    hasher = hashlib.sha1()
+    for k in sorted(state_dict.keys()):
+        if is_lora_key(k) or k == '_last_cano_planes':
+            continue
+        v = state_dict[k].detach().cpu().contiguous()
+        hasher.update(f"{k}:{tuple(v.shape)}:{v.dtype}".encode())
+        hasher.update(v.numpy().tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def get_base_fingerprint(base_ckpt):
+    """
+    base_ckpt: the dir or the .ckpt of the base secc2video model
+    """
+    checkpoint, ckpt_path = get_last_checkpoint(base_ckpt)
+    assert checkpoint is not None, f"| ckpt not found in {base_ckpt}."
+    stat = os.stat(ckpt_path)
+    key = (os.path.abspath(ckpt_path), stat.st_mtime_ns, stat.st_size)
+    if key not in _base_fingerprints:
+        _base_fingerprints[key] = state_dict_fingerprint(checkpoint['state_dict']['model'])
+    return _base_fingerprints[key]
+
+
+def resolve_base_ckpt(checkpoint):
+    # the base is recorded as the path used in training, LORA_BASE_CKPT points to it on another machine
+    return os.getenv('LORA_BASE_CKPT', checkpoint['base_ckpt'])
+
+
+def check_base_fingerprint(checkpoint, base_ckpt):
+    base_fingerprint = get_base_fingerprint(base_ckpt)
+    if checkpoint.get('base_fingerprint') not in (None, base_fingerprint):
+        raise ValueError(f"| The adapter was trained against the base model {checkpoint['base_ckpt']} "
+                         f"(fingerprint {checkpoint['base_fingerprint']}), but {base_ckpt} has fingerprint {base_fingerprint}.")
+
+
+def make_adapter_checkpoint(lora_state_dict, learnable_triplane, person_ds, lora_args, base_ckpt, fp16_triplane=False):
+    learnable_triplane = learnable_triplane.detach().cpu()
+    return {
+        'adapter_format': ADAPTER_FORMAT_VERSION,
+        'state_dict': {
+            'model': {k: v.detach().cpu() for k, v in lora_state_dict.items() if is_lora_key(k)},
+            'learnable_triplane': learnable_triplane.half() if fp16_triplane else learnable_triplane,
+        },
+        'person_ds': person_ds,
+        'lora_args': lora_args,
+        'base_ckpt': base_ckpt,
+        'base_fingerprint': get_base_fingerprint(base_ckpt),
+    }
+
+
+def disable_lora_merging(model):
+    """
+    the loralib layers merge the lora_ deltas into the base weights on eval(), which would make the base speaker-specific,
+    so the shared base keeps them unmerged and adds the deltas on the fly
+    """
+    for m in model.modules():
+        if isinstance(m, LoRALayer):
+            assert not m.merged, "| disable the merging before the first eval()"
+            m.merge_weights = False
+
+
+def load_base_model(hp, lora_args, base_ckpt, device):
+    """
+    build the secc2video model with the LoRA layers of lora_args and load the base weights, to be shared by the adapters
+    """
+    from modules.real3d.secc_img2plane_torso import OSAvatarSECC_Img2plane, OSAvatarSECC_Img2plane_Torso
+    if 'torso' in hp['task_cls'].lower():
+        model = OSAvatarSECC_Img2plane_Torso(hp, lora_args=lora_args)
+    else:
+        model = OSAvatarSECC_Img2plane(hp, lora_args=lora_args)
+    load_ckpt(model, base_ckpt, model_name='model', strict=False)
+    disable_lora_merging(model)
+    model.base_ckpt = base_ckpt
+    model.lora_args = lora_args
+    model.attached_adapter = None
+    return model.to(device).eval()
+
+
+def attach_adapter(model, checkpoint, device, adapter_key=None):
+    """
+    copy the lora_ tensors of an adapter checkpoint into a base model from load_base_model, and set its triplane
+    return: learnable_triplane, nn.Parameter on device
+    """
+    lora_state_dict = checkpoint['state_dict']['model']
+    model_lora_keys = set(k for k in model.state_dict().keys() if is_lora_key(k))
+    missing_keys, unexpected_keys = model_lora_keys - set(lora_state_dict.keys()), set(lora_state_dict.keys()) - model_lora_keys
+    if len(missing_keys) > 0 or len(unexpected_keys) > 0:
+        raise ValueError(f"| The adapter does not match the LoRA layers of the base model, "
+                         f"missing keys: {sorted(missing_keys)[:5]}, unexpected keys: {sorted(unexpected_keys)[:5]}")
+    with torch.no_grad():
+        model.load_state_dict(lora_state_dict, strict=False)
+    learnable_triplane = nn.Parameter(checkpoint['state_dict']['learnable_triplane'].float().to(device), requires_grad=True)
+    model._last_cano_planes = learnable_triplane
+    model.attached_adapter = adapter_key
+    return learnable_triplane
+
+
+def get_lora_layers(model):
+    return [m for m in model.modules() if isinstance(m, LoRALayer) and getattr(m, 'r', 0) > 0]
+
+
+@torch.no_grad()
+def merge_lora_layers(model):
+    """
+    merge the attached lora_ deltas into the weights of the loralib layers, so their forward skips the LoRA branch.
+    the merged weights are new tensors, the base weights are kept aside and restored by unmerge_lora_layers,
+    so that merging and unmerging never drift the shared base.
+    """
+    for m in get_lora_layers(model):
+        if m.merged:
+            continue
+        unmerged_weight = m.weight.data
+        m.weight.data = unmerged_weight.clone()
+        # reuse the merge of loralib (train(False) adds the delta in place, to the clone here)
+        m.merge_weights = True
+        m.train(False)
+        m.merge_weights = False
+        m.unmerged_weight = unmerged_weight
+
+
+@torch.no_grad()
+def unmerge_lora_layers(model):
+    for m in get_lora_layers(model):
+        if m.merged:
+            m.weight.data = m.unmerged_weight
+            del m.unmerged_weight
+            m.merged = False
+
+
+class LoRAAdapterCache:
+    """
+    Serve many speakers with one resident base model from load_base_model.
+    The adapters are kept on the device in an LRU cache, so swapping a speaker in only rebinds the lora_ parameters
+    and the triplane of the base model to its tensors, without any copy.
+    With merge_hot_speaker, the most requested speaker of the recent requests gets its deltas merged into the base
+    weights while it is active (the merged-weights fast path), and the base weights are restored when another one swaps in.
+    usage:
+        adapter_cache = LoRAAdapterCache(base_model, 'cuda', max_adapters=16, merge_hot_speaker=True)
+        entry = adapter_cache.activate(speaker_key, checkpoint) # checkpoint is only needed on a miss
+        learnable_triplane, person_ds = entry['learnable_triplane'], entry['person_ds']
+    """
+    def __init__(self, base_model, device, max_adapters=16, merge_hot_speaker=False, hit_decay=0.9):
+        self.base_model = base_model
+        self.device = device
+        self.max_adapters = max(1, max_adapters)
+        self.merge_hot_speaker = merge_hot_speaker
+        self.hit_decay = hit_decay # the request counts decay, so the hottest speaker follows the recent traffic
+        self.lora_params = {k: p for k, p in base_model.named_parameters() if is_lora_key(k)}
+        self.adapters = OrderedDict() # key => entry, the most recently used at the end
+        self.active_key = None
+        self.merged_key = None
+
+    def serves(self, base_ckpt, lora_args):
+        return self.base_model.base_ckpt == base_ckpt and self.base_model.lora_args == lora_args
+
+    def is_cached(self, key):
+        return key in self.adapters
+
+    def load_adapter(self, checkpoint, **extras):
+        lora_state_dict = checkpoint['state_dict']['model']
+        missing_keys, unexpected_keys = set(self.lora_params.keys()) - set(lora_state_dict.keys()), set(lora_state_dict.keys()) - set(self.lora_params.keys())
+        if len(missing_keys) > 0 or len(unexpected_keys) > 0:
+            raise ValueError(f"| The adapter does not match the LoRA layers of the base model, "
+                             f"missing keys: {sorted(missing_keys)[:5]}, unexpected keys: {sorted(unexpected_keys)[:5]}")
+        for k, v in lora_state_dict.items():
+            if v.shape != self.lora_params[k].shape:
+                raise ValueError(f"| The adapter does not match the LoRA layers of the base model, {k}: {tuple(v.shape)} vs {tuple(self.lora_params[k].shape)}")
+        return {
+            'lora': {k: v.to(self.device, self.lora_params[k].dtype) for k, v in lora_state_dict.items()},
+            'learnable_triplane': nn.Parameter(checkpoint['state_dict']['learnable_triplane'].float().to(self.device), requires_grad=False),
+            'person_ds': checkpoint['person_ds'],
+            'hits': 0.,
+            **extras,
+        }
+
+    @torch.no_grad()
+    def activate(self, key, checkpoint=None, **extras):
+        """
+        swap the adapter of key into the base model, loading it from checkpoint on a miss; extras are kept in its entry
+        return: the entry of the adapter
+        """
+        if key not in self.adapters:
+            assert checkpoint is not None, f"| adapter {key} is not cached, its checkpoint is required."
+            self.adapters[key] = self.load_adapter(checkpoint, **extras)
+            while len(self.adapters) > self.max_adapters:
+                evicted_key, _ = self.adapters.popitem(last=False)
+                print(f"| Evict adapter from cache: {evicted_key}")
+        self.adapters.move_to_end(key)
+        for entry in self.adapters.values():
+            entry['hits'] *= self.hit_decay
+        entry = self.adapters[key]
+        entry['hits'] += 1
+
+        if self.active_key != key:
+            if self.merged_key is not None:
+                unmerge_lora_layers(self.base_model)
+                self.merged_key = None
+            for k, p in self.lora_params.items():
+                p.data = entry['lora'][k]
+            self.base_model._last_cano_planes = entry['learnable_triplane']
+            self.active_key = key
+        if self.merge_hot_speaker and self.merged_key != key and key == self.get_hottest_key():
+            merge_lora_layers(self.base_model)
+            self.merged_key = key
+        return entry
+
+    def get_hottest_key(self):
+        return max(self.adapters.keys(), key=lambda k: self.adapters[k]['hits'])
+
+    def cached_keys(self):
+        return list(self.adapters.keys())
+
+
+def migrate_full_checkpoint(ckpt_path, base_ckpt, fp16_triplane=False, backup=False):
+    """
+    convert a full checkpoint of train_mimictalk_on_a_video into an adapter checkpoint in place
+    backup: keep the full checkpoint as <ckpt_path>.full
+    """
+    checkpoint = torch.load(ckpt_path, map_location='cpu')
+    if is_adapter_checkpoint(checkpoint):
+        print(f"| {ckpt_path} is already an adapter checkpoint, skipping.")
+        return False
+    model_state_dict = checkpoint['state_dict']['model']
+    base_state_dict = get_last_checkpoint(base_ckpt)[0]['state_dict']['model']
+    # the base weights should be frozen in training, report the ones that are not
+    # (a full ckpt saved in eval mode also has the lora_ deltas merged into the weights of the loralib layers)
+    changed_keys = [k for k, v in model_state_dict.items()
+                    if not is_lora_key(k) and k in base_state_dict and (v.shape != base_state_dict[k].shape or not torch.equal(v, base_state_dict[k]))]
+    if len(changed_keys) > 0:
+        print(f"| Warning: {len(changed_keys)} base weights of {ckpt_path} differ from {base_ckpt}, e.g. {changed_keys[:3]}")
+    adapter = make_adapter_checkpoint(model_state_dict, checkpoint['state_dict']['learnable_triplane'], checkpoint['person_ds'],
+                                      checkpoint['lora_args'], base_ckpt, fp16_triplane=fp16_triplane)
+    tmp_path = ckpt_path + ".part"
+    torch.save(adapter, tmp_path, _use_new_zipfile_serialization=False)
+    if backup:
+        os.replace(ckpt_path, ckpt_path + ".full")
+    os.replace(tmp_path, ckpt_path)
+    return True
+
+
+if __name__ == '__main__':
+    import argparse
+    from utils.commons.ckpt_utils import get_all_ckpts
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpts", nargs='+', required=True) # speaker dirs or .ckpt files of full checkpoints
+    parser.add_argument("--base_ckpt", default='checkpoints/mimictalk_orig/os_secc2plane_torso') # the base model they were trained against
+    parser.add_argument("--fp16_triplane", action='store_true')
+    parser.add_argument("--backup", action='store_true') # keep the full checkpoints as <name>.ckpt.full
+    args = parser.parse_args()
+
+    for ckpt in args.ckpts:
+        ckpt_paths = [ckpt] if ckpt.endswith('.ckpt') else get_all_ckpts(ckpt)
+        for ckpt_path in ckpt_paths:
+            size_before = os.path.getsize(ckpt_path)
+            if migrate_full_checkpoint(ckpt_path, args.base_ckpt, fp16_triplane=args.fp16_triplane, backup=args.backup):
+                print(f"| Migrated {ckpt_path}: {size_before / 1024 ** 2:.1f}MB ==> {os.path.getsize(ckpt_path) / 1024 ** 2:.1f}MB")
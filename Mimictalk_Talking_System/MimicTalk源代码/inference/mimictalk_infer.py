@@ -18,6 +18,7 @@ import cv2
 from utils.commons.hparams import hparams, set_hparams
 from utils.commons.tensor_utils import move_to_cuda, convert_to_tensor
 from utils.commons.ckpt_utils import load_ckpt, get_last_checkpoint
+from utils.commons.video_writer import FFmpegVideoWriter, remux_ts_to_mp4
 # 3DMM-related utils
 from deep_3drecon.deep_3drecon_models.bfm import ParametricFaceModel
 from data_util.face3d_helper import Face3DHelper
@@ -32,10 +33,15 @@ from data_gen.utils.process_video.extract_segment_imgs import inpaint_torso_job,
 from inference.infer_utils import mirror_index, load_img_to_512_hwc_array, load_img_to_normalized_512_bchw_tensor
 from inference.infer_utils import smooth_camera_sequence, smooth_features_xd
 from inference.edit_secc import blink_eye_for_secc, hold_eye_opened_for_secc
+from inference.ref_clip_store import get_ref_clip_store
 from inference.real3d_infer import GeneFace2Infer
+from inference.lora_adapter import is_adapter_checkpoint, resolve_base_ckpt, check_base_fingerprint, load_base_model, LoRAAdapterCache
 
 
 class AdaptGeneFace2Infer(GeneFace2Infer):
+    max_cached_adapters = 16 # adapter checkpoints kept on the device, see LoRAAdapterCache
+    merge_hot_speaker = False
+
     def __init__(self, audio2secc_dir, head_model_dir, torso_model_dir, device=None, **kwargs):
         if device is None:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -48,18 +54,20 @@ class AdaptGeneFace2Infer(GeneFace2Infer):
         self.audio2secc_model.to(device).eval()
         self.secc2video_model.to(device).eval()
         self.seg_model = MediapipeSegmenter()
-        self.secc_renderer = SECC_Renderer(512)
+        self.secc_renderer = SECC_Renderer(512, device=device)
         self.face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='lm68')
         self.mp_face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='mediapipe')
         # self.camera_selector = KNearestCameraSelector()
 
-    def load_secc2video(self, head_model_dir, torso_model_dir):
+    def load_secc2video(self, head_model_dir, torso_model_dir, adapter_key=None):
         if torso_model_dir != '':
             config_dir = torso_model_dir if os.path.isdir(torso_model_dir) else os.path.dirname(torso_model_dir)
             set_hparams(f"{config_dir}/config.yaml", print_hparams=False)
             hparams['htbsr_head_threshold'] = 1.0
             self.secc2video_hparams = copy.deepcopy(hparams)
             ckpt = get_last_checkpoint(torso_model_dir)[0]
+            if is_adapter_checkpoint(ckpt):
+                return self.load_secc2video_from_adapter(ckpt, torso_model_dir, adapter_key)
             lora_args = ckpt.get("lora_args", None)
             from modules.real3d.secc_img2plane_torso import OSAvatarSECC_Img2plane_Torso
             model = OSAvatarSECC_Img2plane_Torso(self.secc2video_hparams, lora_args=lora_args)
@@ -75,14 +83,34 @@ class AdaptGeneFace2Infer(GeneFace2Infer):
             ckpt = get_last_checkpoint(head_model_dir)[0]
             lora_args = ckpt.get("lora_args", None)
             self.secc2video_hparams = copy.deepcopy(hparams)
+            if is_adapter_checkpoint(ckpt):
+                return self.load_secc2video_from_adapter(ckpt, head_model_dir, adapter_key)
             model = OSAvatarSECC_Img2plane(self.secc2video_hparams, lora_args=lora_args)
             load_ckpt(model, f"{head_model_dir}", model_name='model', strict=True)
             self.learnable_triplane = nn.Parameter(torch.zeros([1, 3, model.triplane_hid_dim*model.triplane_depth, 256, 256]).float().cuda(), requires_grad=True)
             model._last_cano_planes = self.learnable_triplane
             load_ckpt(model._last_cano_planes, f"{head_model_dir}", model_name='learnable_triplane', strict=True)
         self.person_ds = ckpt['person_ds']
+        self.adapter_checkpoint = None
         return model
 
+    def load_secc2video_from_adapter(self, ckpt, model_dir, adapter_key=None):
+        """
+        swap an adapter checkpoint into the resident base model, which is only built when the base ckpt or the lora_args change
+        """
+        base_ckpt = resolve_base_ckpt(ckpt)
+        check_base_fingerprint(ckpt, base_ckpt)
+        adapter_cache = getattr(self, 'adapter_cache', None)
+        if adapter_cache is None or not adapter_cache.serves(base_ckpt, ckpt['lora_args']):
+            base_model = load_base_model(self.secc2video_hparams, ckpt['lora_args'], base_ckpt, self.device)
+            adapter_cache = self.adapter_cache = LoRAAdapterCache(base_model, self.device, max_adapters=self.max_cached_adapters,
+                                                                  merge_hot_speaker=self.merge_hot_speaker)
+        entry = adapter_cache.activate(adapter_key or model_dir, ckpt, secc2video_hparams=self.secc2video_hparams)
+        self.learnable_triplane = entry['learnable_triplane']
+        self.person_ds = entry['person_ds']
+        self.adapter_checkpoint = ckpt
+        return adapter_cache.base_model
+
     def prepare_batch_from_inp(self, inp):
         """
         :param inp: {'audio_source_name': (str)}
@@ -116,7 +144,7 @@ class AdaptGeneFace2Infer(GeneFace2Infer):
             sample['audio'] = sample['hubert']
             sample['eye_amp'] = torch.ones([1, 1]).cuda() * 1.0
         elif inp['drv_audio_name'][-4:] in ['.mp4']:
-            drv_motion_coeff_dict = fit_3dmm_for_a_video(inp['drv_audio_name'], save=False)
+            drv_motion_coeff_dict = get_ref_clip_store().get_coeff_dict(inp['drv_audio_name'])
             drv_motion_coeff_dict = convert_to_tensor(drv_motion_coeff_dict)
             t_x = drv_motion_coeff_dict['exp'].shape[0] * 2
             self.drv_motion_coeff_dict = drv_motion_coeff_dict
@@ -126,38 +154,9 @@ class AdaptGeneFace2Infer(GeneFace2Infer):
             t_x = drv_motion_coeff_dict['exp'].shape[0] * 2
             self.drv_motion_coeff_dict = drv_motion_coeff_dict
 
-        # Face Parsing
-        sample['ref_gt_img'] = self.person_ds['gt_img'].cuda()
-        img = self.person_ds['gt_img'].reshape([3, 512, 512]).permute(1, 2, 0)
-        img = (img + 1) * 127.5
-        img = np.ascontiguousarray(img.int().numpy()).astype(np.uint8)
-        segmap = self.seg_model._cal_seg_map(img)
-        sample['segmap'] = torch.tensor(segmap).float().unsqueeze(0).cuda()
-        head_img = self.seg_model._seg_out_img_with_segmap(img, segmap, mode='head')[0]
-        sample['ref_head_img'] = ((torch.tensor(head_img) - 127.5)/127.5).float().unsqueeze(0).permute(0, 3, 1,2).cuda() # [b,c,h,w]
-        inpaint_torso_img, _, _, _ = inpaint_torso_job(img, segmap)
-        sample['ref_torso_img'] = ((torch.tensor(inpaint_torso_img) - 127.5)/127.5).float().unsqueeze(0).permute(0, 3, 1,2).cuda() # [b,c,h,w]
-        
-        if inp['bg_image_name'] == '':
-            bg_img = extract_background([img], [segmap], 'knn')
-        else:
-            bg_img = cv2.imread(inp['bg_image_name'])
-            bg_img = cv2.cvtColor(bg_img, cv2.COLOR_BGR2RGB)
-            bg_img = cv2.resize(bg_img, (512,512))
-        sample['bg_img'] = ((torch.tensor(bg_img) - 127.5)/127.5).float().unsqueeze(0).permute(0, 3, 1,2).cuda() # [b,c,h,w]
-
-        # 3DMM, get identity code and camera pose
-        image_name = f"data/raw/val_imgs/{self.person_ds['video_id']}_img.png"
-        os.makedirs(os.path.dirname(image_name), exist_ok=True)
-        cv2.imwrite(image_name, img[:,:,::-1])
-        coeff_dict = fit_3dmm_for_a_image(image_name, save=False)
-        coeff_dict['id'] = self.person_ds['id'].reshape([1,80]).numpy()
-
-        assert coeff_dict is not None
+        ref_sample, coeff_dict = self.prepare_ref_sample(inp)
+        sample.update(ref_sample)
         src_id = torch.tensor(coeff_dict['id']).reshape([1,80]).cuda()
-        src_exp = torch.tensor(coeff_dict['exp']).reshape([1,64]).cuda()
-        src_euler = torch.tensor(coeff_dict['euler']).reshape([1,3]).cuda()
-        src_trans = torch.tensor(coeff_dict['trans']).reshape([1,3]).cuda()
         sample['id'] = src_id.repeat([t_x//2,1])
 
         # get the src_kp for torso model
@@ -184,13 +183,16 @@ class AdaptGeneFace2Infer(GeneFace2Infer):
         print(f"| To extract pose from {inp['drv_pose_name']}")
 
         # extract camera pose 
+        # pose_offset: the first frame in the driving pose sequence, so that consecutive segments of a stream continue the head motion
+        pose_offset = int(inp.get('pose_offset', 0))
         if inp['drv_pose_name'] == 'static':
             sample['euler'] = torch.tensor(coeff_dict['euler']).reshape([1,3]).cuda().repeat([t_x//2,1]) # default static pose
             sample['trans'] = torch.tensor(coeff_dict['trans']).reshape([1,3]).cuda().repeat([t_x//2,1])
+            init_euler, init_trans = sample['euler'][0:1], sample['trans'][0:1]
         else: # from file
             if inp['drv_pose_name'].endswith('.mp4'):
                 # extract coeff from video
-                drv_pose_coeff_dict = fit_3dmm_for_a_video(inp['drv_pose_name'], save=False)
+                drv_pose_coeff_dict = get_ref_clip_store().get_coeff_dict(inp['drv_pose_name'])
             else:
                 # load from npy
                 drv_pose_coeff_dict = np.load(inp['drv_pose_name'], allow_pickle=True).tolist()
@@ -198,18 +200,19 @@ class AdaptGeneFace2Infer(GeneFace2Infer):
             eulers = convert_to_tensor(drv_pose_coeff_dict['euler']).reshape([-1,3]).cuda()
             trans = convert_to_tensor(drv_pose_coeff_dict['trans']).reshape([-1,3]).cuda()
             len_pose = len(eulers)
-            index_lst = [mirror_index(i, len_pose) for i in range(t_x//2)]
+            index_lst = [mirror_index(i + pose_offset, len_pose) for i in range(t_x//2)]
             sample['euler'] = eulers[index_lst]
             sample['trans'] = trans[index_lst]
+            init_euler, init_trans = eulers[0:1], trans[0:1] # the first frame of the whole sequence, shared by all segments
 
         # fix the z axis
-        sample['trans'][:, -1] = sample['trans'][0:1, -1].repeat([sample['trans'].shape[0]])
+        sample['trans'][:, -1] = init_trans[0:1, -1].repeat([sample['trans'].shape[0]])
 
         # mapping to the init pose
         if inp.get("map_to_init_pose", 'False') == 'True':
-            diff_euler = torch.tensor(coeff_dict['euler']).reshape([1,3]).cuda() - sample['euler'][0:1]
+            diff_euler = torch.tensor(coeff_dict['euler']).reshape([1,3]).cuda() - init_euler
             sample['euler'] = sample['euler'] + diff_euler
-            diff_trans = torch.tensor(coeff_dict['trans']).reshape([1,3]).cuda() - sample['trans'][0:1]
+            diff_trans = torch.tensor(coeff_dict['trans']).reshape([1,3]).cuda() - init_trans
             sample['trans'] = sample['trans'] + diff_trans
 
         # prepare camera
@@ -224,117 +227,116 @@ class AdaptGeneFace2Infer(GeneFace2Infer):
 
         return sample
 
+    def prepare_ref_sample(self, inp):
+        """
+        the inputs that only depend on the speaker and the background, shared by all the clips of a speaker
+        return:
+            ref_sample: {'ref_gt_img', 'segmap', 'ref_head_img', 'ref_torso_img', 'bg_img'}
+            coeff_dict: the 3dmm coeffs of the ref image, with the id of the speaker
+        """
+        sample = {}
+        # Face Parsing
+        sample['ref_gt_img'] = self.person_ds['gt_img'].cuda()
+        img = self.person_ds['gt_img'].reshape([3, 512, 512]).permute(1, 2, 0)
+        img = (img + 1) * 127.5
+        img = np.ascontiguousarray(img.int().numpy()).astype(np.uint8)
+        segmap = self.seg_model._cal_seg_map(img)
+        sample['segmap'] = torch.tensor(segmap).float().unsqueeze(0).cuda()
+        head_img = self.seg_model._seg_out_img_with_segmap(img, segmap, mode='head')[0]
+        sample['ref_head_img'] = ((torch.tensor(head_img) - 127.5)/127.5).float().unsqueeze(0).permute(0, 3, 1,2).cuda() # [b,c,h,w]
+        inpaint_torso_img, _, _, _ = inpaint_torso_job(img, segmap)
+        sample['ref_torso_img'] = ((torch.tensor(inpaint_torso_img) - 127.5)/127.5).float().unsqueeze(0).permute(0, 3, 1,2).cuda() # [b,c,h,w]
+        
+        if inp['bg_image_name'] == '':
+            bg_img = extract_background([img], [segmap], 'knn')
+        else:
+            bg_img = cv2.imread(inp['bg_image_name'])
+            bg_img = cv2.cvtColor(bg_img, cv2.COLOR_BGR2RGB)
+            bg_img = cv2.resize(bg_img, (512,512))
+        sample['bg_img'] = ((torch.tensor(bg_img) - 127.5)/127.5).float().unsqueeze(0).permute(0, 3, 1,2).cuda() # [b,c,h,w]
+
+        # 3DMM, get identity code and camera pose
+        image_name = f"data/raw/val_imgs/{self.person_ds['video_id']}_img.png"
+        os.makedirs(os.path.dirname(image_name), exist_ok=True)
+        cv2.imwrite(image_name, img[:,:,::-1])
+        coeff_dict = fit_3dmm_for_a_image(image_name, save=False)
+        coeff_dict['id'] = self.person_ds['id'].reshape([1,80]).numpy()
+        assert coeff_dict is not None
+        return sample, coeff_dict
+
     @torch.no_grad()
     @torch.no_grad()
     def forward_secc2video(self, batch, inp=None):
         num_frames = len(batch['drv_secc'])
-        camera = batch['camera']
-        src_kps = batch['src_kp']
         drv_kps = batch['drv_kp']
-        cano_secc_color = batch['cano_secc']
-        src_secc_color = batch['src_secc']
         drv_secc_colors = batch['drv_secc']
         ref_img_gt = batch['ref_gt_img']
-        ref_img_head = batch['ref_head_img']
-        ref_torso_img = batch['ref_torso_img']
-        bg_img = batch['bg_img']
-        segmap = batch['segmap']
         
         # smooth torso drv_kp
         torso_smo_ksize = 7
         drv_kps = smooth_features_xd(drv_kps.reshape([-1, 68*2]), kernel_size=torso_smo_ksize).reshape([-1, 68, 2])
     
-        # 准备临时输出目录
-        import tempfile
-        import uuid
-        temp_dir = tempfile.mkdtemp()
-        temp_frames_dir = os.path.join(temp_dir, 'frames')
-        os.makedirs(temp_frames_dir, exist_ok=True)
-        
-        # forward renderer - 直接保存到磁盘而不是内存
-        with torch.no_grad():
-            for i in tqdm.trange(num_frames, desc="MimicTalk is rendering frames"):
-                kp_src = torch.cat([src_kps[i:i+1].reshape([1, 68, 2]), torch.zeros([1, 68,1]).to(src_kps.device)],dim=-1)
-                kp_drv = torch.cat([drv_kps[i:i+1].reshape([1, 68, 2]), torch.zeros([1, 68,1]).to(drv_kps.device)],dim=-1)
-                cond={'cond_cano': cano_secc_color,'cond_src': src_secc_color, 'cond_tgt': drv_secc_colors[i:i+1].cuda(),
-                        'ref_torso_img': ref_torso_img, 'bg_img': bg_img, 'segmap': segmap,
-                        'kp_s': kp_src, 'kp_d': kp_drv}
-    
-                gen_output = self.secc2video_model.forward(img=None, camera=camera[i:i+1], cond=cond, ret={}, cache_backbone=False, use_cached_backbone=True)
-                
-                # 立即处理并保存当前帧
-                img = gen_output['image'].cpu()
-                img_raw = gen_output['image_raw'].cpu()
-                depth_img = gen_output['image_depth'].cpu()
-                
-                if inp['out_mode'] == 'concat_debug':
-                    # 处理secc_img
-                    secc_img = torch.nn.functional.interpolate(drv_secc_colors[i:i+1], (512,512)).cpu()
-                    secc_img = ((secc_img + 1) * 127.5).permute(0, 2, 3, 1).int().numpy()
-                    secc_img = secc_img / 127.5 - 1
-                    secc_img = torch.from_numpy(secc_img).permute(0, 3, 1, 2)
-                    
-                    # 处理depth
-                    depth_img = F.interpolate(depth_img, (512,512))
-                    depth_img = depth_img.repeat([1,3,1,1])
-                    depth_img = (depth_img - depth_img.min()) / (depth_img.max() - depth_img.min())
-                    depth_img = depth_img * 2 - 1
-                    depth_img = depth_img.clamp(-1,1)
-                    
-                    # 拼接
-                    frame = torch.cat([
-                        ref_img_gt.cpu(), 
-                        secc_img, 
-                        F.interpolate(img_raw, (512,512)), 
-                        depth_img, 
-                        img
-                    ], dim=-1)
-                else:  # final mode
-                    frame = img
-                
-                # 转换并保存单帧
-                frame = frame.clamp(-1,1)
-                frame = ((frame.permute(0, 2, 3, 1) + 1)/2 * 255).int().numpy().astype(np.uint8)[0]
-                
-                # 保存为临时图片
-                cv2.imwrite(os.path.join(temp_frames_dir, f'frame_{i:06d}.png'), cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
-                
-                # 清理GPU内存
-                del gen_output, img, img_raw, depth_img, frame
-                if inp['out_mode'] == 'concat_debug':
-                    del secc_img
-                torch.cuda.empty_cache()
-        
-        # 使用ffmpeg直接从图片序列生成视频(更节省内存)
-        print("Generating video from frames...")
-        temp_video = os.path.join(temp_dir, f'{uuid.uuid4()}.mp4')
-        
         # 准备输出文件名
         out_fname = 'infer_out/tmp/' + os.path.basename(inp['drv_pose_name'])[:-4] + '.mp4' if inp['out_name'] == '' else inp['out_name']
-        try:
-            os.makedirs(os.path.dirname(out_fname), exist_ok=True)
-        except: 
-            pass
-        
-        # 使用ffmpeg从图片序列生成视频
-        frame_pattern = os.path.join(temp_frames_dir, 'frame_%06d.png')
-        
         if inp['drv_audio_name'][-4:] in ['.wav', '.mp3']:
-            # 有音频
-            cmd = f"ffmpeg -framerate 25 -i {frame_pattern} -i {self.wav16k_name} -y -r 25 -ar 16000 -c:v libx264 -c:a libmp3lame -pix_fmt yuv420p -b:v 2000k -strict experimental -shortest {out_fname}"
+            audio_name = self.wav16k_name
         else:
-            # 先生成临时视频
-            os.system(f"ffmpeg -framerate 25 -i {frame_pattern} -y -c:v libx264 -pix_fmt yuv420p -b:v 2000k {temp_video}")
-            # 尝试添加音频
-            ret = os.system(f"ffmpeg -i {temp_video} -i {inp['drv_audio_name']} -map 0:v -map 1:a -y -c:v copy -shortest {out_fname}")
-            if ret != 0:  # 没有成功提取音频
-                os.system(f"mv {temp_video} {out_fname}")
+            audio_name = inp['drv_audio_name'] # 如果里面没有音频轨道, 则直接输出无音频轨道的纯视频
         
-        os.system(cmd if inp['drv_audio_name'][-4:] in ['.wav', '.mp3'] else '')
-        
-        # 清理临时文件
-        import shutil
-        shutil.rmtree(temp_dir)
+        # 渲染出的帧直接通过管道送进ffmpeg编码, 音频在同一次编码中合入, 不再落盘成PNG
+        # .ts: an MPEG-TS segment of a HLS stream, whose audio has to be AAC
+        audio_codec = 'aac' if out_fname.endswith('.ts') else 'libmp3lame'
+        writer = FFmpegVideoWriter(out_fname, fps=25, audio_name=audio_name, audio_codec=audio_codec, audio_sample_rate=16000, video_bitrate='2000k')
+        with writer, torch.no_grad():
+            for start, end, gen_output in self.render_secc2video_batches(batch, drv_kps, inp, img=None, cache_first_frame=False, desc="MimicTalk is rendering frames"):
+                imgs = gen_output['image'].cpu()
+                imgs_raw = gen_output['image_raw'].cpu()
+                depth_imgs = gen_output['image_depth'].cpu()
+                del gen_output
+                
+                for j, i in enumerate(range(start, end)):
+                    # 立即处理并写入当前帧
+                    img = imgs[j:j+1]
+                    img_raw = imgs_raw[j:j+1]
+                    depth_img = depth_imgs[j:j+1]
+                    
+                    if inp['out_mode'] == 'concat_debug':
+                        # 处理secc_img
+                        secc_img = torch.nn.functional.interpolate(drv_secc_colors[i:i+1], (512,512)).cpu()
+                        secc_img = ((secc_img + 1) * 127.5).permute(0, 2, 3, 1).int().numpy()
+                        secc_img = secc_img / 127.5 - 1
+                        secc_img = torch.from_numpy(secc_img).permute(0, 3, 1, 2)
+                        
+                        # 处理depth
+                        depth_img = F.interpolate(depth_img, (512,512))
+                        depth_img = depth_img.repeat([1,3,1,1])
+                        depth_img = (depth_img - depth_img.min()) / (depth_img.max() - depth_img.min())
+                        depth_img = depth_img * 2 - 1
+                        depth_img = depth_img.clamp(-1,1)
+                        
+                        # 拼接
+                        frame = torch.cat([
+                            ref_img_gt.cpu(), 
+                            secc_img, 
+                            F.interpolate(img_raw, (512,512)), 
+                            depth_img, 
+                            img
+                        ], dim=-1)
+                    else:  # final mode
+                        frame = img
+                    
+                    # 转换并写入单帧
+                    frame = frame.clamp(-1,1)
+                    frame = ((frame.permute(0, 2, 3, 1) + 1)/2 * 255).int().numpy().astype(np.uint8)[0]
+                    writer.write(frame)
+                
+                del imgs, imgs_raw, depth_imgs
+        if out_fname.endswith('.ts'):
+            # 同时封装一份MP4(只换容器不重新编码), 供不支持原生HLS的浏览器逐段播放; 失败时带着ffmpeg的报错抛出
+            remux_ts_to_mp4(out_fname)
+        # 清理GPU内存
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
         
         print(f"Saved at {out_fname}")
         return out_fname
@@ -358,6 +360,9 @@ if __name__ == '__main__':
     parser.add_argument("--hold_eye_opened", default='False') # concat_debug | debug | final 
     parser.add_argument("--map_to_init_pose", default='True') # concat_debug | debug | final 
     parser.add_argument("--seed", default=None, type=int) # random seed, default None to use time.time()
+    parser.add_argument("--render_batch_size", default=0, type=int) # frames per secc2video forward, 0 for auto (CPU: by available memory, GPU: 1)
+    parser.add_argument("--empty_space_skipping", action='store_true') # skip the empty cells and the occluded samples in volume rendering, faster but not bit-exact
+    parser.add_argument("--ray_chunk_memory_mb", default=0, type=int) # render the rays in chunks of about this much activation memory, 0 for no chunking
  
     args = parser.parse_args()
 
@@ -378,5 +383,8 @@ if __name__ == '__main__':
             'map_to_init_pose': args.map_to_init_pose,
             'hold_eye_opened': args.hold_eye_opened,
             'seed': args.seed,
+            'render_batch_size': args.render_batch_size,
+            'empty_space_skipping': args.empty_space_skipping,
+            'ray_chunk_memory_mb': args.ray_chunk_memory_mb,
             }
     AdaptGeneFace2Infer.example_run(inp)
\ No newline at end of file
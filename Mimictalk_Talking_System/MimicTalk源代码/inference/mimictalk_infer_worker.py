@@ -0,0 +1,211 @@
+"""
+常驻推理进程: audio2secc、分割模型、SECC渲染器和Face3DHelper只在启动时加载一次,
+每个说话人的secc2video(LoRA)模型按LRU缓存在内存里, 通过本地HTTP接口服务infer_once请求.
+用法:
+    python inference/mimictalk_infer_worker.py --a2m_ckpt checkpoints/240112_icl_audio2secc_vox2_cmlr --port 8090
+"""
+import os
+import sys
+sys.path.append('./')
+import copy
+import traceback
+from collections import OrderedDict
+
+import torch
+
+from utils.commons.ckpt_utils import get_all_ckpts
+from utils.commons.hparams import hparams
+from data_util.face3d_helper import Face3DHelper
+from deep_3drecon.secc_renderer import SECC_Renderer
+from data_gen.utils.mp_feature_extractors.mp_segmenter import MediapipeSegmenter
+from inference.mimictalk_infer import AdaptGeneFace2Infer
+
+
+# 与 inference/mimictalk_infer.py 命令行参数的默认值保持一致
+DEFAULT_INFER_INP = {
+    'head_ckpt': '',
+    'torso_ckpt': 'checkpoints_mimictalk/German_20s',
+    'bg_image_name': '',
+    'drv_audio_name': 'data/raw/examples/80_vs_60_10s.wav',
+    'drv_pose_name': 'static',
+    'drv_talking_style_name': '',
+    'blink_mode': 'period',
+    'temperature': 0.3,
+    'denoising_steps': 20,
+    'cfg_scale': 1.5,
+    'out_name': '',
+    'out_mode': 'final',
+    'map_to_init_pose': 'True',
+    'hold_eye_opened': 'False',
+    'seed': None,
+    'render_batch_size': 0,
+    'empty_space_skipping': False,
+    'ray_chunk_memory_mb': 0,
+    'pose_offset': 0, # 流式对话中后一段视频接着前一段的头部姿态继续
+}
+
+
+class MimicTalkInferWorker(AdaptGeneFace2Infer):
+    def __init__(self, audio2secc_dir, device=None, max_cached_speakers=2, max_concurrent_jobs=1, max_cached_adapters=16, merge_hot_speaker=False):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = device
+        self.audio2secc_dir = audio2secc_dir
+        self.head_model_dir = ''
+        self.torso_model_dir = ''
+        self.audio2secc_model = self.load_audio2secc(audio2secc_dir)
+        self.audio2secc_model.to(device).eval()
+        self.seg_model = MediapipeSegmenter()
+        self.secc_renderer = SECC_Renderer(512, device=device)
+        self.face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='lm68')
+        self.mp_face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='mediapipe')
+        # speaker_key -> secc2video模型及其附属状态, 最近使用的在末尾
+        self.max_cached_speakers = max(1, max_cached_speakers)
+        self.speaker_cache = OrderedDict()
+        # adapter格式的说话人: 一个常驻的base模型 + 按LRU缓存在显存中的adapter, 见LoRAAdapterCache
+        self.max_cached_adapters = max_cached_adapters
+        self.merge_hot_speaker = merge_hot_speaker
+        self.adapter_cache = None
+        self.secc2video_model = None
+        self.speaker_key = None
+        # (speaker_key, bg_image_name) -> 参考图的人脸分割/背景/3DMM, 流式对话的每一句都复用, 不再重复计算
+        self.max_cached_ref_samples = 8
+        self.ref_sample_cache = OrderedDict()
+        # 每个请求有独立的临时目录和线程局部状态; 模型阶段在model_lock下串行,
+        # 最多max_concurrent_jobs个请求同时在跑, 其余请求的音频特征提取与之重叠
+        self.set_max_concurrent_jobs(max_concurrent_jobs)
+
+    @staticmethod
+    def get_speaker_key(head_model_dir, torso_model_dir):
+        model_dir = torso_model_dir if torso_model_dir != '' else head_model_dir
+        if model_dir.endswith('.ckpt'):
+            ckpt_path = model_dir
+        else:
+            ckpt_paths = get_all_ckpts(model_dir)
+            assert len(ckpt_paths) > 0, f"| ckpt not found in {model_dir}."
+            ckpt_path = ckpt_paths[0]
+        # 带上mtime, 同一目录重新训练后会自动失效
+        return (head_model_dir, torso_model_dir, os.path.abspath(ckpt_path), os.path.getmtime(ckpt_path))
+
+    def activate_speaker(self, head_model_dir, torso_model_dir):
+        key = self.get_speaker_key(head_model_dir, torso_model_dir)
+        adapter_cache = getattr(self, 'adapter_cache', None)
+        if adapter_cache is not None and adapter_cache.is_cached(key):
+            # adapter说话人共享常驻的base模型, 命中时只需换入其lora参数和triplane
+            print(f"| Adapter cache hit: {torso_model_dir or head_model_dir}")
+            entry = adapter_cache.activate(key)
+            entry = dict(entry, secc2video_model=adapter_cache.base_model)
+        elif key in self.speaker_cache:
+            self.speaker_cache.move_to_end(key)
+            print(f"| Speaker cache hit: {torso_model_dir or head_model_dir}")
+            entry = self.speaker_cache[key]
+        else:
+            print(f"| Speaker cache miss, loading: {torso_model_dir or head_model_dir}")
+            model = self.load_secc2video(head_model_dir, torso_model_dir, adapter_key=key)
+            model.to(self.device).eval()
+            entry = {
+                'secc2video_model': model,
+                'learnable_triplane': self.learnable_triplane,
+                'person_ds': self.person_ds,
+                'secc2video_hparams': self.secc2video_hparams,
+            }
+            if self.adapter_checkpoint is None:
+                # 完整checkpoint的说话人各自占一份模型
+                self.speaker_cache[key] = entry
+                while len(self.speaker_cache) > self.max_cached_speakers:
+                    evicted_key, _ = self.speaker_cache.popitem(last=False)
+                    print(f"| Evict speaker from cache: {evicted_key[1] or evicted_key[0]}")
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+        self.secc2video_model = entry['secc2video_model']
+        self.learnable_triplane = entry['learnable_triplane']
+        self.person_ds = entry['person_ds']
+        self.secc2video_hparams = entry['secc2video_hparams']
+        # sr_with_ref、facev2v_warp等模块在forward时读取全局hparams, 命中缓存时也要换回当前说话人的配置
+        hparams.clear()
+        hparams.update(self.secc2video_hparams)
+        self.head_model_dir = head_model_dir
+        self.torso_model_dir = torso_model_dir
+        self.speaker_key = key
+
+    def prepare_ref_sample(self, inp):
+        key = (self.speaker_key, inp['bg_image_name'])
+        if key not in self.ref_sample_cache:
+            self.ref_sample_cache[key] = super().prepare_ref_sample(inp)
+            while len(self.ref_sample_cache) > self.max_cached_ref_samples:
+                self.ref_sample_cache.popitem(last=False)
+        self.ref_sample_cache.move_to_end(key)
+        ref_sample, coeff_dict = self.ref_sample_cache[key]
+        return dict(ref_sample), dict(coeff_dict)
+
+    def infer(self, inp):
+        inp_tmp = copy.deepcopy(DEFAULT_INFER_INP)
+        inp_tmp.update({k: v for k, v in inp.items() if v is not None})
+        inp = inp_tmp
+        if inp['drv_talking_style_name'] == '' and inp['drv_pose_name'].endswith('.mp4'):
+            inp['drv_talking_style_name'] = inp['drv_pose_name']
+        return self.infer_once(inp)
+
+    def prepare_batch_from_inp(self, inp):
+        # 在model_lock内切换说话人模型, 保证同一请求的准备与渲染使用同一个secc2video模型
+        self.activate_speaker(inp['head_ckpt'], inp['torso_ckpt'])
+        return super().prepare_batch_from_inp(inp)
+
+    def cached_speakers(self):
+        keys = list(self.speaker_cache.keys())
+        if getattr(self, 'adapter_cache', None) is not None:
+            keys += self.adapter_cache.cached_keys()
+        return [key[1] or key[0] for key in keys]
+
+
+def build_app(worker):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+    app = FastAPI(title="MimicTalk 常驻推理进程")
+
+    @app.get("/health")
+    def health():
+        return JSONResponse({
+            "code": 0,
+            "msg": "推理进程正常运行",
+            "data": {
+                "a2m_ckpt": worker.audio2secc_dir,
+                "device": str(worker.device),
+                "cached_speakers": worker.cached_speakers(),
+            }
+        })
+
+    @app.post("/infer")
+    async def infer(request: Request):
+        inp = await request.json()
+        # 推理本身是同步阻塞的, 放到线程池里执行, 避免卡住/health
+        from starlette.concurrency import run_in_threadpool
+        try:
+            out_name = await run_in_threadpool(worker.infer, inp)
+            return JSONResponse({"code": 0, "msg": "推理成功", "data": {"out_name": out_name}})
+        except Exception as e:
+            traceback.print_exc()
+            return JSONResponse({"code": -1, "msg": f"推理失败：{str(e)}", "data": None}, status_code=500)
+
+    return app
+
+
+if __name__ == '__main__':
+    import argparse
+    import uvicorn
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--a2m_ckpt", default='checkpoints/240112_icl_audio2secc_vox2_cmlr')
+    parser.add_argument("--host", default='0.0.0.0')
+    parser.add_argument("--port", default=8090, type=int)
+    parser.add_argument("--max_cached_speakers", default=2, type=int) # 常驻显存的说话人模型数量上限
+    parser.add_argument("--max_cached_adapters", default=16, type=int) # 常驻显存的adapter说话人数量上限, 它们共享一个base模型
+    parser.add_argument("--merge_hot_speaker", action='store_true') # 把最常请求的说话人的lora合并进base权重, 跳过lora分支
+    parser.add_argument("--preload_torso_ckpt", default='') # 启动时预先加载的说话人模型
+    parser.add_argument("--max_concurrent_jobs", default=2, type=int) # 同时处理的请求数上限
+    args = parser.parse_args()
+
+    worker = MimicTalkInferWorker(args.a2m_ckpt, max_cached_speakers=args.max_cached_speakers, max_concurrent_jobs=args.max_concurrent_jobs,
+                                  max_cached_adapters=args.max_cached_adapters, merge_hot_speaker=args.merge_hot_speaker)
+    if args.preload_torso_ckpt != '':
+        worker.activate_speaker('', args.preload_torso_ckpt)
+    uvicorn.run(build_app(worker), host=args.host, port=args.port, workers=1)
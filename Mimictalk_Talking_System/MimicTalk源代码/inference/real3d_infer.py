@@ -11,11 +11,14 @@ import tqdm
 import copy
 import cv2
 import math
+import threading
 
 # common utils
 from utils.commons.hparams import hparams, set_hparams
 from utils.commons.tensor_utils import move_to_cuda, convert_to_tensor
 from utils.commons.ckpt_utils import load_ckpt, get_last_checkpoint
+from utils.commons.audio_feat_cache import get_audio_feat_cache, HUBERT_FEAT_CONFIG, F0_FEAT_CONFIG
+from utils.commons.video_writer import FFmpegVideoWriter
 # 3DMM-related utils
 from deep_3drecon.deep_3drecon_models.bfm import ParametricFaceModel
 from data_util.face3d_helper import Face3DHelper
@@ -28,10 +31,14 @@ from data_gen.eg3d.convert_to_eg3d_convention import get_eg3d_convention_camera_
 # Face Parsing 
 from data_gen.utils.mp_feature_extractors.mp_segmenter import MediapipeSegmenter
 from data_gen.utils.process_video.extract_segment_imgs import inpaint_torso_job, extract_background
+# secc2video
+from modules.real3d.super_resolution.sr_with_ref import SRRefSession
 # other inference utils
 from inference.infer_utils import mirror_index, load_img_to_512_hwc_array, load_img_to_normalized_512_bchw_tensor
-from inference.infer_utils import smooth_camera_sequence, smooth_features_xd
+from inference.infer_utils import smooth_camera_sequence, smooth_features_xd, get_render_batch_size
+from inference.infer_utils import InferWorkspace, RequestLocalState, request_local_property
 from inference.edit_secc import blink_eye_for_secc, hold_eye_opened_for_secc
+from inference.ref_clip_store import get_ref_clip_store
 
 
 def read_first_frame_from_a_video(vid_name):
@@ -109,6 +116,22 @@ def crop_img_on_face_area_percent(img_name, out_name='temp/cropped_src_img.png',
 
 
 class GeneFace2Infer:
+    # per-request state lives in thread-local storage, each request also gets its own scratch dir
+    _request_state = RequestLocalState()
+    inp = request_local_property('inp')
+    workspace = request_local_property('workspace')
+    wav16k_name = request_local_property('wav16k_name')
+    wav16k_src_name = request_local_property('wav16k_src_name')
+    drv_motion_coeff_dict = request_local_property('drv_motion_coeff_dict')
+    # the models keep state between calls (icl context, cached backbone), so the model stage of each
+    # request is serialized, while the audio feature extraction of up to max_concurrent_jobs requests overlaps with it
+    model_lock = threading.RLock()
+    job_slots = threading.BoundedSemaphore(1)
+
+    @classmethod
+    def set_max_concurrent_jobs(cls, max_concurrent_jobs):
+        cls.job_slots = threading.BoundedSemaphore(max(1, max_concurrent_jobs))
+
     def __init__(self, audio2secc_dir, head_model_dir, torso_model_dir, device=None, inp=None):
         if device is None:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -117,7 +140,7 @@ class GeneFace2Infer:
         self.audio2secc_model.to(device).eval()
         self.secc2video_model.to(device).eval()
         self.seg_model = MediapipeSegmenter()
-        self.secc_renderer = SECC_Renderer(512)
+        self.secc_renderer = SECC_Renderer(512, device=device)
         self.face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='lm68')
         self.mp_face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='mediapipe')
         self.camera_selector = KNearestCameraSelector()
@@ -178,21 +201,38 @@ class GeneFace2Infer:
         return model
 
     def infer_once(self, inp):
-        self.inp = inp
-        samples = self.prepare_batch_from_inp(inp)
-        seed = inp['seed'] if inp['seed'] is not None else int(time.time())
-        random.seed(seed)
-        torch.manual_seed(seed)
-        np.random.seed(seed)
-        out_name = self.forward_system(samples, inp)
+        with self.job_slots, InferWorkspace() as workspace:
+            self.workspace = workspace
+            self.inp = inp
+            self.prefetch_audio_feats(inp)
+            with self.model_lock:
+                samples = self.prepare_batch_from_inp(inp)
+                seed = inp['seed'] if inp['seed'] is not None else int(time.time())
+                random.seed(seed)
+                torch.manual_seed(seed)
+                np.random.seed(seed)
+                out_name = self.forward_system(samples, inp)
         return out_name
+
+    def prefetch_audio_feats(self, inp):
+        """
+        extract the audio features into the AudioFeatureCache before taking the model lock,
+            so that prepare_batch_from_inp only reads them from the cache
+        """
+        if not get_audio_feat_cache().enabled or inp['drv_audio_name'][-4:] not in ['.wav', '.mp3']:
+            return
+        if self.audio2secc_hparams['audio_type'] != 'hubert': # get_mfcc modifies the global hparams
+            return
+        self.save_wav16k(inp['drv_audio_name'])
+        self.get_hubert(self.wav16k_name)
+        self.get_f0(self.wav16k_name)
     
     def prepare_batch_from_inp(self, inp):
         """
         :param inp: {'audio_source_name': (str)}
         :return: a dict that contains the condition feature of NeRF
         """
-        cropped_name = 'temp/cropped_src_img_512.png'
+        cropped_name = self.workspace.path('cropped_src_img_512.png')
         crop_img_on_face_area_percent(inp['src_image_name'], cropped_name, min_face_area_percent=inp['min_face_area_percent'])
         inp['src_image_name'] = cropped_name
 
@@ -225,7 +265,7 @@ class GeneFace2Infer:
             sample['eye_amp'] = torch.ones([1, 1]).cuda() * 1.0
             sample['mouth_amp'] = torch.ones([1, 1]).cuda() * inp['mouth_amp']
         elif inp['drv_audio_name'][-4:] in ['.mp4']:
-            drv_motion_coeff_dict = fit_3dmm_for_a_video(inp['drv_audio_name'], save=False)
+            drv_motion_coeff_dict = get_ref_clip_store().get_coeff_dict(inp['drv_audio_name'])
             drv_motion_coeff_dict = convert_to_tensor(drv_motion_coeff_dict)
             t_x = drv_motion_coeff_dict['exp'].shape[0] * 2
             self.drv_motion_coeff_dict = drv_motion_coeff_dict
@@ -241,7 +281,7 @@ class GeneFace2Infer:
         image_name = inp['src_image_name']
         if image_name.endswith(".mp4"):
             img = read_first_frame_from_a_video(image_name)
-            image_name = inp['src_image_name'] = image_name[:-4] + '.png'
+            image_name = inp['src_image_name'] = self.workspace.path(os.path.basename(image_name)[:-4] + '.png')
             cv2.imwrite(image_name, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
         sample['ref_gt_img'] = load_img_to_normalized_512_bchw_tensor(image_name).cuda()
         img = load_img_to_512_hwc_array(image_name)
@@ -301,7 +341,7 @@ class GeneFace2Infer:
         else: # from file
             if inp['drv_pose_name'].endswith('.mp4'):
                 # extract coeff from video
-                drv_pose_coeff_dict = fit_3dmm_for_a_video(inp['drv_pose_name'], save=False)
+                drv_pose_coeff_dict = get_ref_clip_store().get_coeff_dict(inp['drv_pose_name'])
             else:
                 # load from npy
                 drv_pose_coeff_dict = np.load(inp['drv_pose_name'], allow_pickle=True).tolist()
@@ -338,7 +378,8 @@ class GeneFace2Infer:
     @torch.no_grad()
     def get_hubert(self, wav16k_name):
         from data_gen.utils.process_audio.extract_hubert import get_hubert_from_16k_wav
-        hubert = get_hubert_from_16k_wav(wav16k_name).detach().numpy()
+        hubert = get_audio_feat_cache().get_or_compute(wav16k_name, 'hubert', HUBERT_FEAT_CONFIG,
+                                                       lambda: get_hubert_from_16k_wav(wav16k_name).detach().numpy())
         len_mel = hubert.shape[0]
         x_multiply = 8
         if len_mel % x_multiply == 0:
@@ -357,16 +398,18 @@ class GeneFace2Infer:
         hparams['fmin'] = 80
         hparams['fmax'] = 12000
         hparams['audio_sample_rate'] = 24000
-        mfcc = librosa_wav2mfcc(wav16k_name,
-            fft_size=hparams['fft_size'],
-            hop_size=hparams['hop_size'],
-            win_length=hparams['win_size'],
-            num_mels=hparams['audio_num_mel_bins'],
-            fmin=hparams['fmin'],
-            fmax=hparams['fmax'],
-            sample_rate=hparams['audio_sample_rate'],
-            center=True)
-        mfcc = np.array(mfcc).reshape([-1, 13])
+        mfcc_config = {k: hparams[k] for k in ['fft_size', 'hop_size', 'win_size', 'audio_num_mel_bins', 'fmin', 'fmax', 'audio_sample_rate']}
+        mfcc = get_audio_feat_cache().get_or_compute(wav16k_name, 'mfcc', mfcc_config,
+            lambda: np.array(librosa_wav2mfcc(wav16k_name,
+                fft_size=hparams['fft_size'],
+                hop_size=hparams['hop_size'],
+                win_length=hparams['win_size'],
+                num_mels=hparams['audio_num_mel_bins'],
+                fmin=hparams['fmin'],
+                fmax=hparams['fmax'],
+                sample_rate=hparams['audio_sample_rate'],
+                center=True)))
+        mfcc = mfcc.reshape([-1, 13])
         len_mel = mfcc.shape[0]
         x_multiply = 8
         if len_mel % x_multiply == 0:
@@ -425,6 +468,8 @@ class GeneFace2Infer:
         zero_eulers = torch.zeros([id.shape[0], 3]).to(id.device)
         zero_trans = torch.zeros([id.shape[0], 3]).to(exp.device)
         # render the secc given the id,exp
+        # the id is constant within a clip unless audio2secc also predicts it, the renderer falls back to the full shape then
+        self.secc_renderer.bind_identity(id[0:1])
         with torch.no_grad():
             chunk_size = 50
             drv_secc_color_lst = []
@@ -436,6 +481,7 @@ class GeneFace2Infer:
         drv_secc_colors = torch.cat(drv_secc_color_lst, dim=0)
         _, src_secc_color = self.secc_renderer(id[0:1], exp[0:1], zero_eulers[0:1], zero_trans[0:1])
         _, cano_secc_color = self.secc_renderer(id[0:1], exp[0:1]*0, zero_eulers[0:1], zero_trans[0:1])
+        self.secc_renderer.unbind_identity()
         batch['drv_secc'] = drv_secc_colors.cuda()
         batch['src_secc'] = src_secc_color.cuda()
         batch['cano_secc'] = cano_secc_color.cuda()
@@ -470,95 +516,115 @@ class GeneFace2Infer:
         return batch
 
     @torch.no_grad()
-    def forward_secc2video(self, batch, inp=None):
+    def render_secc2video_batches(self, batch, drv_kps, inp, img=None, cache_first_frame=False, desc="rendering frames"):
+        """
+        run secc2video on `render_batch_size` frames per forward pass
+        args:
+            batch: the output of forward_audio2secc
+            drv_kps: [T, 68, 2], the smoothed drv_kp
+            img: the ref head img to compute the canonical planes, None to use the cached ones
+            cache_first_frame: compute and cache the canonical planes with the first frame
+        yield:
+            (start, end, gen_output), gen_output contains frames [start, end)
+        """
         num_frames = len(batch['drv_secc'])
         camera = batch['camera']
-        src_kps = batch['src_kp']
+        drv_secc_colors = batch['drv_secc']
+        # the occupancy grid is derived from the canonical planes of the clip, see ImportanceRenderer.forward
+        self.secc2video_model.rendering_kwargs['empty_space_skipping'] = inp.get('empty_space_skipping', False)
+        self.secc2video_model.rendering_kwargs['ray_chunk_memory_mb'] = inp.get('ray_chunk_memory_mb', 0)
+        render_batch_size = get_render_batch_size(self.secc2video_model, camera.device, inp.get('render_batch_size', 0))
+        if render_batch_size > 1:
+            print(f"| Rendering {render_batch_size} frames per forward pass")
+        # the zero z-channel of keypoints is concatenated once for all frames
+        src_kps = batch['src_kp'][:num_frames].reshape([-1, 68, 2])
+        kp_src_all = torch.cat([src_kps, torch.zeros([len(src_kps), 68, 1]).to(src_kps.device)], dim=-1)
+        kp_drv_all = torch.cat([drv_kps[:num_frames].reshape([-1, 68, 2]), torch.zeros([num_frames, 68, 1]).to(drv_kps.device)], dim=-1)
+        # the cano/src secc and torso conditions are shared by all frames, expand them once (views, no copy)
+        shared_cond = {'cond_cano': batch['cano_secc'], 'cond_src': batch['src_secc'],
+                'ref_torso_img': batch['ref_torso_img'], 'bg_img': batch['bg_img'], 'segmap': batch['segmap']}
+        shared_cond = {k: v.expand([render_batch_size] + list(v.shape[1:])) for k, v in shared_cond.items()}
+        # the resized torso/bg imgs and their features are computed on the first frame and reused by the others
+        sr_ref_session = SRRefSession()
+
+        start = 0
+        with tqdm.tqdm(total=num_frames, desc=desc) as pbar:
+            while start < num_frames:
+                cache_backbone = cache_first_frame and start == 0
+                end = start + 1 if cache_backbone else min(start + render_batch_size, num_frames)
+                bs = end - start
+                cond = {k: v[:bs] for k, v in shared_cond.items()}
+                cond.update({'cond_tgt': drv_secc_colors[start:end].to(camera.device),
+                        'kp_s': kp_src_all[start:end], 'kp_d': kp_drv_all[start:end],
+                        'ref_cameras': camera[start:end],
+                        'sr_ref_session': sr_ref_session,
+                        })
+                gen_output = self.secc2video_model.forward(img=img, camera=camera[start:end], cond=cond, ret={}, cache_backbone=cache_backbone, use_cached_backbone=not cache_backbone)
+                yield start, end, gen_output
+                pbar.update(bs)
+                start = end
+
+    @torch.no_grad()
+    def forward_secc2video(self, batch, inp=None):
+        num_frames = len(batch['drv_secc'])
         drv_kps = batch['drv_kp']
-        cano_secc_color = batch['cano_secc']
-        src_secc_color = batch['src_secc']
         drv_secc_colors = batch['drv_secc']
         ref_img_gt = batch['ref_gt_img']
         ref_img_head = batch['ref_head_img']
-        ref_torso_img = batch['ref_torso_img']
-        bg_img = batch['bg_img']
-        segmap = batch['segmap']
         
         # smooth torso drv_kp
         torso_smo_ksize = 7
         drv_kps = smooth_features_xd(drv_kps.reshape([-1, 68*2]), kernel_size=torso_smo_ksize).reshape([-1, 68, 2])
 
+        out_fname = 'infer_out/tmp/' + os.path.basename(inp['src_image_name'])[:-4] + '_' + os.path.basename(inp['drv_pose_name'])[:-4] + '.mp4' if inp['out_name'] == '' else inp['out_name']
+        if inp['drv_audio_name'][-4:] in ['.wav', '.mp3']:
+            audio_name = self.wav16k_name
+        else:
+            audio_name = inp['drv_audio_name'] # 没有成功从drv_audio_name里面提取到音频, 则直接输出无音频轨道的纯视频
+        writer = FFmpegVideoWriter(out_fname, fps=25, audio_name=audio_name)
+
         # forward renderer
+        # in final mode the frames are streamed to the encoder as soon as they are rendered,
+        # concat_debug needs the depth range of the whole clip, so it keeps all frames in memory
         img_raw_lst = []
         img_lst = []
         depth_img_lst = []
-        with torch.no_grad():
-            with torch.cuda.amp.autocast(inp['fp16']):
-                for i in tqdm.trange(num_frames, desc="Real3D-Portrait is rendering frames"):
-                    kp_src = torch.cat([src_kps[i:i+1].reshape([1, 68, 2]), torch.zeros([1, 68,1]).to(src_kps.device)],dim=-1)
-                    kp_drv = torch.cat([drv_kps[i:i+1].reshape([1, 68, 2]), torch.zeros([1, 68,1]).to(drv_kps.device)],dim=-1)
-                    cond={'cond_cano': cano_secc_color,'cond_src': src_secc_color, 'cond_tgt': drv_secc_colors[i:i+1].cuda(),
-                            'ref_torso_img': ref_torso_img, 'bg_img': bg_img, 'segmap': segmap,
-                            'kp_s': kp_src, 'kp_d': kp_drv,
-                            'ref_cameras': camera[i:i+1],
-                            }
-                    if i == 0:
-                        gen_output = self.secc2video_model.forward(img=ref_img_head, camera=camera[i:i+1], cond=cond, ret={}, cache_backbone=True, use_cached_backbone=False)
-                    else:
-                        gen_output = self.secc2video_model.forward(img=ref_img_head, camera=camera[i:i+1], cond=cond, ret={}, cache_backbone=False, use_cached_backbone=True)
-                    img_lst.append(gen_output['image'])
-                    img_raw_lst.append(gen_output['image_raw'])
-                    depth_img_lst.append(gen_output['image_depth'])
-
-        # save demo video
-        depth_imgs = torch.cat(depth_img_lst)
-        imgs = torch.cat(img_lst)
-        imgs_raw = torch.cat(img_raw_lst)
-        secc_img = torch.cat([torch.nn.functional.interpolate(drv_secc_colors[i:i+1], (512,512)) for i in range(num_frames)])
-        
-        if inp['out_mode'] == 'concat_debug':
-            secc_img = secc_img.cpu()
-            secc_img = ((secc_img + 1) * 127.5).permute(0, 2, 3, 1).int().numpy()
-
-            depth_img = F.interpolate(depth_imgs, (512,512)).cpu()
-            depth_img = depth_img.repeat([1,3,1,1])
-            depth_img = (depth_img - depth_img.min()) / (depth_img.max() - depth_img.min())
-            depth_img = depth_img * 2 - 1
-            depth_img = depth_img.clamp(-1,1)
-
-            secc_img = secc_img / 127.5 - 1
-            secc_img = torch.from_numpy(secc_img).permute(0, 3, 1, 2)
-            imgs = torch.cat([ref_img_gt.repeat([imgs.shape[0],1,1,1]).cpu(), secc_img, F.interpolate(imgs_raw, (512,512)).cpu(), depth_img, imgs.cpu()], dim=-1)
-        elif inp['out_mode'] == 'final':
-            imgs = imgs.cpu()
-        elif inp['out_mode'] == 'debug':
-            raise NotImplementedError("to do: save separate videos")
-        imgs = imgs.clamp(-1,1)
-
-        import imageio
-        debug_name = 'demo.mp4'
-        out_imgs = ((imgs.permute(0, 2, 3, 1) + 1)/2 * 255).int().cpu().numpy().astype(np.uint8)
-        writer = imageio.get_writer(debug_name, fps=25, format='FFMPEG', codec='h264')
-        
-        for i in tqdm.trange(len(out_imgs), desc="Imageio is saving video"):
-            writer.append_data(out_imgs[i])
-        writer.close()
-        
-        out_fname = 'infer_out/tmp/' + os.path.basename(inp['src_image_name'])[:-4] + '_' + os.path.basename(inp['drv_pose_name'])[:-4] + '.mp4' if inp['out_name'] == '' else inp['out_name']
-        try:
-            os.makedirs(os.path.dirname(out_fname), exist_ok=True)
-        except: pass
-        if inp['drv_audio_name'][-4:] in ['.wav', '.mp3']:
-            # cmd = f"ffmpeg -i {debug_name} -i {self.wav16k_name} -y -shortest {out_fname}"
-            cmd = f"ffmpeg -i {debug_name} -i {self.wav16k_name} -y -v quiet -shortest {out_fname}"
-            print(cmd)
-            os.system(cmd)
-            os.system(f"rm {debug_name}")
-            os.system(f"rm {self.wav16k_name}")
-        else:
-            ret = os.system(f"ffmpeg -i {debug_name} -i {inp['drv_audio_name']} -map 0:v -map 1:a -y -v quiet -shortest {out_fname}")
-            if ret != 0: # 没有成功从drv_audio_name里面提取到音频, 则直接输出无音频轨道的纯视频
-                os.system(f"mv {debug_name} {out_fname}")
+        with writer:
+            with torch.no_grad():
+                with torch.cuda.amp.autocast(inp['fp16']):
+                    for _, _, gen_output in self.render_secc2video_batches(batch, drv_kps, inp, img=ref_img_head, cache_first_frame=True, desc="Real3D-Portrait is rendering frames"):
+                        if inp['out_mode'] == 'final':
+                            imgs = gen_output['image'].clamp(-1,1)
+                            writer.write_frames(((imgs.permute(0, 2, 3, 1) + 1)/2 * 255).int().cpu().numpy().astype(np.uint8))
+                            continue
+                        img_lst.append(gen_output['image'])
+                        img_raw_lst.append(gen_output['image_raw'])
+                        depth_img_lst.append(gen_output['image_depth'])
+
+            if inp['out_mode'] == 'concat_debug':
+                depth_imgs = torch.cat(depth_img_lst)
+                imgs = torch.cat(img_lst)
+                imgs_raw = torch.cat(img_raw_lst)
+                secc_img = torch.cat([torch.nn.functional.interpolate(drv_secc_colors[i:i+1], (512,512)) for i in range(num_frames)])
+
+                secc_img = secc_img.cpu()
+                secc_img = ((secc_img + 1) * 127.5).permute(0, 2, 3, 1).int().numpy()
+
+                depth_img = F.interpolate(depth_imgs, (512,512)).cpu()
+                depth_img = depth_img.repeat([1,3,1,1])
+                depth_img = (depth_img - depth_img.min()) / (depth_img.max() - depth_img.min())
+                depth_img = depth_img * 2 - 1
+                depth_img = depth_img.clamp(-1,1)
+
+                secc_img = secc_img / 127.5 - 1
+                secc_img = torch.from_numpy(secc_img).permute(0, 3, 1, 2)
+                imgs = torch.cat([ref_img_gt.repeat([imgs.shape[0],1,1,1]).cpu(), secc_img, F.interpolate(imgs_raw, (512,512)).cpu(), depth_img, imgs.cpu()], dim=-1)
+                imgs = imgs.clamp(-1,1)
+                out_imgs = ((imgs.permute(0, 2, 3, 1) + 1)/2 * 255).int().cpu().numpy().astype(np.uint8)
+                writer.write_frames(out_imgs)
+            elif inp['out_mode'] == 'debug':
+                raise NotImplementedError("to do: save separate videos")
+
         print(f"Saved at {out_fname}")
         return out_fname
         
@@ -587,9 +653,11 @@ class GeneFace2Infer:
     def save_wav16k(self, audio_name):
         supported_types = ('.wav', '.mp3', '.mp4', '.avi')
         assert audio_name.endswith(supported_types), f"Now we only support {','.join(supported_types)} as audio source!"
-        import uuid
-        wav16k_name = audio_name[:-4] + f'{uuid.uuid1()}_16k.wav'
+        wav16k_name = self.workspace.path(os.path.basename(audio_name)[:-4] + '_16k.wav')
+        if getattr(self._request_state, 'wav16k_src_name', None) == audio_name and os.path.exists(wav16k_name):
+            return # already extracted for this request, e.g., by prefetch_audio_feats
         self.wav16k_name = wav16k_name
+        self.wav16k_src_name = audio_name
         extract_wav_cmd = f"ffmpeg -i {audio_name} -f wav -ar 16000 -v quiet -y {wav16k_name} -y"
         # extract_wav_cmd = f"ffmpeg -i {audio_name} -f wav -ar 16000 -y {wav16k_name} -y"
         print(extract_wav_cmd)
@@ -598,8 +666,11 @@ class GeneFace2Infer:
 
     def get_f0(self, wav16k_name):
         from data_gen.utils.process_audio.extract_mel_f0 import extract_mel_from_fname, extract_f0_from_wav_and_mel
-        wav, mel = extract_mel_from_fname(self.wav16k_name)
-        f0, f0_coarse = extract_f0_from_wav_and_mel(wav, mel)
+        def compute_f0():
+            wav, mel = extract_mel_from_fname(wav16k_name)
+            f0, f0_coarse = extract_f0_from_wav_and_mel(wav, mel)
+            return f0
+        f0 = get_audio_feat_cache().get_or_compute(wav16k_name, 'f0', F0_FEAT_CONFIG, compute_f0)
         f0 = f0.reshape([-1,1])
         return f0
 
@@ -637,6 +708,9 @@ if __name__ == '__main__':
     parser.add_argument("--map_to_init_pose", default='True') # concat_debug | debug | final 
     parser.add_argument("--seed", default=None, type=int) # random seed, default None to use time.time()
     parser.add_argument("--fp16", action='store_true')
+    parser.add_argument("--render_batch_size", default=0, type=int) # frames per secc2video forward, 0 for auto (CPU: by available memory, GPU: 1)
+    parser.add_argument("--empty_space_skipping", action='store_true') # skip the empty cells and the occluded samples in volume rendering, faster but not bit-exact
+    parser.add_argument("--ray_chunk_memory_mb", default=0, type=int) # render the rays in chunks of about this much activation memory, 0 for no chunking
 
     args = parser.parse_args()
 
@@ -662,6 +736,9 @@ if __name__ == '__main__':
             'cfg_scale': args.cfg_scale,
             'seed': args.seed,
             'fp16': args.fp16, # 目前的ckpt使用fp16会导致nan，发现是因为i2p模型的layernorm产生了单个nan导致的，在训练阶段也采用fp16可能可以解决这个问题
+            'render_batch_size': args.render_batch_size,
+            'empty_space_skipping': args.empty_space_skipping,
+            'ray_chunk_memory_mb': args.ray_chunk_memory_mb,
             }
 
     GeneFace2Infer.example_run(inp)
\ No newline at end of file
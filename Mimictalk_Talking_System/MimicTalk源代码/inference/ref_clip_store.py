@@ -0,0 +1,186 @@
+"""
+Persistent store of the reference clips used as driving pose / talking style.
+For each clip (keyed by the hash of the video file) it keeps the fitted 3DMM coeffs (id/exp/euler/trans)
+    and the hubert/f0 of its audio track, so a clip from the reference library is only processed once.
+usage:
+    store = get_ref_clip_store()
+    coeff_dict = store.get_coeff_dict('data/raw/examples/German_20s.mp4') # {'id', 'exp', 'euler', 'trans'}
+    hubert, f0 = store.get_audio_feats('data/raw/examples/German_20s.mp4')
+pre-index a library of clips:
+    python inference/ref_clip_store.py --videos data/raw/examples/*.mp4
+"""
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.commons.audio_feat_cache import HUBERT_FEAT_CONFIG, F0_FEAT_CONFIG
+
+
+# change it when fit_3dmm_for_a_video changes, the old entries are then ignored
+COEFF_CONFIG = {'fitter': 'fit_3dmm_for_a_video', 'id_mode': 'global', 'keypoint_mode': 'mediapipe'}
+COEFF_NAMES = ('id', 'exp', 'euler', 'trans')
+AUDIO_FEAT_NAMES = ('hubert', 'f0')
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def fit_coeffs_for_ref_video(video_name):
+    from data_gen.utils.process_video.fit_3dmm_landmark import fit_3dmm_for_a_video
+    coeff_dict = fit_3dmm_for_a_video(video_name, save=False)
+    return {k: coeff_dict[k] for k in COEFF_NAMES}
+
+
+def extract_audio_feats_for_ref_video(video_name):
+    from utils.commons.audio_feat_cache import get_audio_feat_cache
+    from data_gen.utils.process_audio.extract_mel_f0 import extract_mel_from_fname, extract_f0_from_wav_and_mel
+    from data_gen.utils.process_audio.extract_hubert import get_hubert_from_16k_wav
+    # unique name, concurrent jobs may use the same reference video
+    wav16k_name = video_name[:-4] + f'_{uuid.uuid4().hex}_16k.wav'
+    os.system(f"ffmpeg -i {video_name} -f wav -ar 16000 -v quiet -y {wav16k_name} -y")
+    print(f"Extracted wav file (16khz) from {video_name} to {wav16k_name}.")
+    try:
+        def compute_f0():
+            wav, mel = extract_mel_from_fname(wav16k_name)
+            f0, f0_coarse = extract_f0_from_wav_and_mel(wav, mel)
+            return f0
+        f0 = get_audio_feat_cache().get_or_compute(wav16k_name, 'f0', F0_FEAT_CONFIG, compute_f0)
+        hubert = get_audio_feat_cache().get_or_compute(wav16k_name, 'hubert', HUBERT_FEAT_CONFIG,
+                                                       lambda: get_hubert_from_16k_wav(wav16k_name).detach().numpy())
+    finally:
+        if os.path.exists(wav16k_name):
+            os.remove(wav16k_name)
+    return {'hubert': np.asarray(hubert), 'f0': np.asarray(f0).reshape([-1, 1])}
+
+
+class RefClipStore:
+    """
+    On-disk store of reference clip features, laid out as <store_dir>/<video hash>/<group>_<config hash>/<name>.npy.
+    The coeffs and the audio feats are two groups computed on first use, so a clip only used as pose never runs hubert.
+    Arrays are loaded memory-mapped (copy-on-write), and the recently used groups are kept in memory,
+        as are the file hashes of the last max_video_hashes videos.
+    """
+    def __init__(self, store_dir, enabled=True, max_cached_groups=32, max_video_hashes=256):
+        self.store_dir = store_dir
+        self.enabled = enabled
+        self.max_cached_groups = max_cached_groups
+        self.max_video_hashes = max_video_hashes
+        self.lock = threading.Lock()
+        self.key_locks = {} # group dir => lock, so concurrent jobs don't process the same clip twice
+        self.cached_groups = OrderedDict() # group dir => {name: array}
+        self.video_hashes = OrderedDict() # (abspath, mtime, size) => hash of the video file
+
+    def hash_video(self, video_name):
+        stat = os.stat(video_name)
+        stat_key = (os.path.abspath(video_name), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if stat_key in self.video_hashes:
+                self.video_hashes.move_to_end(stat_key)
+                return self.video_hashes[stat_key]
+        hasher = hashlib.sha1()
+        with open(video_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        video_hash = hasher.hexdigest()
+        with self.lock:
+            self.video_hashes[stat_key] = video_hash
+            while len(self.video_hashes) > self.max_video_hashes:
+                self.video_hashes.popitem(last=False)
+        return video_hash
+
+    def group_dir(self, video_name, group, config):
+        return os.path.join(self.store_dir, self.hash_video(video_name), f"{group}_{config_hash(config)}")
+
+    def get_coeff_dict(self, video_name):
+        """
+        return: {'id': [T, 80], 'exp': [T, 64], 'euler': [T, 3], 'trans': [T, 3]}, np.ndarray
+        """
+        return self.get_or_compute(video_name, 'coeff', COEFF_CONFIG, COEFF_NAMES, lambda: fit_coeffs_for_ref_video(video_name))
+
+    def get_audio_feats(self, video_name):
+        """
+        return: hubert [T_audio, 1024], f0 [T_audio, 1], np.ndarray
+        """
+        config = {'hubert': HUBERT_FEAT_CONFIG, 'f0': F0_FEAT_CONFIG}
+        feats = self.get_or_compute(video_name, 'audio', config, AUDIO_FEAT_NAMES, lambda: extract_audio_feats_for_ref_video(video_name))
+        return feats['hubert'], feats['f0']
+
+    def get_or_compute(self, video_name, group, config, names, compute_fn):
+        if not self.enabled:
+            return compute_fn()
+        group_dir = self.group_dir(video_name, group, config)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(group_dir, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if group_dir in self.cached_groups:
+                    self.cached_groups.move_to_end(group_dir)
+                    return dict(self.cached_groups[group_dir])
+            arrays = self.load(group_dir, names)
+            if arrays is not None:
+                print(f"| Loaded {group} of reference clip {video_name} from {group_dir}")
+            else:
+                arrays = {k: np.asarray(v) for k, v in compute_fn().items()}
+                self.save(group_dir, arrays)
+            with self.lock:
+                self.cached_groups[group_dir] = arrays
+                while len(self.cached_groups) > self.max_cached_groups:
+                    self.cached_groups.popitem(last=False)
+        return dict(arrays)
+
+    def load(self, group_dir, names):
+        try:
+            return {k: np.load(os.path.join(group_dir, f"{k}.npy"), mmap_mode='c') for k in names}
+        except (ValueError, OSError):
+            return None
+
+    def save(self, group_dir, arrays):
+        # write to a temp dir and rename, so that a concurrent reader never sees a partial group
+        tmp_dir = f"{group_dir}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(tmp_dir)
+            for k, v in arrays.items():
+                np.save(os.path.join(tmp_dir, f"{k}.npy"), v)
+            os.replace(tmp_dir, group_dir)
+        except OSError as e:
+            print(f"| Failed to save reference clip features to {group_dir}: {e}")
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def index_video(self, video_name, audio=True):
+        self.get_coeff_dict(video_name)
+        if audio:
+            self.get_audio_feats(video_name)
+
+
+_ref_clip_store = None
+
+
+def get_ref_clip_store():
+    global _ref_clip_store
+    if _ref_clip_store is None:
+        store_dir = os.getenv('REF_CLIP_STORE_DIR', 'infer_out/.cache/ref_clips')
+        enabled = os.getenv('REF_CLIP_STORE', '1') != '0'
+        _ref_clip_store = RefClipStore(store_dir, enabled=enabled)
+    return _ref_clip_store
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--videos", nargs='+', required=True) # the reference clips to pre-index
+    parser.add_argument("--no_audio", action='store_true') # only fit the 3DMM coeffs, for clips only used as pose
+    args = parser.parse_args()
+
+    store = get_ref_clip_store()
+    for i, video_name in enumerate(args.videos):
+        print(f"| [{i+1}/{len(args.videos)}] Indexing {video_name}")
+        store.index_video(video_name, audio=not args.no_audio)
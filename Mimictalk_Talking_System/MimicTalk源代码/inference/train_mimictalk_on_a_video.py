@@ -36,6 +36,7 @@ from inference.infer_utils import mirror_index, load_img_to_512_hwc_array, load_
 from inference.infer_utils import smooth_camera_sequence, smooth_features_xd
 from inference.edit_secc import blink_eye_for_secc, hold_eye_opened_for_secc
 from modules.commons.loralib.utils import mark_only_lora_as_trainable
+from inference.lora_adapter import make_adapter_checkpoint
 from utils.nn.model_utils import num_params
 import lpips
 from utils.commons.meters import AvgrageMeter
@@ -50,6 +51,7 @@ class LoRATrainer(nn.Module):
         head_model_dir = inp['head_ckpt']
         torso_model_dir = inp['torso_ckpt']
         model_dir = torso_model_dir if torso_model_dir != '' else head_model_dir
+        self.base_model_dir = model_dir
         cmd = f"cp {os.path.join(model_dir, 'config.yaml')} {self.inp['work_dir']}"
         print(cmd)
         os.system(cmd)
@@ -60,7 +62,7 @@ class LoRATrainer(nn.Module):
         self.secc2video_model = self.load_secc2video(model_dir)
         self.secc2video_model.to(device).eval()
         self.seg_model = MediapipeSegmenter()
-        self.secc_renderer = SECC_Renderer(512)
+        self.secc_renderer = SECC_Renderer(512, device=device)
         self.face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='lm68')
         self.mp_face3d_helper = Face3DHelper(use_gpu=True, keypoint_mode='mediapipe')
         # self.camera_selector = KNearestCameraSelector()
@@ -179,6 +181,8 @@ class LoRATrainer(nn.Module):
             'kps': kps,
         }
         self.ds = ds
+        # the drv secc of each training step is rendered with the same id, only the exp changes
+        self.secc_renderer.bind_identity(ds['id'][0:1])
         return ds
     
     def training_loop(self, inp):
@@ -564,6 +568,10 @@ class LoRATrainer(nn.Module):
         return out_img
     
     def dump_checkpoint(self, inp):
+        if inp.get('ckpt_format', 'adapter') == 'adapter':
+            # only the lora_ tensors, the triplane and person_ds, the frozen base weights are loaded from base_model_dir
+            return make_adapter_checkpoint(self.model.state_dict(), self.model.state_dict()['_last_cano_planes'], self.get_person_ds(inp),
+                                           self.lora_args, self.base_model_dir, fp16_triplane=inp.get('fp16_triplane', False))
         checkpoint = {}
         # save optimizers
         optimizer_states = []
@@ -581,6 +589,10 @@ class LoRATrainer(nn.Module):
         del state_dict['model']['_last_cano_planes']
         checkpoint['state_dict'] = state_dict
         checkpoint['lora_args'] = self.lora_args
+        checkpoint['person_ds'] = self.get_person_ds(inp)
+        return checkpoint
+
+    def get_person_ds(self, inp):
         person_ds = {}
         video_id = inp['video_id']
         img_name = f'data/processed/videos/{video_id}/gt_imgs/{format(0, "08d")}.jpg'
@@ -589,8 +601,7 @@ class LoRATrainer(nn.Module):
         person_ds['id'] = self.ds['id'].cpu().reshape([1, 80])
         person_ds['src_kp'] = self.ds['kps'][0].cpu()
         person_ds['video_id'] = inp['video_id']
-        checkpoint['person_ds'] = person_ds
-        return checkpoint
+        return person_ds
 if __name__ == '__main__':
     import argparse, glob, tqdm
     parser = argparse.ArgumentParser()
@@ -606,6 +617,8 @@ if __name__ == '__main__':
     parser.add_argument("--lr_triplane", default=0.005, help="for video, 0.1; for an image, 0.001; for ablation with_triplane, 0.") 
     parser.add_argument("--lora_r", default=2, type=int, help="width of lora unit") 
     parser.add_argument("--lora_mode", default='secc2plane_sr', help='for video, full; for an image, none')
+    parser.add_argument("--ckpt_format", default='adapter', help="adapter: only the lora and the triplane, loaded on top of the base ckpt; full: the whole model and the optimizer states")
+    parser.add_argument("--fp16_triplane", action='store_true', help="store the triplane of the adapter ckpt in fp16")
 
     args = parser.parse_args()
     inp = {
@@ -620,6 +633,8 @@ if __name__ == '__main__':
             'lr_triplane': float(args.lr_triplane),
             'lora_mode': args.lora_mode,
             'lora_r': args.lora_r,
+            'ckpt_format': args.ckpt_format,
+            'fp16_triplane': args.fp16_triplane,
             }
     if inp['work_dir'] == None:
         video_id = os.path.basename(inp['video_id'])[:-4] if inp['video_id'].endswith((".mp4", ".png", ".jpg", ".jpeg")) else inp['video_id']
@@ -0,0 +1,117 @@
+"""
+Occupancy grid over the rendering box, for the empty-space skipping of ImportanceRenderer at inference.
+The candidate cells are derived once per clip from the canonical planes: the cells where the canonical density
+is above the threshold, dilated by a margin that covers the motion of the frames.
+Each frame then only re-evaluates the density at the centers of the candidate cells with its own planes,
+and falls back to the whole grid when its density reaches the border of the candidates.
+"""
+import math
+import torch
+import torch.nn.functional as F
+
+
+def dilate_grid(occ, radius):
+    """
+    occ: [B, R, R, R] bool ==> [B, R, R, R] bool, dilated by a cube of radius cells
+    """
+    if radius <= 0:
+        return occ
+    return F.max_pool3d(occ.float().unsqueeze(1), kernel_size=2*radius+1, stride=1, padding=radius).squeeze(1) > 0
+
+
+class OccupancyGrid:
+    """
+    usage:
+        grid = OccupancyGrid(resolution=64)
+        grid.update_candidates(renderer, cano_planes, decoder, rendering_options) # once per clip, cached on cano_planes
+        occ = grid.get_frame_occupancy(renderer, planes, decoder, rendering_options, dilation=4) # [B, R, R, R]
+        occupied = grid.query(occ, sample_coordinates, rendering_options['box_warp']) # [B, M]
+    """
+    def __init__(self, resolution=64, density_threshold=0.01, candidate_margin=4, chunk_size=1 << 18):
+        self.resolution = resolution
+        self.density_threshold = density_threshold
+        self.candidate_margin = candidate_margin
+        self.chunk_size = chunk_size
+        self.candidates_key = None
+        self.candidates = None # [B_cano, R, R, R] bool
+
+    def cell_centers(self, box_warp, device):
+        R = self.resolution
+        r = ((torch.arange(R, device=device).float() + 0.5) / R - 0.5) * box_warp
+        return torch.stack(torch.meshgrid(r, r, r, indexing='ij'), dim=-1).reshape([-1, 3]) # [R^3, 3]
+
+    def query_density(self, renderer, planes, decoder, coordinates, options):
+        """
+        planes: [1, ...], coordinates: [M, 3] ==> [M], the density as in MipRayMarcher2
+        """
+        options = {**options, 'density_noise': 0}
+        densities = []
+        for i in range(0, len(coordinates), self.chunk_size):
+            coords = coordinates[i: i + self.chunk_size].unsqueeze(0)
+            sigma = renderer.run_model(planes, decoder, coords, torch.zeros_like(coords), options)['sigma']
+            densities.append(F.softplus(sigma.float().reshape([-1]) - 1))
+        return torch.cat(densities)
+
+    def evaluate_cells(self, renderer, planes, decoder, options, cells=None):
+        """
+        cells: [R^3] bool, the cells to evaluate, None for all
+        return: [B, R^3] bool, the occupied cells
+        """
+        R = self.resolution
+        centers = self.cell_centers(options['box_warp'], planes.device)
+        occ = torch.zeros([len(planes), R ** 3], dtype=torch.bool, device=planes.device)
+        for b in range(len(planes)):
+            cell_ids = torch.arange(R ** 3, device=planes.device) if cells is None else torch.nonzero(cells[b], as_tuple=False)[:, 0]
+            if len(cell_ids) > 0:
+                occ[b, cell_ids] = self.query_density(renderer, planes[b:b+1], decoder, centers[cell_ids], options) > self.density_threshold
+        return occ
+
+    @torch.no_grad()
+    def update_candidates(self, renderer, cano_planes, decoder, options):
+        # the cano planes are fixed within a clip, so the candidates are only rebuilt when they change
+        key = (cano_planes.data_ptr(), tuple(cano_planes.shape), cano_planes._version, options['box_warp'])
+        if key == self.candidates_key:
+            return
+        R = self.resolution
+        occ = self.evaluate_cells(renderer, cano_planes, decoder, options).reshape([-1, R, R, R])
+        # an empty canonical density (e.g. multiplicative fusion with the secc planes) gives no border to fall back on
+        self.candidates = dilate_grid(occ, self.candidate_margin) if occ.reshape([len(occ), -1]).any(dim=1).all() else None
+        self.candidates_key = key
+
+    def clear_candidates(self):
+        self.candidates_key = None
+        self.candidates = None
+
+    @torch.no_grad()
+    def get_frame_occupancy(self, renderer, planes, decoder, options, dilation=1):
+        """
+        planes: [B, ...], the planes of the frames
+        dilation: in cells, at least the sample spacing along the rays, since MipRayMarcher2 averages adjacent samples
+        return: [B, R, R, R] bool
+        """
+        R = self.resolution
+        B = len(planes)
+        if self.candidates is None or len(self.candidates) not in (1, B):
+            return dilate_grid(self.evaluate_cells(renderer, planes, decoder, options).reshape([B, R, R, R]), dilation)
+        candidates = self.candidates.expand([B, R, R, R])
+        occ = self.evaluate_cells(renderer, planes, decoder, options, cells=candidates.reshape([B, -1])).reshape([B, R, R, R])
+        # the density may go beyond the candidates when the frame is far from the canonical one, evaluate all cells then
+        candidate_border = candidates & dilate_grid(~candidates, 1)
+        for b in torch.nonzero((occ & candidate_border).reshape([B, -1]).any(dim=1), as_tuple=False)[:, 0].tolist():
+            occ[b] = self.evaluate_cells(renderer, planes[b:b+1], decoder, options).reshape([R, R, R])
+        return dilate_grid(occ, dilation)
+
+    def query(self, occ, coordinates, box_warp):
+        """
+        occ: [B, R, R, R], coordinates: [B, M, 3]
+        return: [B, M] bool, the samples out of the box are treated as occupied
+        """
+        R = self.resolution
+        idx = torch.floor((coordinates / box_warp + 0.5) * R).long()
+        in_box = ((idx >= 0) & (idx < R)).all(dim=-1)
+        idx = idx.clamp(0, R - 1)
+        flat_idx = (idx[..., 0] * R + idx[..., 1]) * R + idx[..., 2]
+        return torch.gather(occ.reshape([len(occ), -1]), 1, flat_idx) | ~in_box
+
+    def get_dilation(self, max_spacing, box_warp):
+        return int(math.ceil(max_spacing * self.resolution / box_warp)) + 1
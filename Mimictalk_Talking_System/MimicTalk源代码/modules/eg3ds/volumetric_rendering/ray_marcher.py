@@ -47,7 +47,8 @@ class MipRayMarcher2(nn.Module):
 
         # clip the composite to min/max range of depths
         composite_depth = torch.nan_to_num(composite_depth, float('inf'))
-        composite_depth = torch.clamp(composite_depth, torch.min(depths), torch.max(depths))
+        if rendering_options.get('clamp_depth', True): # the chunked rendering clamps to the range over all chunks itself
+            composite_depth = torch.clamp(composite_depth, torch.min(depths), torch.max(depths))
 
         if rendering_options.get('white_back', False):
             composite_rgb = composite_rgb + 1 - weight_total # 如果accu_weight为0， 则自动给color设置为0。
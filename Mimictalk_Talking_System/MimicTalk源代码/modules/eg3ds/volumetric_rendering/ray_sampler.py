@@ -19,11 +19,63 @@ class RaySampler(torch.nn.Module):
     def __init__(self):
         super().__init__()
         self.ray_origins_h, self.ray_directions, self.depths, self.image_coords, self.rendering_options = None, None, None, None, None
-
+        self.max_cached_cam_dirs = 8
+        self.cam_dirs_cache = {} # (resolution, device, intrinsics) => [M, 3] camera space ray directions
+        self.last_ray_bundle = None # (resolution, cam2world_matrix, intrinsics, ray_origins, ray_dirs)
 
     def forward(self, cam2world_matrix, intrinsics, resolution):
         """
         Create batches of rays and return origins and directions.
+        The camera space directions are cached per (resolution, intrinsics), so only the rotation and translation
+        of the cameras are applied per frame, and the previous bundle is returned when the cameras are unchanged.
+
+        cam2world_matrix: (N, 4, 4)
+        intrinsics: (N, 3, 3)
+        resolution: int
+
+        ray_origins: (N, M, 3), expanded from the camera locations, don't write in-place
+        ray_dirs: (N, M, 3)
+        """
+        if cam2world_matrix.requires_grad or intrinsics.requires_grad:
+            return self.forward_uncached(cam2world_matrix, intrinsics, resolution)
+        if self.last_ray_bundle is not None:
+            last_resolution, last_cam2world_matrix, last_intrinsics, ray_origins, ray_dirs = self.last_ray_bundle
+            if last_resolution == resolution and torch.equal(last_cam2world_matrix, cam2world_matrix) and torch.equal(last_intrinsics, intrinsics):
+                return ray_origins, ray_dirs
+
+        N, M = cam2world_matrix.shape[0], resolution**2
+        if N > 1 and torch.equal(cam2world_matrix, cam2world_matrix[:1].expand_as(cam2world_matrix)) and torch.equal(intrinsics, intrinsics[:1].expand_as(intrinsics)):
+            # e.g. the static pose, all frames of the batch share one bundle
+            ray_origins, ray_dirs = self.forward(cam2world_matrix[:1], intrinsics[:1], resolution)
+            ray_origins, ray_dirs = ray_origins.expand(N, -1, -1), ray_dirs.expand(N, -1, -1)
+        else:
+            cam_dirs = torch.stack([self.get_cam_dirs(intrinsics[i], resolution) for i in range(N)]) # [N, M, 3]
+            rotation = cam2world_matrix[:, :3, :3]
+            ray_dirs = torch.nn.functional.normalize(torch.bmm(cam_dirs, rotation.transpose(1, 2)), dim=2)
+            ray_origins = cam2world_matrix[:, :3, 3].unsqueeze(1).expand(-1, M, -1)
+        self.last_ray_bundle = (resolution, cam2world_matrix.clone(), intrinsics.clone(), ray_origins, ray_dirs)
+        return ray_origins, ray_dirs
+
+    def get_cam_dirs(self, intrinsics, resolution):
+        """
+        intrinsics: (3, 3) ==> (M, 3), the unnormalized ray directions in camera space, z=1
+        """
+        key = (resolution, str(intrinsics.device), tuple(intrinsics.flatten().tolist()))
+        if key not in self.cam_dirs_cache:
+            if len(self.cam_dirs_cache) >= self.max_cached_cam_dirs:
+                self.cam_dirs_cache.pop(next(iter(self.cam_dirs_cache)))
+            fx, fy, cx, cy, sk = intrinsics[0, 0], intrinsics[1, 1], intrinsics[0, 2], intrinsics[1, 2], intrinsics[0, 1]
+            uv = torch.stack(torch.meshgrid(torch.arange(resolution, dtype=torch.float32, device=intrinsics.device), torch.arange(resolution, dtype=torch.float32, device=intrinsics.device), indexing='ij')) * (1./resolution) + (0.5/resolution)
+            uv = uv.flip(0).reshape(2, -1).transpose(1, 0)
+            x_cam, y_cam = uv[:, 0], uv[:, 1]
+            x_lift = (x_cam - cx + cy*sk/fy - sk*y_cam/fy) / fx
+            y_lift = (y_cam - cy) / fy
+            self.cam_dirs_cache[key] = torch.stack((x_lift, y_lift, torch.ones_like(x_lift)), dim=-1)
+        return self.cam_dirs_cache[key]
+
+    def forward_uncached(self, cam2world_matrix, intrinsics, resolution):
+        """
+        Create batches of rays and return origins and directions.
 
         cam2world_matrix: (N, 4, 4)
         intrinsics: (N, 3, 3)
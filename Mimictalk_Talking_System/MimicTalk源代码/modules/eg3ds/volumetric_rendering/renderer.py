@@ -21,11 +21,15 @@ import torch.nn.functional as F
 from einops import rearrange
 
 from modules.eg3ds.volumetric_rendering.ray_marcher import MipRayMarcher2
+from modules.eg3ds.volumetric_rendering.occupancy_grid import OccupancyGrid
 from modules.eg3ds.volumetric_rendering import math_utils
 from utils.commons.tensor_utils import convert_like
 from utils.commons.hparams import hparams
 import copy
 
+# about 1KB of sampled triplane features and decoder activations per sample point
+RENDER_BYTES_PER_SAMPLE = 1024
+
 
 def generate_planes():
     """
@@ -114,57 +118,151 @@ class ImportanceRenderer(torch.nn.Module):
         self.ray_marcher = MipRayMarcher2()
         self.plane_axes = generate_planes()
         self.triplane_feature_type = hparams.get("triplane_feature_type", "triplane")
+        self.occupancy_grid = OccupancyGrid(resolution=hparams.get("occupancy_grid_resolution", 64),
+                                            density_threshold=hparams.get("occupancy_density_threshold", 0.01))
 
-    def forward(self, planes, decoder, ray_origins, ray_directions, rendering_options):
+    def forward(self, planes, decoder, ray_origins, ray_directions, rendering_options, cano_planes=None):
+        """
+        cano_planes: the canonical planes of the clip, used to derive the occupancy grid of the empty-space skipping.
+            rendering_options['empty_space_skipping'] enables it at inference, the full path is kept as the reference.
+        """
         self.plane_axes = self.plane_axes.to(ray_origins.device)
 
         if rendering_options['ray_start'] == rendering_options['ray_end'] == 'auto':
             ray_start, ray_end = math_utils.get_ray_limits_box(ray_origins, ray_directions, box_side_length=rendering_options['box_warp']) # 根据ndc world bbox的大小（默认-1，1），自动计算near和far
             is_ray_valid = ray_end > ray_start
-            if torch.any(is_ray_valid).item():
-                ray_start[~is_ray_valid] = ray_start[is_ray_valid].min()
-                ray_end[~is_ray_valid] = ray_start[is_ray_valid].max()
+            if self.training:
+                if torch.any(is_ray_valid).item():
+                    ray_start[~is_ray_valid] = ray_start[is_ray_valid].min()
+                    ray_end[~is_ray_valid] = ray_start[is_ray_valid].max()
+            else:
+                # 推理时逐帧填充无效光线的near/far, 使批量渲染与逐帧渲染结果一致
+                for b in range(len(ray_start)):
+                    if torch.any(is_ray_valid[b]).item():
+                        ray_start[b][~is_ray_valid[b]] = ray_start[b][is_ray_valid[b]].min()
+                        ray_end[b][~is_ray_valid[b]] = ray_start[b][is_ray_valid[b]].max()
         else: # 如果bbox没有被限定在-1，1的bbox里面，使用自行设定的near far
             # Create stratified depth samples
             ray_start, ray_end = rendering_options['ray_start'], rendering_options['ray_end']
 
-        depths_coarse = self.sample_stratified(ray_origins, ray_start, ray_end, rendering_options['depth_resolution'], rendering_options['disparity_space_sampling'])
+        N_importance = rendering_options['depth_resolution_importance']
+        coarse_noise, importance_noise = None, None
+        if not self.training:
+            coarse_noise, importance_noise = self.draw_per_sample_noise(ray_origins, rendering_options['depth_resolution'], N_importance)
+        depths_coarse = self.sample_stratified(ray_origins, ray_start, ray_end, rendering_options['depth_resolution'], rendering_options['disparity_space_sampling'], noise=coarse_noise)
         batch_size, num_rays, samples_per_ray, _ = depths_coarse.shape
 
+        skip_empty_space = rendering_options.get('empty_space_skipping', False) and not self.training
+        occupancy = self.get_occupancy(planes, decoder, depths_coarse, rendering_options, cano_planes) if skip_empty_space else None
+
+        ray_chunk_size = self.get_ray_chunk_size(planes, batch_size, samples_per_ray + N_importance, rendering_options)
+        if not self.training and 0 < ray_chunk_size < num_rays:
+            rgb_final, depth_final, weights_sum = self.render_rays_chunked(planes, decoder, ray_origins, ray_directions, depths_coarse, importance_noise, occupancy, ray_chunk_size, rendering_options)
+            return rgb_final, depth_final, weights_sum, is_ray_valid
+
+        rgb_final, depth_final, weights = self.render_rays(planes, decoder, ray_origins, ray_directions, depths_coarse, importance_noise, occupancy, rendering_options)
+        return rgb_final, depth_final, weights.sum(2), is_ray_valid
+
+    def render_rays(self, planes, decoder, ray_origins, ray_directions, depths_coarse, importance_noise, occupancy, rendering_options, merge_sorted=False):
+        """
+        the coarse and fine passes on a bundle of rays
+        occupancy: the occupancy grid of the empty-space skipping, None for the full path
+        merge_sorted: merge the sorted coarse and fine samples, instead of sorting their concatenation
+        """
+        batch_size, num_rays, samples_per_ray, _ = depths_coarse.shape
+        N_importance = rendering_options['depth_resolution_importance']
+        skip_empty_space = occupancy is not None
+
         # Coarse Pass
         sample_coordinates = (ray_origins.unsqueeze(-2) + depths_coarse * ray_directions.unsqueeze(-2)).reshape(batch_size, -1, 3)
         sample_directions = ray_directions.unsqueeze(-2).expand(-1, -1, samples_per_ray, -1).reshape(batch_size, -1, 3)
         
-        out = self.run_model(planes, decoder, sample_coordinates, sample_directions, rendering_options)
+        if skip_empty_space:
+            out = self.run_model_marching(planes, decoder, sample_coordinates, sample_directions, depths_coarse, occupancy, rendering_options)
+        else:
+            out = self.run_model(planes, decoder, sample_coordinates, sample_directions, rendering_options)
         colors_coarse = out['rgb']
         densities_coarse = out['sigma']
         colors_coarse = colors_coarse.reshape(batch_size, num_rays, samples_per_ray, colors_coarse.shape[-1])
         densities_coarse = densities_coarse.reshape(batch_size, num_rays, samples_per_ray, 1)
 
         # Fine Pass
-        N_importance = rendering_options['depth_resolution_importance']
         if N_importance > 0:
             _, _, weights = self.ray_marcher(colors_coarse, densities_coarse, depths_coarse, rendering_options)
 
-            depths_fine = self.sample_importance(depths_coarse, weights, N_importance)
+            depths_fine = self.sample_importance(depths_coarse, weights, N_importance, noise=importance_noise)
             sample_directions = ray_directions.unsqueeze(-2).expand(-1, -1, N_importance, -1).reshape(batch_size, -1, 3)
             sample_coordinates = (ray_origins.unsqueeze(-2) + depths_fine * ray_directions.unsqueeze(-2)).reshape(batch_size, -1, 3)
 
-            out = self.run_model(planes, decoder, sample_coordinates, sample_directions, rendering_options)
+            if skip_empty_space:
+                # skip the fine samples in empty cells or behind the depth where the coarse transmittance vanishes
+                sample_mask = self.occupancy_grid.query(occupancy, sample_coordinates, rendering_options['box_warp'])
+                sample_mask = sample_mask & (depths_fine <= self.get_termination_depth(densities_coarse, depths_coarse, rendering_options)).reshape(batch_size, -1)
+                out = self.run_model_sparse(planes, decoder, sample_coordinates, sample_directions, sample_mask, rendering_options)
+            else:
+                out = self.run_model(planes, decoder, sample_coordinates, sample_directions, rendering_options)
             colors_fine = out['rgb']
             densities_fine = out['sigma']
             colors_fine = colors_fine.reshape(batch_size, num_rays, N_importance, colors_fine.shape[-1])
             densities_fine = densities_fine.reshape(batch_size, num_rays, N_importance, 1)
 
-            all_depths, all_colors, all_densities = self.unify_samples(depths_coarse, colors_coarse, densities_coarse,
+            unify_samples = self.merge_sorted_samples if merge_sorted else self.unify_samples
+            all_depths, all_colors, all_densities = unify_samples(depths_coarse, colors_coarse, densities_coarse,
                                                                   depths_fine, colors_fine, densities_fine)
 
             # Aggregate
             rgb_final, depth_final, weights = self.ray_marcher(all_colors, all_densities, all_depths, rendering_options)
         else:
+            all_depths = depths_coarse
             rgb_final, depth_final, weights = self.ray_marcher(colors_coarse, densities_coarse, depths_coarse, rendering_options)
 
-        return rgb_final, depth_final, weights.sum(2), is_ray_valid
+        if merge_sorted:
+            return rgb_final, depth_final, weights, all_depths
+        return rgb_final, depth_final, weights
+
+    def get_ray_chunk_size(self, planes, batch_size, samples_per_ray, options):
+        """
+        the number of rays per chunk, options['ray_chunk_size'] if given,
+        else sized to options['ray_chunk_memory_mb'] of sample activations; 0 for no chunking
+        """
+        if options.get('ray_chunk_size', 0) > 0:
+            return options['ray_chunk_size']
+        if options.get('ray_chunk_memory_mb', 0) > 0:
+            bytes_per_ray = batch_size * samples_per_ray * RENDER_BYTES_PER_SAMPLE
+            return max(1, int(options['ray_chunk_memory_mb'] * 1024 * 1024 // bytes_per_ray))
+        return 0
+
+    def render_rays_chunked(self, planes, decoder, ray_origins, ray_directions, depths_coarse, importance_noise, occupancy, ray_chunk_size, rendering_options):
+        """
+        render_rays on chunks of ray_chunk_size rays, so that the peak memory of the sample activations is bounded.
+        the ray limits, the noise and the occupancy are drawn for all rays before chunking,
+        and the depth clamp of the ray marcher (the min/max over all samples) is applied after the last chunk,
+        so the outputs are the same as the unchunked path.
+        return:
+            rgb_final: [B, M, C], depth_final: [B, M, 1], weights_sum: [B, M, 1]
+        """
+        batch_size, num_rays, _, _ = depths_coarse.shape
+        N_importance = rendering_options['depth_resolution_importance']
+        chunk_options = {**rendering_options, 'clamp_depth': False}
+        if importance_noise is not None:
+            importance_noise = importance_noise.reshape(batch_size, num_rays, N_importance)
+        rgb_final = depth_final = weights_sum = None
+        depth_min, depth_max = float('inf'), -float('inf')
+        for start in range(0, num_rays, ray_chunk_size):
+            end = min(start + ray_chunk_size, num_rays)
+            chunk_noise = None if importance_noise is None else importance_noise[:, start:end].reshape(-1, N_importance)
+            rgb, depth, weights, all_depths = self.render_rays(planes, decoder, ray_origins[:, start:end], ray_directions[:, start:end],
+                                                    depths_coarse[:, start:end], chunk_noise, occupancy, chunk_options, merge_sorted=True)
+            if rgb_final is None:
+                rgb_final = rgb.new_empty([batch_size, num_rays, rgb.shape[-1]])
+                depth_final = depth.new_empty([batch_size, num_rays, depth.shape[-1]])
+                weights_sum = weights.new_empty([batch_size, num_rays, weights.shape[-1]])
+            rgb_final[:, start:end] = rgb
+            depth_final[:, start:end] = depth
+            weights_sum[:, start:end] = weights.sum(2)
+            depth_min, depth_max = min(depth_min, all_depths.min().item()), max(depth_max, all_depths.max().item())
+        depth_final = torch.clamp(depth_final, depth_min, depth_max)
+        return rgb_final, depth_final, weights_sum
 
     def run_model(self, planes, decoder, sample_coordinates, sample_directions, options):
         hparams = self.hparams
@@ -187,6 +285,88 @@ class ImportanceRenderer(torch.nn.Module):
             out['sigma'] += torch.randn_like(out['sigma']) * options['density_noise']
         return out
 
+    def get_occupancy(self, planes, decoder, depths, options, cano_planes=None):
+        """
+        the occupancy grid of each frame, dilated by the coarse sample spacing along the rays
+        return: [B, R, R, R] bool
+        """
+        if cano_planes is not None:
+            self.occupancy_grid.update_candidates(self, cano_planes, decoder, options)
+        else:
+            self.occupancy_grid.clear_candidates()
+        max_spacing = (depths[:, :, 1:] - depths[:, :, :-1]).max().item()
+        dilation = self.occupancy_grid.get_dilation(max_spacing, options['box_warp'])
+        return self.occupancy_grid.get_frame_occupancy(self, planes, decoder, options, dilation=dilation)
+
+    def run_model_sparse(self, planes, decoder, sample_coordinates, sample_directions, sample_mask, options):
+        """
+        run_model on the samples where sample_mask [B, M] is True,
+        the skipped samples get zero features and the sigma of empty space (options['empty_sigma'])
+        """
+        batch_size, num_samples, _ = sample_coordinates.shape
+        colors, sigmas = None, None
+        for b in range(batch_size):
+            sample_ids = torch.nonzero(sample_mask[b], as_tuple=False)[:, 0]
+            if len(sample_ids) == 0:
+                if colors is not None or b < batch_size - 1:
+                    continue
+                sample_ids = sample_ids.new_zeros([1]) # nothing to evaluate at all, still run one sample to get the output channels
+            plane_idx = min(b, len(planes) - 1)
+            out = self.run_model(planes[plane_idx:plane_idx+1], decoder, sample_coordinates[b:b+1, sample_ids], sample_directions[b:b+1, sample_ids], options)
+            if colors is None:
+                colors = out['rgb'].new_zeros([batch_size, num_samples, out['rgb'].shape[-1]])
+                sigmas = out['sigma'].new_full([batch_size, num_samples, 1], options.get('empty_sigma', -10.))
+            colors[b, sample_ids] = out['rgb'][0]
+            sigmas[b, sample_ids] = out['sigma'][0]
+        return {'rgb': colors, 'sigma': sigmas}
+
+    def run_model_marching(self, planes, decoder, sample_coordinates, sample_directions, depths, occupancy, options):
+        """
+        the coarse pass with empty-space skipping and early ray termination:
+        the samples are evaluated segment by segment along the rays, the samples in empty cells are skipped,
+        and the rays whose transmittance drops below options['early_termination_threshold'] skip the remaining segments.
+        """
+        batch_size, num_rays, samples_per_ray, _ = depths.shape
+        segment_size = options.get('marching_segment_size', 8)
+        threshold = options.get('early_termination_threshold', 1e-3)
+        sample_mask = self.occupancy_grid.query(occupancy, sample_coordinates, options['box_warp']).reshape(batch_size, num_rays, samples_per_ray)
+        sample_coordinates = sample_coordinates.reshape(batch_size, num_rays, samples_per_ray, 3)
+        sample_directions = sample_directions.reshape(batch_size, num_rays, samples_per_ray, 3)
+        is_ray_active = torch.ones([batch_size, num_rays], dtype=torch.bool, device=depths.device)
+        colors_lst, sigmas_lst = [], []
+        for start in range(0, samples_per_ray, segment_size):
+            end = min(start + segment_size, samples_per_ray)
+            segment_mask = sample_mask[:, :, start:end] & is_ray_active.unsqueeze(-1)
+            out = self.run_model_sparse(planes, decoder, sample_coordinates[:, :, start:end].reshape(batch_size, -1, 3),
+                                        sample_directions[:, :, start:end].reshape(batch_size, -1, 3), segment_mask.reshape(batch_size, -1), options)
+            colors_lst.append(out['rgb'].reshape(batch_size, num_rays, end - start, -1))
+            sigmas_lst.append(out['sigma'].reshape(batch_size, num_rays, end - start, 1))
+            if end < samples_per_ray:
+                transmittance = self.cal_transmittance(torch.cat(sigmas_lst, dim=-2), depths[:, :, :end])[:, :, -1, 0]
+                is_ray_active = is_ray_active & (transmittance >= threshold)
+        return {'rgb': torch.cat(colors_lst, dim=-2).reshape(batch_size, num_rays * samples_per_ray, -1),
+                'sigma': torch.cat(sigmas_lst, dim=-2).reshape(batch_size, num_rays * samples_per_ray, 1)}
+
+    def cal_transmittance(self, densities, depths):
+        """
+        the accumulated transmittance after each interval, the same quadrature as MipRayMarcher2 with clamp_mode softplus
+        densities, depths: [B, M, S, 1] ==> [B, M, S-1, 1]
+        """
+        deltas = depths[:, :, 1:] - depths[:, :, :-1]
+        densities_mid = F.softplus((densities[:, :, :-1] + densities[:, :, 1:]).float() / 2 - 1)
+        alpha = 1 - torch.exp(-densities_mid * deltas)
+        return torch.cumprod(1 - alpha + 1e-10, dim=-2)
+
+    def get_termination_depth(self, densities, depths, options):
+        """
+        the depth where the transmittance drops below options['early_termination_threshold'], inf for the rays never terminated
+        return: [B, M, 1, 1]
+        """
+        threshold = options.get('early_termination_threshold', 1e-3)
+        is_terminated = self.cal_transmittance(densities, depths) < threshold
+        termination_depth = torch.where(is_terminated, depths[:, :, 1:], torch.full_like(depths[:, :, 1:], float('inf')))
+        return termination_depth.min(dim=-2, keepdim=True)[0]
+
     def sort_samples(self, all_depths, all_colors, all_densities):
         _, indices = torch.sort(all_depths, dim=-2)
         all_depths = torch.gather(all_depths, -2, indices)
@@ -206,7 +386,41 @@ class ImportanceRenderer(torch.nn.Module):
 
         return all_depths, all_colors, all_densities
 
-    def sample_stratified(self, ray_origins, ray_start, ray_end, depth_resolution, disparity_space_sampling=False):
+    def merge_sorted_samples(self, depths1, colors1, densities1, depths2, colors2, densities2):
+        """
+        unify_samples for the sorted coarse samples: only the fine samples are sorted,
+        then each sample is scattered to its rank in the merge of the two sorted sequences
+        """
+        depths2, colors2, densities2 = self.sort_samples(depths2, colors2, densities2)
+        S1, S2 = depths1.shape[-2], depths2.shape[-2]
+        sorted1, sorted2 = depths1.squeeze(-1).contiguous(), depths2.squeeze(-1).contiguous()
+        # rank = own index + the number of samples of the other sequence before it, the ties go to the first sequence
+        rank1 = torch.arange(S1, device=depths1.device) + torch.searchsorted(sorted2, sorted1, right=False)
+        rank2 = torch.arange(S2, device=depths2.device) + torch.searchsorted(sorted1, sorted2, right=True)
+        indices = torch.cat([rank1, rank2], dim=-1).unsqueeze(-1)
+
+        def merge(x1, x2):
+            x = torch.cat([x1, x2], dim=-2)
+            return torch.empty_like(x).scatter_(-2, indices.expand(-1, -1, -1, x.shape[-1]), x)
+        return merge(depths1, depths2), merge(colors1, colors2), merge(densities1, densities2)
+
+    def draw_per_sample_noise(self, ray_origins, depth_resolution, N_importance):
+        """
+        Draw the stratified jitter and the importance-sampling uniforms frame by frame,
+        in the same order as a sequence of batch_size=1 forwards would consume the RNG,
+        so that rendering N frames in one batch reproduces the per-frame results.
+        """
+        N, M, _ = ray_origins.shape
+        coarse_noise_lst, importance_noise_lst = [], []
+        for _ in range(N):
+            coarse_noise_lst.append(torch.rand([1, M, depth_resolution, 1], device=ray_origins.device))
+            if N_importance > 0:
+                importance_noise_lst.append(torch.rand([M, N_importance], device=ray_origins.device))
+        coarse_noise = torch.cat(coarse_noise_lst, dim=0)
+        importance_noise = torch.cat(importance_noise_lst, dim=0) if N_importance > 0 else None
+        return coarse_noise, importance_noise
+
+    def sample_stratified(self, ray_origins, ray_start, ray_end, depth_resolution, disparity_space_sampling=False, noise=None):
         """
         Return depths of approximately uniformly spaced samples along rays.
         """
@@ -217,21 +431,24 @@ class ImportanceRenderer(torch.nn.Module):
                                     depth_resolution,
                                     device=ray_origins.device).reshape(1, 1, depth_resolution, 1).repeat(N, M, 1, 1)
             depth_delta = 1/(depth_resolution - 1)
-            depths_coarse += torch.rand_like(depths_coarse) * depth_delta
+            noise = torch.rand_like(depths_coarse) if noise is None else noise
+            depths_coarse += noise * depth_delta
             depths_coarse = 1./(1./ray_start * (1. - depths_coarse) + 1./ray_end * depths_coarse)
         else:
             if type(ray_start) == torch.Tensor:
                 depths_coarse = math_utils.linspace(ray_start, ray_end, depth_resolution).permute(1,2,0,3)
                 depth_delta = (ray_end - ray_start) / (depth_resolution - 1)
-                depths_coarse += torch.rand_like(depths_coarse) * depth_delta[..., None]
+                noise = torch.rand_like(depths_coarse) if noise is None else noise
+                depths_coarse += noise * depth_delta[..., None]
             else:
                 depths_coarse = torch.linspace(ray_start, ray_end, depth_resolution, device=ray_origins.device).reshape(1, 1, depth_resolution, 1).repeat(N, M, 1, 1)
                 depth_delta = (ray_end - ray_start)/(depth_resolution - 1)
-                depths_coarse += torch.rand_like(depths_coarse) * depth_delta
+                noise = torch.rand_like(depths_coarse) if noise is None else noise
+                depths_coarse += noise * depth_delta
 
         return depths_coarse
 
-    def sample_importance(self, z_vals, weights, N_importance):
+    def sample_importance(self, z_vals, weights, N_importance, noise=None):
         """
         Return depths of importance sampled points along rays. See NeRF importance sampling for more.
         """
@@ -243,15 +460,15 @@ class ImportanceRenderer(torch.nn.Module):
 
             # smooth weights
             weights = torch.nn.functional.max_pool1d(weights.unsqueeze(1).float(), 2, 1, padding=1)
-            weights = torch.nn.functional.avg_pool1d(weights, 2, 1).squeeze()
+            weights = torch.nn.functional.avg_pool1d(weights, 2, 1).squeeze(1)
             weights = weights + 0.01
 
             z_vals_mid = 0.5 * (z_vals[: ,:-1] + z_vals[: ,1:])
             importance_z_vals = self.sample_pdf(z_vals_mid, weights[:, 1:-1],
-                                             N_importance).detach().reshape(batch_size, num_rays, N_importance, 1)
+                                             N_importance, u=noise).detach().reshape(batch_size, num_rays, N_importance, 1)
         return importance_z_vals
 
-    def sample_pdf(self, bins, weights, N_importance, det=False, eps=1e-5):
+    def sample_pdf(self, bins, weights, N_importance, det=False, eps=1e-5, u=None):
         """
         Sample @N_importance samples from @bins with distribution defined by @weights.
         Inputs:
@@ -260,6 +477,7 @@ class ImportanceRenderer(torch.nn.Module):
             N_importance: the number of samples to draw from the distribution
             det: deterministic or not
             eps: a small number to prevent division by zero
+            u: (N_rays, N_importance) pre-drawn uniforms, used instead of torch.rand when given
         Outputs:
             samples: the sampled samples
         """
@@ -274,7 +492,9 @@ class ImportanceRenderer(torch.nn.Module):
         cdf = torch.cat([torch.zeros_like(cdf[: ,:1]), cdf], -1)  # (N_rays, N_samples_+1)
                                                                    # padded to 0~1 inclusive
 
-        if det:
+        if u is not None:
+            pass
+        elif det:
             u = torch.linspace(0, 1, N_importance, device=bins.device)
             u = u.expand(N_rays, N_importance)
         else:
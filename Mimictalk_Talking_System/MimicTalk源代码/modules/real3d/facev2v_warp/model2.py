@@ -218,10 +218,11 @@ class WarpBasedTorsoModelMediaPipe(nn.Module):
             nn.Sigmoid()
         ])
 
-    #  V2, 先warp， 再mean
-    def forward(self, torso_src_img, segmap, kp_s, kp_d, tgt_head_img, tgt_head_weights, cal_loss=False, target_torso_mask=None):
+    def forward_ref_feats(self, torso_src_img, segmap):
         """
-        kp_s, kp_d, [b, 68, 3], within the range of [-1,1]
+        the features that only depend on the reference torso img and its segmap, i.e., are the same for every frame
+        return:
+            ref_feats: dict of torso_appearance_feats [B, C, D, H, W] and motion_inp_appearance_feats [B, C+2, D, H, W]
         """
         if hparams.get("torso_inp_mode", "rgb") == 'rgb_alpha':
             torso_segmap = torch.nn.functional.interpolate(segmap[:,[2,4]].float(), size=(torso_src_img.shape[-2],torso_src_img.shape[-1]), mode='bilinear', align_corners=False, antialias=False) # see tasks/eg3ds/loss_utils/segment_loss/mp_segmenter.py for the segmap convention
@@ -234,6 +235,18 @@ class WarpBasedTorsoModelMediaPipe(nn.Module):
         if self.hparams.get("mul_torso_mask", True):
             torso_appearance_feats = torso_appearance_feats * torso_mask.unsqueeze(1)
         motion_inp_appearance_feats = torch.cat([torso_appearance_feats, torso_segmap.unsqueeze(2).repeat([1,1,torso_appearance_feats.shape[2],1,1])], dim=1)
+        return {'torso_appearance_feats': torso_appearance_feats, 'motion_inp_appearance_feats': motion_inp_appearance_feats}
+
+    #  V2, 先warp， 再mean
+    def forward(self, torso_src_img, segmap, kp_s, kp_d, tgt_head_img, tgt_head_weights, cal_loss=False, target_torso_mask=None, ref_feats=None):
+        """
+        kp_s, kp_d, [b, 68, 3], within the range of [-1,1]
+        ref_feats: the precomputed output of forward_ref_feats, None to compute it from torso_src_img and segmap
+        """
+        if ref_feats is None:
+            ref_feats = self.forward_ref_feats(torso_src_img, segmap)
+        torso_appearance_feats = ref_feats['torso_appearance_feats']
+        motion_inp_appearance_feats = ref_feats['motion_inp_appearance_feats']
 
         if self.hparams['torso_kp_num'] == 4:
             kp_s = kp_s[:,[0,8,16,27],:]
@@ -117,7 +117,7 @@ class OSAvatarSECC_Img2plane(OSAvatar_Img2plane):
             self._last_cano_planes = cano_planes
 
         # Perform volume rendering
-        feature_samples, depth_samples, weights_samples, is_ray_valid = self.renderer(planes, self.decoder, ray_origins, ray_directions, self.rendering_kwargs) # channels last
+        feature_samples, depth_samples, weights_samples, is_ray_valid = self.renderer(planes, self.decoder, ray_origins, ray_directions, self.rendering_kwargs, cano_planes=cano_planes) # channels last
 
         # Reshape into 'raw' neural-rendered image
         H = W = self.neural_rendering_resolution
@@ -130,7 +130,12 @@ class OSAvatarSECC_Img2plane(OSAvatar_Img2plane):
             feature_image[~is_ray_valid_mask.repeat([1,feature_image.shape[1],1,1])] = -1
             # feature_image[~is_ray_valid_mask.repeat([1,feature_image.shape[1],1,1])] *= 0
             # feature_image[~is_ray_valid_mask.repeat([1,feature_image.shape[1],1,1])] -= 1
-            depth_image[~is_ray_valid_mask] = depth_image[is_ray_valid_mask].min().item()
+            if self.training:
+                depth_image[~is_ray_valid_mask] = depth_image[is_ray_valid_mask].min().item()
+            else:
+                # 推理时逐帧填充, 使批量渲染与逐帧渲染结果一致
+                for b in range(N):
+                    depth_image[b][~is_ray_valid_mask[b]] = depth_image[b][is_ray_valid_mask[b]].min().item()
 
         # Run superresolution to get final image
         rgb_image = feature_image[:, :3]
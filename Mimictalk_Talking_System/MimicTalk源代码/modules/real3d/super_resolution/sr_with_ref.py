@@ -13,6 +13,53 @@ from utils.commons.hparams import hparams
 from utils.commons.image_utils import dilate, erode
 
 
+class SRRefSession:
+    """
+    Caches the per speaker/background invariants of SuperresolutionHybrid8XDC_Warp for one clip:
+        the 256px ref_torso_rgb/ref_bg_rgb, bg_encoder(ref_bg_rgb_256) and the torso appearance features.
+    They are computed on the first frame and reused by all following frames; the session is invalidated
+        when another ref_torso_rgb/ref_bg_rgb/segmap tensor is passed in, or one of them is modified in place.
+    Only used in inference, the training path always recomputes them.
+    usage:
+        sr_ref_session = SRRefSession()
+        for ...: model.forward(..., cond={..., 'sr_ref_session': sr_ref_session})
+    """
+    def __init__(self):
+        self.ref_inputs = None # hold the ref tensors, so their storage can't be reused by other tensors
+        self.ref_keys = None
+        self.ref_feats = None
+
+    @staticmethod
+    def is_shared_by_batch(tensor):
+        # every sample in the batch is the same ref img, e.g., a [1, ...] tensor expanded to [B, ...]
+        return tensor.shape[0] == 1 or tensor.stride(0) == 0
+
+    @staticmethod
+    def tensor_key(tensor):
+        return (tensor.data_ptr(), tuple(tensor.shape[1:]), tuple(tensor.stride()[1:]), tensor.dtype, tensor.device, tensor._version)
+
+    def get(self, sr_model, ref_torso_rgb, ref_bg_rgb, segmap):
+        """
+        return the invariants expanded to the batch size of ref_torso_rgb, None if they can't be shared by the batch
+        """
+        ref_inputs = (ref_torso_rgb, ref_bg_rgb, segmap)
+        if not all(self.is_shared_by_batch(t) for t in ref_inputs):
+            return None
+        ref_keys = (id(sr_model),) + tuple(self.tensor_key(t) for t in ref_inputs)
+        if ref_keys != self.ref_keys:
+            self.ref_feats = sr_model.forward_ref_feats(ref_torso_rgb[:1], ref_bg_rgb[:1], segmap[:1])
+            self.ref_inputs = ref_inputs
+            self.ref_keys = ref_keys
+        bs = ref_torso_rgb.shape[0]
+        return {k: self._expand(v, bs) for k, v in self.ref_feats.items()}
+
+    @classmethod
+    def _expand(cls, v, bs):
+        if isinstance(v, dict):
+            return {k: cls._expand(v_, bs) for k, v_ in v.items()}
+        return v.expand([bs] + list(v.shape[1:]))
+
+
 class SuperresolutionHybrid8XDC_Warp(SuperresolutionHybrid8XDC):
     def __init__(self, channels, img_resolution, sr_num_fp16_res, sr_antialias, **block_kwargs):
         super().__init__(channels, img_resolution, sr_num_fp16_res, sr_antialias, **block_kwargs)
@@ -64,7 +111,20 @@ class SuperresolutionHybrid8XDC_Warp(SuperresolutionHybrid8XDC):
             nn.Conv2d(256, 256, 3, 1, padding=1),
         ])
 
-    def forward(self, rgb, x, ws, ref_torso_rgb, ref_bg_rgb, weights_img, segmap, kp_s, kp_d, target_torso_mask=None, **block_kwargs):
+    def forward_ref_feats(self, ref_torso_rgb, ref_bg_rgb, segmap):
+        """
+        the part of forward that only depends on the ref torso/bg img, it is the same for every frame of a clip
+        """
+        ref_torso_rgb_256 = torch.nn.functional.interpolate(ref_torso_rgb, size=(256, 256), mode='bilinear', align_corners=False, antialias=self.sr_antialias)
+        ref_bg_rgb_256 = torch.nn.functional.interpolate(ref_bg_rgb, size=(256, 256), mode='bilinear', align_corners=False, antialias=self.sr_antialias)
+        x_bg = self.bg_encoder(ref_bg_rgb_256)
+        torso_ref_feats = self.torso_model.forward_ref_feats(ref_torso_rgb_256, segmap)
+        return {'ref_torso_rgb_256': ref_torso_rgb_256, 'ref_bg_rgb_256': ref_bg_rgb_256, 'x_bg': x_bg, 'torso_ref_feats': torso_ref_feats}
+
+    def forward(self, rgb, x, ws, ref_torso_rgb, ref_bg_rgb, weights_img, segmap, kp_s, kp_d, target_torso_mask=None, ref_session=None, **block_kwargs):
+        """
+        ref_session: SRRefSession, reuse the ref torso/bg features computed on the previous frames, only works in inference
+        """
         weights_img = weights_img.detach()
         ws = ws[:, -1:, :].expand([rgb.shape[0], 3, -1])
         
@@ -77,17 +137,21 @@ class SuperresolutionHybrid8XDC_Warp(SuperresolutionHybrid8XDC):
         rgb_256 = torch.nn.functional.interpolate(rgb, size=(256, 256), mode='bilinear', align_corners=False, antialias=self.sr_antialias)
         weights_256 = torch.nn.functional.interpolate(weights_img, size=(256, 256), mode='bilinear', align_corners=False, antialias=self.sr_antialias)
         
-        ref_torso_rgb_256 = torch.nn.functional.interpolate(ref_torso_rgb, size=(256, 256), mode='bilinear', align_corners=False, antialias=self.sr_antialias)
-        
-        ref_bg_rgb_256 = torch.nn.functional.interpolate(ref_bg_rgb, size=(256, 256), mode='bilinear', align_corners=False, antialias=self.sr_antialias)
+        ref_feats = None
+        if ref_session is not None and not self.training:
+            ref_feats = ref_session.get(self, ref_torso_rgb, ref_bg_rgb, segmap)
+        if ref_feats is None:
+            ref_feats = self.forward_ref_feats(ref_torso_rgb, ref_bg_rgb, segmap)
+        ref_torso_rgb_256 = ref_feats['ref_torso_rgb_256']
+        ref_bg_rgb_256 = ref_feats['ref_bg_rgb_256']
         x, rgb = self.block0(x, rgb, ws, **block_kwargs) # sr branch, 128x128 head img ==> 256x256 head img
         if hparams.get("torso_model_version", "v1") == 'v1':
-            rgb_torso, facev2v_ret = self.torso_model.forward(ref_torso_rgb_256, segmap, kp_s, kp_d, rgb_256.detach(), cal_loss=True, target_torso_mask=target_torso_mask)
+            rgb_torso, facev2v_ret = self.torso_model.forward(ref_torso_rgb_256, segmap, kp_s, kp_d, rgb_256.detach(), cal_loss=True, target_torso_mask=target_torso_mask, ref_feats=ref_feats['torso_ref_feats'])
         elif hparams.get("torso_model_version", "v1") == 'v2':
-            rgb_torso, facev2v_ret = self.torso_model.forward(ref_torso_rgb_256, segmap, kp_s, kp_d, rgb_256.detach(), weights_256.detach(), cal_loss=True, target_torso_mask=target_torso_mask)
+            rgb_torso, facev2v_ret = self.torso_model.forward(ref_torso_rgb_256, segmap, kp_s, kp_d, rgb_256.detach(), weights_256.detach(), cal_loss=True, target_torso_mask=target_torso_mask, ref_feats=ref_feats['torso_ref_feats'])
         x_torso = self.torso_encoder(facev2v_ret['deformed_torso_hid'])
 
-        x_bg = self.bg_encoder(ref_bg_rgb_256)
+        x_bg = ref_feats['x_bg']
         
         if hparams.get("weight_fuse", True):
             if hparams['htbsr_head_weight_fuse_mode'] == 'v1':
@@ -139,9 +203,13 @@ class SuperresolutionHybrid8XDC_Warp(SuperresolutionHybrid8XDC):
                 head_occlusion = head_torso_alpha.clone()    
                 htbsr_head_threshold = hparams['htbsr_head_threshold']
                 if not self.training:
-                    head_occlusion_ = head_occlusion[head_occlusion>0.05]
-                    htbsr_head_threshold = max(head_occlusion_.quantile(0.05), htbsr_head_threshold) # 过滤掉比0.05大的最后5% voxels
-                head_occlusion[head_occlusion > htbsr_head_threshold] = 1.
+                    # 逐帧计算阈值, 使批量渲染与逐帧渲染结果一致
+                    for b in range(len(head_occlusion)):
+                        head_occlusion_ = head_occlusion[b][head_occlusion[b]>0.05]
+                        htbsr_head_threshold_b = max(head_occlusion_.quantile(0.05), htbsr_head_threshold) # 过滤掉比0.05大的最后5% voxels
+                        head_occlusion[b][head_occlusion[b] > htbsr_head_threshold_b] = 1.
+                else:
+                    head_occlusion[head_occlusion > htbsr_head_threshold] = 1.
                 torso_occlusion = torch.nn.functional.interpolate(facev2v_ret['occlusion_2'], size=(256, 256), mode='bilinear', align_corners=False, antialias=self.sr_antialias)
                 person_occlusion = (torso_occlusion + head_occlusion).clamp_(0,1)
                 rgb = rgb * person_occlusion + ref_bg_rgb_256 * (1-person_occlusion) # run6
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# run the tests from any directory, the modules are imported relative to the repo root like the inference scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+sf = pytest.importorskip("soundfile")
+
+from utils.commons.audio_feat_cache import AudioFeatureCache
+
+
+def write_wav(path, seed, subtype='PCM_16'):
+    wav = np.random.RandomState(seed).uniform(-0.5, 0.5, 1600).astype(np.float32)
+    sf.write(str(path), wav, 16000, subtype=subtype)
+    return str(path)
+
+
+def test_same_samples_share_features(tmp_path):
+    cache = AudioFeatureCache(str(tmp_path / 'cache'))
+    calls = []
+    def compute():
+        calls.append(1)
+        return np.arange(6, dtype=np.float32).reshape(3, 2)
+    wav_a = write_wav(tmp_path / 'a.wav', 0)
+    wav_b = write_wav(tmp_path / 'b.wav', 0) # another temp name of the same audio
+    feat_a = cache.get_or_compute(wav_a, 'f0', {'hop_size': 320}, compute)
+    feat_b = cache.get_or_compute(wav_b, 'f0', {'hop_size': 320}, compute)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(feat_a, feat_b)
+    # another config or another audio is computed again
+    cache.get_or_compute(wav_a, 'f0', {'hop_size': 160}, compute)
+    cache.get_or_compute(write_wav(tmp_path / 'c.wav', 1), 'f0', {'hop_size': 320}, compute)
+    assert len(calls) == 3
+
+
+def test_rewritten_wav_is_rehashed(tmp_path):
+    cache = AudioFeatureCache(str(tmp_path / 'cache'))
+    wav_name = write_wav(tmp_path / 'a.wav', 0)
+    old_hash = cache.hash_wav(wav_name)
+    write_wav(tmp_path / 'a.wav', 1, subtype='FLOAT') # different size, so the stat key changes
+    assert cache.hash_wav(wav_name) != old_hash
+
+
+def test_wav_hashes_are_bounded(tmp_path):
+    cache = AudioFeatureCache(str(tmp_path / 'cache'), max_wav_hashes=3)
+    wav_names = [write_wav(tmp_path / f'{i}.wav', 0) for i in range(5)]
+    hashes = {cache.hash_wav(wav_name) for wav_name in wav_names}
+    assert len(hashes) == 1
+    assert len(cache.wav_hashes) == 3
+    assert [key[0] for key in cache.wav_hashes] == [os.path.abspath(wav_name) for wav_name in wav_names[2:]]
+    # a hit moves the wav to the most recently used end
+    cache.hash_wav(wav_names[2])
+    assert next(reversed(cache.wav_hashes))[0] == os.path.abspath(wav_names[2])
+
+
+def test_evicts_least_recently_used(tmp_path):
+    feat = np.zeros(1024, dtype=np.float32)
+    cache = AudioFeatureCache(str(tmp_path / 'cache'), max_bytes=int(feat.nbytes * 2.5))
+    wav_names = [write_wav(tmp_path / f'{i}.wav', i) for i in range(3)]
+    for i, wav_name in enumerate(wav_names):
+        cache.get_or_compute(wav_name, 'hubert', None, lambda: feat)
+        # mtime granularity may be coarse, make the access order explicit
+        for fname in os.listdir(cache.cache_dir):
+            path = os.path.join(cache.cache_dir, fname)
+            if fname.startswith(cache.hash_wav(wav_name)):
+                os.utime(path, (i + 1, i + 1))
+    cache.evict()
+    left = os.listdir(cache.cache_dir)
+    assert len(left) == 2
+    assert not any(fname.startswith(cache.hash_wav(wav_names[0])) for fname in left)
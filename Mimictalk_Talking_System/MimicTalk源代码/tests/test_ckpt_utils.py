@@ -0,0 +1,67 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from utils.commons.ckpt_utils import CheckpointCache, get_ckpt_cache, load_ckpt
+
+
+def save_ckpt(path, state_dict):
+    torch.save({'state_dict': {'model': state_dict}, 'optimizer_states': [{'step': 1}]}, path)
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def clear_global_cache():
+    get_ckpt_cache().clear()
+    yield
+    get_ckpt_cache().clear()
+
+
+def test_cache_shares_one_load_and_reloads_after_resave(tmp_path):
+    cache = CheckpointCache(max_bytes=1024 ** 3)
+    path = save_ckpt(tmp_path / 'model_ckpt_steps_1.ckpt', {'weight': torch.zeros(2)})
+    first = cache.load(path)
+    assert cache.load(path) is first
+    save_ckpt(path, {'weight': torch.ones(3)})
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 1))
+    second = cache.load(path)
+    assert second is not first
+    assert second['state_dict']['model']['weight'].shape == (3,)
+
+
+def test_cache_drops_optimizer_states(tmp_path):
+    cache = CheckpointCache(max_bytes=1024 ** 3)
+    path = save_ckpt(tmp_path / 'model_ckpt_steps_1.ckpt', {'weight': torch.zeros(2)})
+    assert 'optimizer_states' not in cache.load(path)
+    assert 'optimizer_states' in torch.load(path, map_location='cpu')
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    path_a = save_ckpt(tmp_path / 'a.ckpt', {'weight': torch.zeros(16)})
+    path_b = save_ckpt(tmp_path / 'b.ckpt', {'weight': torch.zeros(16)})
+    cache = CheckpointCache(max_bytes=int(os.path.getsize(path_a) * 1.5))
+    cache.load(path_a)
+    cache.load(path_b)
+    assert [key[0] for key in cache.entries] == [os.path.abspath(path_b)]
+    assert cache.total_bytes == os.path.getsize(path_b)
+
+
+def test_cache_disabled_with_zero_max_bytes(tmp_path):
+    cache = CheckpointCache(max_bytes=0)
+    path = save_ckpt(tmp_path / 'model_ckpt_steps_1.ckpt', {'weight': torch.zeros(2)})
+    assert cache.load(path) is not cache.load(path)
+    assert len(cache.entries) == 0
+
+
+def test_load_ckpt_non_strict_does_not_prune_the_cached_state_dict(tmp_path):
+    # the bias has a mismatched shape, load_ckpt(strict=False) drops it before loading
+    path = save_ckpt(tmp_path / 'model_ckpt_steps_10.ckpt', {'weight': torch.ones(2, 2), 'bias': torch.ones(3)})
+    model = torch.nn.Linear(2, 2)
+    load_ckpt(model, path, strict=False)
+    assert torch.equal(model.weight.data, torch.ones(2, 2))
+    cached = get_ckpt_cache().load(path)
+    assert set(cached['state_dict']['model'].keys()) == {'weight', 'bias'}
+    # a second non-strict load sees the same keys
+    load_ckpt(torch.nn.Linear(2, 2), str(tmp_path), strict=False)
+    assert set(get_ckpt_cache().load(path)['state_dict']['model'].keys()) == {'weight', 'bias'}
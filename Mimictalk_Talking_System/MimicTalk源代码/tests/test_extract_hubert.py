@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("soundfile")
+
+import data_gen.utils.process_audio.extract_hubert as extract_hubert
+
+
+class FakeHubert(torch.nn.Module):
+    """only the CNN feature extractor of HuBERT (kernel 400, stride 320), so the clipping should be lossless"""
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv1d(1, 4, kernel_size=400, stride=320)
+
+    def forward(self, input_values):
+        return SimpleNamespace(last_hidden_state=self.conv(input_values[:, None]).transpose(1, 2))
+
+
+def fake_processor(speech, return_tensors="pt", sampling_rate=16000):
+    return SimpleNamespace(input_values=torch.as_tensor(speech, dtype=torch.float32)[None])
+
+
+@pytest.fixture
+def fake_hubert(monkeypatch):
+    model = FakeHubert().eval()
+    monkeypatch.setattr(extract_hubert, "hubert_model", model)
+    monkeypatch.setattr(extract_hubert, "wav2vec2_processor", fake_processor)
+    return model
+
+
+# exact multiples of the 320000-sample clip and remainders shorter than kernel - stride make the last full clip short
+@pytest.mark.parametrize("num_samples", [640000, 640040, 960050, 650000, 320000 * 3 + 400, 100000])
+@pytest.mark.parametrize("batch_size", [1, 2, 8])
+def test_hubert_clips_match_a_single_pass(fake_hubert, num_samples, batch_size):
+    speech = torch.randn(num_samples).numpy()
+    ret = extract_hubert.get_hubert_from_16k_speech(speech, device="cpu", batch_size=batch_size)
+    expected_T = (num_samples - 80) // 320
+    assert ret.shape == (expected_T, 4)
+    with torch.no_grad():
+        ref = fake_hubert(torch.as_tensor(speech, dtype=torch.float32)[None]).last_hidden_state[0]
+    n = min(expected_T, ref.shape[0])
+    assert torch.allclose(ret[:n], ref[:n], atol=1e-5)
@@ -0,0 +1,76 @@
+import os
+import threading
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("soundfile") # imported by the audio feature cache
+
+from inference.ref_clip_store import RefClipStore, COEFF_NAMES
+
+
+def write_video(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def fake_coeffs(T=4):
+    return {'id': np.ones([T, 80]), 'exp': np.zeros([T, 64]), 'euler': np.zeros([T, 3]), 'trans': np.arange(T * 3.).reshape([T, 3])}
+
+
+def test_same_clip_is_processed_once(tmp_path):
+    store = RefClipStore(str(tmp_path / 'store'))
+    calls = []
+    def compute():
+        calls.append(1)
+        return fake_coeffs()
+    video_a = write_video(tmp_path / 'a.mp4', b'clip')
+    video_b = write_video(tmp_path / 'b.mp4', b'clip') # the same clip uploaded under another name
+    coeff_a = store.get_or_compute(video_a, 'coeff', {}, COEFF_NAMES, compute)
+    coeff_b = store.get_or_compute(video_b, 'coeff', {}, COEFF_NAMES, compute)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(coeff_a['trans'], coeff_b['trans'])
+    # the returned dict is a copy, the caller can't change the cached group
+    coeff_a['trans'] = None
+    assert store.get_or_compute(video_a, 'coeff', {}, COEFF_NAMES, compute)['trans'] is not None
+    # another config is computed again
+    store.get_or_compute(video_a, 'coeff', {'fitter': 'v2'}, COEFF_NAMES, compute)
+    assert len(calls) == 2
+
+
+def test_loads_from_disk_in_a_new_process(tmp_path):
+    video_name = write_video(tmp_path / 'a.mp4', b'clip')
+    RefClipStore(str(tmp_path / 'store')).get_or_compute(video_name, 'coeff', {}, COEFF_NAMES, fake_coeffs)
+    def fail():
+        raise AssertionError('should be loaded from the store')
+    coeff = RefClipStore(str(tmp_path / 'store')).get_or_compute(video_name, 'coeff', {}, COEFF_NAMES, fail)
+    np.testing.assert_array_equal(coeff['trans'], fake_coeffs()['trans'])
+    assert not any(name.endswith('.tmp') for _, dirs, _ in os.walk(tmp_path / 'store') for name in dirs)
+
+
+def test_concurrent_requests_compute_once(tmp_path):
+    store = RefClipStore(str(tmp_path / 'store'))
+    video_name = write_video(tmp_path / 'a.mp4', b'clip')
+    calls = []
+    def compute():
+        calls.append(1)
+        return fake_coeffs()
+    threads = [threading.Thread(target=store.get_or_compute, args=(video_name, 'coeff', {}, COEFF_NAMES, compute)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+
+
+def test_memory_caches_are_bounded(tmp_path):
+    store = RefClipStore(str(tmp_path / 'store'), max_cached_groups=2, max_video_hashes=3)
+    video_names = [write_video(tmp_path / f'{i}.mp4', f'clip{i}'.encode()) for i in range(5)]
+    for video_name in video_names:
+        store.get_or_compute(video_name, 'coeff', {}, COEFF_NAMES, fake_coeffs)
+    assert len(store.cached_groups) == 2
+    assert [key[0] for key in store.video_hashes] == [os.path.abspath(video_name) for video_name in video_names[2:]]
+    # a rewritten video is hashed again
+    old_hash = store.hash_video(video_names[-1])
+    write_video(video_names[-1], b'another clip')
+    assert store.hash_video(video_names[-1]) != old_hash
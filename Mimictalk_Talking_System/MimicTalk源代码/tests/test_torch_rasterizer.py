@@ -0,0 +1,134 @@
+import os
+import math
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from deep_3drecon.util.torch_rasterizer import rasterize_meshes, faces_to_packed, interpolate_face_attributes
+
+FOV = 12.59
+IMAGE_SIZE = 48
+
+
+def random_meshes(batch_size=2, num_faces=80, seed=0):
+    """random triangles in front of the camera, mostly small with a few large ones, overlapping in depth"""
+    gen = torch.Generator().manual_seed(seed)
+    num_verts = num_faces * 3
+    z = 2. + torch.rand([batch_size, num_verts, 1], generator=gen)
+    extent = math.tan(math.radians(FOV) / 2) * z # the visible half width at depth z
+    centers = (torch.rand([batch_size, num_faces, 1, 2], generator=gen) * 2.4 - 1.2).repeat_interleave(3, dim=1).reshape([batch_size, num_verts, 2])
+    scales = torch.where(torch.rand([batch_size, num_faces, 1, 1], generator=gen) < 0.1, 0.8, 0.1).repeat_interleave(3, dim=1).reshape([batch_size, num_verts, 1])
+    xy = (centers + (torch.rand([batch_size, num_verts, 2], generator=gen) * 2 - 1) * scales) * extent
+    verts = torch.cat([xy, z], dim=-1)
+    faces = torch.arange(num_verts).reshape([num_faces, 3])
+    return verts, faces
+
+
+def reference_rasterize(verts, faces, image_size, fov):
+    """
+    one pixel at a time in float64, the same rules as pytorch3d's CPU rasterizer:
+    perspective correct barycentrics, strictly inside, the nearest face wins and ties go to the lower face index
+    """
+    verts, faces = verts.double().numpy(), faces.numpy()
+    B, N, _ = verts.shape
+    F = faces.shape[0]
+    tan_half_fov = math.tan(math.radians(fov) / 2)
+    pix_to_face = np.full([B, image_size, image_size], -1)
+    zbuf = np.full([B, image_size, image_size], -1.)
+    bary = np.full([B, image_size, image_size, 3], -1.)
+    for b in range(B):
+        v = verts[b][faces] # [F, 3, 3]
+        x, y, z = v[..., 0] / (v[..., 2] * tan_half_fov), v[..., 1] / (v[..., 2] * tan_half_fov), v[..., 2]
+        area = (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]) - (y[:, 2] - y[:, 0]) * (x[:, 1] - x[:, 0])
+        for row in range(image_size):
+            py = 1. - (2. * row + 1.) / image_size
+            for col in range(image_size):
+                px = 1. - (2. * col + 1.) / image_size
+                w = np.stack([(px - x[:, (i + 1) % 3]) * (y[:, (i + 2) % 3] - y[:, (i + 1) % 3])
+                              - (py - y[:, (i + 1) % 3]) * (x[:, (i + 2) % 3] - x[:, (i + 1) % 3]) for i in range(3)], axis=-1) / area[:, None]
+                top = w * np.stack([z[:, 1] * z[:, 2], z[:, 0] * z[:, 2], z[:, 0] * z[:, 1]], axis=-1)
+                b_coords = top / top.sum(-1, keepdims=True)
+                pz = (b_coords * z).sum(-1)
+                inside = (b_coords > 0).all(-1) & (pz >= 0)
+                if not inside.any():
+                    continue
+                f = min(np.nonzero(inside)[0], key=lambda i: (pz[i], i))
+                pix_to_face[b, row, col] = b * F + f
+                zbuf[b, row, col] = pz[f]
+                bary[b, row, col] = b_coords[f]
+    return pix_to_face, zbuf, bary
+
+
+def compare(out, ref, max_mismatch_ratio):
+    (pix_to_face, zbuf, bary), (pix_to_face_ref, zbuf_ref, bary_ref) = [[np.asarray(x) for x in o] for o in (out, ref)]
+    # float32 vs float64 may disagree on the pixel centers lying exactly on an edge
+    same = pix_to_face == pix_to_face_ref
+    assert 1 - same.mean() <= max_mismatch_ratio
+    covered = same & (pix_to_face_ref >= 0)
+    assert covered.sum() > 0.2 * covered.size
+    np.testing.assert_allclose(zbuf[covered], zbuf_ref[covered], atol=1e-4)
+    np.testing.assert_allclose(bary[covered], bary_ref[covered], atol=1e-4)
+    assert (zbuf[~(pix_to_face >= 0)] == -1).all() and (bary[~(pix_to_face >= 0)] == -1).all()
+
+
+@pytest.mark.parametrize("max_candidates", [1 << 20, 64])
+def test_matches_reference(max_candidates):
+    verts, faces = random_meshes()
+    out = rasterize_meshes(verts, faces, IMAGE_SIZE, FOV, max_candidates=max_candidates)
+    compare(out, reference_rasterize(verts, faces, IMAGE_SIZE, FOV), max_mismatch_ratio=0.002)
+
+
+def test_batched_faces_and_interpolation():
+    verts, faces = random_meshes(seed=1)
+    pix_to_face, zbuf, bary = rasterize_meshes(verts, faces, IMAGE_SIZE, FOV)
+    pix_to_face_b, zbuf_b, bary_b = rasterize_meshes(verts, faces.unsqueeze(0).expand([2, -1, -1]), IMAGE_SIZE, FOV)
+    assert torch.equal(pix_to_face, pix_to_face_b) and torch.equal(zbuf, zbuf_b)
+    # interpolating the view space coords gives back the z-buffer
+    attrs = verts.reshape([-1, 3])[faces_to_packed(faces, 2, verts.shape[1])]
+    image = interpolate_face_attributes(pix_to_face, bary, attrs)
+    covered = pix_to_face >= 0
+    torch.testing.assert_close(image[..., 2][covered], zbuf[covered], atol=1e-4, rtol=0)
+    assert (image[~covered] == 0).all()
+
+
+def test_matches_pytorch3d():
+    pytest.importorskip("pytorch3d")
+    from pytorch3d.structures import Meshes
+    from pytorch3d.renderer import FoVPerspectiveCameras, RasterizationSettings, MeshRasterizer
+    verts, faces = random_meshes(seed=2)
+    image_size = 128
+    rasterizer = MeshRasterizer()
+    fragments = rasterizer(Meshes(verts, faces.unsqueeze(0).expand([2, -1, -1]).int()), cameras=FoVPerspectiveCameras(fov=FOV),
+                           raster_settings=RasterizationSettings(image_size=image_size))
+    ref = fragments.pix_to_face[..., 0], fragments.zbuf[..., 0], fragments.bary_coords[..., 0, :]
+    compare(rasterize_meshes(verts, faces, image_size, FOV), ref, max_mismatch_ratio=0.001)
+
+
+
+class FakeFaceModel:
+    """the BFM model file is a separate download, only the attributes read by SECC_Renderer.__init__"""
+    center = 112.
+    focal = 1015.
+
+    def __init__(self, bfm_folder):
+        self.face_buf = np.arange(30).reshape([10, 3])
+
+
+@pytest.fixture
+def secc_renderer_cls(monkeypatch):
+    pytest.importorskip("einops")
+    import deep_3drecon.secc_renderer as secc_renderer
+    # the other assets are loaded by paths relative to the repo root
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    monkeypatch.setattr(secc_renderer, 'ParametricFaceModel', FakeFaceModel)
+    return secc_renderer.SECC_Renderer
+
+
+def test_secc_renderer_selects_torch_backend_on_cpu(secc_renderer_cls, monkeypatch):
+    assert secc_renderer_cls(512, device='cpu').face_renderer.backend == 'torch'
+    # the inference pipelines call SECC_Renderer(512) without a device on the CPU-only nodes
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: False)
+    secc_renderer = secc_renderer_cls(512)
+    assert secc_renderer.face_renderer.backend == 'torch'
+    assert secc_renderer.face_buf.device.type == 'cpu' and secc_renderer.face_feat.device.type == 'cpu'
@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+from utils.commons.video_reader import VideoFrameReader
+
+NUM_FRAMES = 40
+
+
+@pytest.fixture(scope="module")
+def video_name(tmp_path_factory):
+    # each frame is filled with a gray level of 5 * its index, so the frame index can be read back from the pixels
+    video_name = str(tmp_path_factory.mktemp("video") / "frames.avi")
+    writer = cv2.VideoWriter(video_name, cv2.VideoWriter_fourcc(*"MJPG"), 25, (64, 48))
+    for i in range(NUM_FRAMES):
+        writer.write(np.full([48, 64, 3], 5 * i, dtype=np.uint8))
+    writer.release()
+    return video_name
+
+
+def frame_ids(frames):
+    return [int(round(frame.mean() / 5)) for frame in frames]
+
+
+def test_reads_all_frames(video_name):
+    reader = VideoFrameReader(video_name)
+    assert len(reader) == NUM_FRAMES
+    assert frame_ids(reader) == list(range(NUM_FRAMES))
+    # the reader can be iterated again
+    assert reader.read_all().shape == (NUM_FRAMES, 48, 64, 3)
+
+
+@pytest.mark.parametrize("accurate_seek", [False, True])
+@pytest.mark.parametrize("start,max_frames", [(0, 10), (13, 10), (35, 10), (39, None), (40, None)])
+def test_frame_range_starts_at_the_exact_frame(video_name, accurate_seek, start, max_frames):
+    reader = VideoFrameReader(video_name, start=start, max_frames=max_frames, accurate_seek=accurate_seek)
+    end = NUM_FRAMES if max_frames is None else min(start + max_frames, NUM_FRAMES)
+    assert frame_ids(reader) == list(range(start, end))
+
+
+def test_shards_cover_the_video_like_a_single_pass(video_name):
+    shard_size = 7
+    ids = []
+    for start in range(0, NUM_FRAMES, shard_size):
+        ids += frame_ids(VideoFrameReader(video_name, start=start, max_frames=shard_size, accurate_seek=True))
+    assert ids == frame_ids(VideoFrameReader(video_name))
+
+
+def test_stride(video_name):
+    assert frame_ids(VideoFrameReader(video_name, stride=3, start=2)) == list(range(2, NUM_FRAMES, 3))
@@ -0,0 +1,23 @@
+import shutil
+import subprocess
+import pytest
+
+from utils.commons import video_writer
+from utils.commons.video_writer import remux_ts_to_mp4
+
+
+def test_remux_raises_with_ffmpeg_stderr(monkeypatch):
+    def fail(cmd, **kwargs):
+        assert kwargs.get('check') and cmd[-1] == 'seg_0000.mp4'
+        raise subprocess.CalledProcessError(1, cmd, output='', stderr='seg_0000.ts: Invalid data found when processing input\n')
+    monkeypatch.setattr(video_writer.subprocess, 'run', fail)
+    with pytest.raises(RuntimeError, match='return code 1.*Invalid data found'):
+        remux_ts_to_mp4('seg_0000.ts')
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is not installed")
+def test_remux_missing_input(tmp_path):
+    with pytest.raises(RuntimeError, match='ffmpeg failed to remux'):
+        remux_ts_to_mp4(str(tmp_path / 'missing.ts'))
+    assert not (tmp_path / 'missing.mp4').exists()
+
@@ -0,0 +1,126 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import soundfile as sf
+
+
+# the feature configs used by the inference pipelines, change them when the extractor changes
+HUBERT_FEAT_CONFIG = {'model': 'facebook/hubert-large-ls960-ft'}
+F0_FEAT_CONFIG = {'extractor': 'parselmouth', 'hop_size': 320, 'audio_sample_rate': 16000, 'f0_min': 80, 'f0_max': 750}
+
+
+class AudioFeatureCache:
+    """
+    Content-addressed on-disk cache of audio features (hubert, f0, mfcc, ...).
+    The key is the hash of the 16k waveform samples plus the feature name and its config, so the same
+        driving audio re-rendered with another speaker/pose/bg reuses the features even though
+        the temp 16k wav has a different name each time.
+    Features are stored as .npy and loaded memory-mapped (copy-on-write). Each hit refreshes the
+        mtime of the file, and the least recently used files are removed once the total size exceeds max_bytes.
+    The sample hashes of the last max_wav_hashes wavs are kept in memory, the temp wavs of finished jobs fall out of it.
+    usage:
+        feat = get_audio_feat_cache().get_or_compute(wav16k_name, 'hubert', HUBERT_FEAT_CONFIG,
+                                                     lambda: get_hubert_from_16k_wav(wav16k_name).numpy())
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, enabled=True, max_wav_hashes=256):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.max_wav_hashes = max_wav_hashes
+        self.lock = threading.Lock()
+        self.wav_hashes = OrderedDict() # (abspath, mtime, size) => hash of samples, avoid re-hashing a wav for every feature
+
+    def hash_wav(self, wav_name):
+        stat = os.stat(wav_name)
+        stat_key = (os.path.abspath(wav_name), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if stat_key in self.wav_hashes:
+                self.wav_hashes.move_to_end(stat_key)
+                return self.wav_hashes[stat_key]
+        # hash the decoded samples instead of the file bytes, so the wav header does not matter
+        wav, sr = sf.read(wav_name, dtype='float32')
+        hasher = hashlib.sha1()
+        hasher.update(str((sr, wav.shape)).encode())
+        hasher.update(np.ascontiguousarray(wav).tobytes())
+        wav_hash = hasher.hexdigest()
+        with self.lock:
+            self.wav_hashes[stat_key] = wav_hash
+            while len(self.wav_hashes) > self.max_wav_hashes:
+                self.wav_hashes.popitem(last=False)
+        return wav_hash
+
+    def make_key(self, wav_name, feat_name, config=None):
+        config_str = json.dumps(config or {}, sort_keys=True, default=str)
+        config_hash = hashlib.sha1(config_str.encode()).hexdigest()[:16]
+        return f"{self.hash_wav(wav_name)}_{feat_name}_{config_hash}"
+
+    def get_or_compute(self, wav_name, feat_name, config, compute_fn):
+        if not self.enabled:
+            return compute_fn()
+        key = self.make_key(wav_name, feat_name, config)
+        npy_name = os.path.join(self.cache_dir, key + '.npy')
+        if os.path.exists(npy_name):
+            try:
+                feat = np.load(npy_name, mmap_mode='c')
+                os.utime(npy_name)
+                print(f"| Loaded cached {feat_name} from {npy_name}")
+                return feat
+            except (ValueError, OSError) as e:
+                print(f"| Failed to load cached {feat_name} from {npy_name} ({e}), re-computing...")
+        feat = np.asarray(compute_fn())
+        self.save(npy_name, feat)
+        return feat
+
+    def save(self, npy_name, feat):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write to a temp file and rename, so that a concurrent reader never sees a partial file
+        tmp_name = f"{npy_name}.{uuid.uuid4().hex}.tmp.npy"
+        try:
+            np.save(tmp_name, feat)
+            os.replace(tmp_name, npy_name)
+        except OSError as e:
+            print(f"| Failed to save audio feature cache {npy_name}: {e}")
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            return
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for fname in os.listdir(self.cache_dir):
+                if not fname.endswith('.npy') or fname.endswith('.tmp.npy'):
+                    continue
+                path = os.path.join(self.cache_dir, fname)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes = sum(e[1] for e in entries)
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+
+
+_audio_feat_cache = None
+
+
+def get_audio_feat_cache():
+    global _audio_feat_cache
+    if _audio_feat_cache is None:
+        cache_dir = os.getenv('AUDIO_FEAT_CACHE_DIR', 'infer_out/.cache/audio_feats')
+        max_bytes = int(os.getenv('AUDIO_FEAT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+        enabled = os.getenv('AUDIO_FEAT_CACHE', '1') != '0'
+        _audio_feat_cache = AudioFeatureCache(cache_dir, max_bytes=max_bytes, enabled=enabled)
+    return _audio_feat_cache
@@ -1,10 +1,84 @@
 import glob
 import os
 import re
+import threading
+from collections import OrderedDict
 import torch
 
 
-def get_last_checkpoint(work_dir, steps=None):
+class CheckpointCache:
+    """
+    Process-wide cache of deserialized checkpoints, keyed by (abspath, mtime, size).
+    A ckpt that is re-saved in place gets a new key, so stale entries are never returned.
+    The memory footprint of an entry is estimated by its file size, and the least recently used
+        entries are evicted once the total exceeds max_bytes (set CKPT_CACHE_MAX_BYTES=0 to disable caching).
+    Optimizer states are dropped from the cached entries, callers that need them (e.g., resuming a training)
+        should load with use_cache=False.
+    The cached checkpoints are shared by all callers, so treat them as read-only.
+    """
+    def __init__(self, max_bytes=int(os.getenv('CKPT_CACHE_MAX_BYTES', 1024 ** 3))):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key => (checkpoint, nbytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(ckpt_path, mmap=False):
+        stat = os.stat(ckpt_path)
+        return (os.path.abspath(ckpt_path), stat.st_mtime_ns, stat.st_size, mmap)
+
+    def load(self, ckpt_path, mmap=False):
+        key = self.make_key(ckpt_path, mmap)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            # hold the lock while loading, so concurrent callers of the same ckpt share one deserialization
+            checkpoint = torch_load_ckpt(ckpt_path, mmap=mmap)
+            checkpoint = {k: v for k, v in checkpoint.items() if k != 'optimizer_states'}
+            # a mmap'ed checkpoint is paged in lazily by the OS, it barely costs resident memory
+            nbytes = 0 if mmap else key[2]
+            if self.max_bytes > 0 and nbytes <= self.max_bytes:
+                self.entries[key] = (checkpoint, nbytes)
+                self.total_bytes += nbytes
+                self.evict()
+            return checkpoint
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.total_bytes -= nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+def torch_load_ckpt(ckpt_path, mmap=False):
+    if mmap:
+        try:
+            # requires torch>=2.1 and a ckpt saved with the zipfile serialization
+            return torch.load(ckpt_path, map_location='cpu', mmap=True)
+        except (TypeError, RuntimeError) as e:
+            print(f"| mmap load of '{ckpt_path}' is not supported ({e}), fallback to a normal load.")
+    return torch.load(ckpt_path, map_location='cpu')
+
+
+_ckpt_cache = CheckpointCache()
+
+
+def get_ckpt_cache():
+    return _ckpt_cache
+
+
+def load_checkpoint(ckpt_path, mmap=False, use_cache=True):
+    if not use_cache:
+        return torch_load_ckpt(ckpt_path, mmap=mmap)
+    return _ckpt_cache.load(ckpt_path, mmap=mmap)
+
+
+def get_last_checkpoint(work_dir, steps=None, mmap=False, use_cache=True):
     checkpoint = None
     last_ckpt_path = None
     if work_dir.endswith(".ckpt"):
@@ -13,7 +87,7 @@ def get_last_checkpoint(work_dir, steps=None):
         ckpt_paths = get_all_ckpts(work_dir, steps)
     if len(ckpt_paths) > 0:
         last_ckpt_path = ckpt_paths[0]
-        checkpoint = torch.load(last_ckpt_path, map_location='cpu')
+        checkpoint = load_checkpoint(last_ckpt_path, mmap=mmap, use_cache=use_cache)
     return checkpoint, last_ckpt_path
 
 
@@ -26,14 +100,15 @@ def get_all_ckpts(work_dir, steps=None):
                   key=lambda x: -int(re.findall('.*steps\_(\d+)\.ckpt', x)[0]))
 
 
-def load_ckpt(cur_model, ckpt_base_dir, model_name='model', force=True, strict=True, steps=None, verbose=True):
+def load_ckpt(cur_model, ckpt_base_dir, model_name='model', force=True, strict=True, steps=None, verbose=True,
+              mmap=False, use_cache=True):
     if os.path.isfile(ckpt_base_dir):
         base_dir = os.path.dirname(ckpt_base_dir)
         ckpt_path = ckpt_base_dir
-        checkpoint = torch.load(ckpt_base_dir, map_location='cpu')
+        checkpoint = load_checkpoint(ckpt_base_dir, mmap=mmap, use_cache=use_cache)
     else:
         base_dir = ckpt_base_dir
-        checkpoint, ckpt_path = get_last_checkpoint(ckpt_base_dir, steps)
+        checkpoint, ckpt_path = get_last_checkpoint(ckpt_base_dir, steps, mmap=mmap, use_cache=use_cache)
     if checkpoint is not None:
         state_dict = checkpoint["state_dict"]
         if len([k for k in state_dict.keys() if '.' in k]) > 0:
@@ -49,6 +124,8 @@ def load_ckpt(cur_model, ckpt_base_dir, model_name='model', force=True, strict=T
                     k[len(rest_model_name) + 1:]: v for k, v in state_dict[base_model_name].items()
                     if k.startswith(f'{rest_model_name}.')}
         if not strict:
+            # the state_dict may be the one held by the ckpt cache, prune a shallow copy of it
+            state_dict = dict(state_dict)
             cur_model_state_dict = cur_model.state_dict()
             unmatched_keys = []
             for key, param in state_dict.items():
@@ -66,7 +143,8 @@ def load_ckpt(cur_model, ckpt_base_dir, model_name='model', force=True, strict=T
         if hasattr(cur_model, 'load_state_dict'):
             cur_model.load_state_dict(state_dict, strict=strict)
         else: # when cur_model is nn.Parameter
-            cur_model.data = state_dict
+            # clone so that updating the parameter in place won't touch the cached ckpt
+            cur_model.data = state_dict.clone()
         print(f"| load '{model_name}' from '{ckpt_path}', strict={strict}")
     else:
         e_msg = f"| ckpt not found in {base_dir}."
@@ -200,7 +200,7 @@ class Trainer:
         model = task.build_model()
         if model is not None:
             task.model = model
-        checkpoint, _ = get_last_checkpoint(self.work_dir, self.resume_from_checkpoint)
+        checkpoint, _ = get_last_checkpoint(self.work_dir, self.resume_from_checkpoint, use_cache=False)
         if checkpoint is not None:
             self.restore_weights(checkpoint)
         elif self.on_gpu:
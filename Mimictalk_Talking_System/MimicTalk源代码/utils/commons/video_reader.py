@@ -0,0 +1,141 @@
+import math
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+
+class VideoFrameReader:
+    """
+    Stream the frames of a video, decoded ahead by a background thread into a bounded queue,
+    so that only max_read_ahead frames are alive at a time, whatever the length of the video.
+    RGB frames are channel-reversed views of the decoded BGR buffers, no copy is made.
+    Each iteration re-opens the video, so the same reader can be consumed by several passes.
+    OpenCV seeks are not frame-accurate for every codec (e.g., H.264 with B-frames), set accurate_seek=True
+        when the frame index matters, the frames before start are then decoded and discarded instead.
+    usage:
+        reader = VideoFrameReader('video.mp4', stride=2) # start/max_frames to read a frame range only
+        print(reader.height, reader.width, len(reader))
+        for frame in reader: # [H, W, 3] uint8 RGB
+            ...
+    """
+    _END = None
+
+    def __init__(self, video_name, stride=1, rgb=True, max_read_ahead=16, start=0, max_frames=None, accurate_seek=False):
+        assert stride >= 1, f"stride should be >= 1, but got {stride}"
+        self.video_name = video_name
+        self.stride = stride
+        self.start = start
+        self.accurate_seek = accurate_seek
+        self.rgb = rgb
+        self.max_read_ahead = max_read_ahead
+        self.max_frames = max_frames
+        cap = cv2.VideoCapture(video_name)
+        if not cap.isOpened():
+            raise IOError(f"failed to open video {video_name}")
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.num_decoded_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) # from the container, may be inexact
+        cap.release()
+
+    def __len__(self):
+        """
+        the number of frames yielded, estimated from the frame count in the container
+        """
+        num_frames = math.ceil(max(self.num_decoded_frames - self.start, 0) / self.stride)
+        return num_frames if self.max_frames is None else min(num_frames, self.max_frames)
+
+    @property
+    def shape(self):
+        return (len(self), self.height, self.width, 3)
+
+    def _seek(self, cap):
+        """
+        move cap to self.start, return the capture to read from
+        """
+        if not self.accurate_seek:
+            # seek to the key frame before start and decode forward, instead of decoding all the frames before it
+            cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+            if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == self.start:
+                return cap
+            print(f"| inexact seek to frame {self.start} of {self.video_name}, decode from the first frame instead.")
+            cap.release()
+            cap = cv2.VideoCapture(self.video_name)
+        for _ in range(self.start):
+            if not cap.grab():
+                break
+        return cap
+
+    def _decode_frames(self, frame_queue, stop_event):
+        cap = cv2.VideoCapture(self.video_name)
+        try:
+            if self.start > 0:
+                cap = self._seek(cap)
+            idx = self.start
+            num_yielded = 0
+            while cap.isOpened() and not stop_event.is_set():
+                if self.max_frames is not None and num_yielded >= self.max_frames:
+                    break
+                if (idx - self.start) % self.stride != 0:
+                    # skipped frames are only demuxed, not decoded
+                    if not cap.grab():
+                        break
+                    idx += 1
+                    continue
+                ret, frame_bgr = cap.read()
+                if not ret or frame_bgr is None:
+                    break
+                idx += 1
+                num_yielded += 1
+                while not stop_event.is_set():
+                    try:
+                        frame_queue.put(frame_bgr, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            frame_queue.put(e)
+        finally:
+            cap.release()
+            frame_queue.put(self._END)
+
+    def __iter__(self):
+        # one extra slot for the end mark, so the decoder thread never blocks on it
+        frame_queue = queue.Queue(maxsize=self.max_read_ahead + 2)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._decode_frames, args=(frame_queue, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                frame_bgr = frame_queue.get()
+                if frame_bgr is self._END:
+                    break
+                if isinstance(frame_bgr, Exception):
+                    raise frame_bgr
+                yield frame_bgr[..., ::-1] if self.rgb else frame_bgr # BGR ==> RGB
+        finally:
+            # the consumer may stop early, unblock the decoder and wait for it to release the video
+            stop_event.set()
+            while thread.is_alive():
+                try:
+                    frame_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def read_all(self):
+        """
+        read all frames into one [T, H, W, 3] uint8 array, for the callers that need random access.
+        the array is preallocated from the frame count, so the peak memory is one copy of the video.
+        """
+        frames = np.empty([max(len(self), 1), self.height, self.width, 3], dtype=np.uint8)
+        num_frames = 0
+        for frame in self:
+            if num_frames == len(frames):
+                # the frame count in the container is underestimated
+                frames = np.concatenate([frames, np.empty_like(frames)])
+            frames[num_frames] = frame
+            num_frames += 1
+        return frames[:num_frames]
@@ -0,0 +1,144 @@
+import os
+import queue
+import threading
+import subprocess
+
+import numpy as np
+
+
+class FFmpegVideoWriter:
+    """
+    Stream raw RGB frames into a single ffmpeg process through stdin, and mux the audio in the same pass.
+    Frames are piped to ffmpeg by a background thread, so encoding overlaps with rendering.
+    usage:
+        with FFmpegVideoWriter('out.mp4', fps=25, audio_name='drv_16k.wav') as writer:
+            for frame in frames: # [H, W, 3] uint8 RGB
+                writer.write(frame)
+    """
+    _END = None
+
+    def __init__(self, out_fname, fps=25, audio_name=None, audio_codec=None, audio_sample_rate=None,
+                 video_codec='libx264', video_bitrate=None, max_queue_size=32, loglevel='error'):
+        self.out_fname = out_fname
+        self.fps = fps
+        # the audio is optional, if it contains no audio stream we output a pure video
+        self.audio_name = audio_name if audio_name is not None and os.path.exists(audio_name) else None
+        self.audio_codec = audio_codec
+        self.audio_sample_rate = audio_sample_rate
+        self.video_codec = video_codec
+        self.video_bitrate = video_bitrate
+        self.loglevel = loglevel
+        self.frame_queue = queue.Queue(maxsize=max_queue_size)
+        self.proc = None
+        self.thread = None
+        self.frame_shape = None
+        self.num_frames = 0
+        self.error = None
+
+    def build_cmd(self, height, width):
+        cmd = ['ffmpeg', '-y', '-loglevel', self.loglevel,
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-framerate', str(self.fps), '-i', 'pipe:0']
+        if self.audio_name is not None:
+            cmd += ['-i', self.audio_name, '-map', '0:v', '-map', '1:a?']
+        cmd += ['-c:v', self.video_codec, '-pix_fmt', 'yuv420p', '-r', str(self.fps)]
+        if self.video_bitrate is not None:
+            cmd += ['-b:v', self.video_bitrate]
+        if self.audio_name is not None:
+            if self.audio_codec is not None:
+                cmd += ['-c:a', self.audio_codec]
+            if self.audio_sample_rate is not None:
+                cmd += ['-ar', str(self.audio_sample_rate)]
+            cmd += ['-shortest']
+        cmd += [self.out_fname]
+        return cmd
+
+    def start(self, height, width):
+        out_dir = os.path.dirname(self.out_fname)
+        if out_dir != '':
+            os.makedirs(out_dir, exist_ok=True)
+        cmd = self.build_cmd(height, width)
+        print(' '.join(cmd))
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._pipe_frames, daemon=True)
+        self.thread.start()
+
+    def _pipe_frames(self):
+        while True:
+            frame = self.frame_queue.get()
+            if frame is self._END:
+                break
+            if self.error is not None:
+                continue # keep draining the queue so that write() never blocks
+            try:
+                self.proc.stdin.write(frame.tobytes())
+            except (BrokenPipeError, OSError) as e:
+                self.error = e
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError) as e:
+            self.error = self.error or e
+
+    def write(self, frame):
+        """
+        frame: [H, W, 3] uint8 RGB array
+        """
+        if self.error is not None:
+            raise RuntimeError(f"ffmpeg exited while writing {self.out_fname}: {self.error}")
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        assert frame.ndim == 3 and frame.shape[-1] == 3, f"expect a [H, W, 3] frame, but got {frame.shape}"
+        if self.proc is None:
+            self.frame_shape = frame.shape
+            self.start(frame.shape[0], frame.shape[1])
+        assert frame.shape == self.frame_shape, f"frame shape changed from {self.frame_shape} to {frame.shape}"
+        self.frame_queue.put(frame)
+        self.num_frames += 1
+
+    def write_frames(self, frames):
+        """
+        frames: [T, H, W, 3] uint8 RGB array
+        """
+        for frame in frames:
+            self.write(frame)
+
+    def close(self):
+        if self.proc is None:
+            return self.out_fname
+        self.frame_queue.put(self._END)
+        self.thread.join()
+        ret = self.proc.wait()
+        self.proc = None
+        if ret != 0 or self.error is not None:
+            raise RuntimeError(f"ffmpeg failed to encode {self.out_fname} (return code {ret}): {self.error}")
+        return self.out_fname
+
+    def abort(self):
+        if self.proc is None:
+            return
+        self.proc.kill()
+        self.frame_queue.put(self._END)
+        self.thread.join()
+        self.proc.wait()
+        self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def remux_ts_to_mp4(ts_fname, mp4_fname=None):
+    """
+    copy the streams of an MPEG-TS segment (AAC audio) into an MP4 container, without re-encoding
+    return: the mp4 file name, raises RuntimeError with the ffmpeg stderr when it fails
+    """
+    mp4_fname = mp4_fname or os.path.splitext(ts_fname)[0] + '.mp4'
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', ts_fname, '-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-movflags', '+faststart', mp4_fname]
+    try:
+        subprocess.run(cmd, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ffmpeg failed to remux {ts_fname} to {mp4_fname} (return code {e.returncode}): {e.stderr.strip()}")
+    return mp4_fname
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response
 from backend.video_audio_processor import VideoAudioProcessor
 import os
 import subprocess
@@ -200,17 +200,9 @@ def api_train():
         video_file.save(temp_video_path)
         
         try:
-            # 调用后端FastAPI训练API - 使用JSON格式
+            # 调用后端FastAPI训练API - 使用multipart/form-data上传原始视频，不再Base64编码
             backend_url = f"http://localhost:{BACKEND_PORT}/api/train"
             
-            # 读取视频文件内容并转换为Base64编码
-            with open(temp_video_path, 'rb') as f:
-                video_content = f.read()
-            
-            import base64
-            video_base64 = base64.b64encode(video_content).decode('utf-8')
-            video_base64 = f"data:video/mp4;base64,{video_base64}"
-            
             # 准备默认参数
             params = {
                 'max_updates': max_updates,  # 使用解析出的max_updates或默认值
@@ -219,7 +211,6 @@ def api_train():
                 'batch_size': 1,
                 'lr': 0.001,
                 'lr_triplane': 0.005,
-                'video_file': video_base64
             }
             
             # 合并前端传递的自定义参数
@@ -235,8 +226,10 @@ def api_train():
                 except json.JSONDecodeError:
                     print(f"无效的自定义参数JSON: {custom_params}")
             
-            # 使用JSON格式发送请求
-            response = requests.post(backend_url, json=params, stream=True)
+            # 视频作为文件字段，其余参数作为表单字段
+            with open(temp_video_path, 'rb') as video_f:
+                files = {'video_file': (os.path.basename(temp_video_path), video_f, 'video/mp4')}
+                response = requests.post(backend_url, data={k: str(v) for k, v in params.items()}, files=files, stream=True)
             
             # 处理响应（这里简化处理，实际应该处理流式输出）
             if response.status_code == 200:
@@ -276,6 +269,17 @@ def api_train():
             'error': str(e)
         }), 400
 
+def wait_backend_job(job_id, task_id, poll_interval=2):
+    """轮询后端任务直到结束，同步进度到tasks[task_id]，返回与原同步接口相同格式的结果"""
+    while True:
+        job = requests.get(f"http://localhost:{BACKEND_PORT}/api/jobs/{job_id}", timeout=30).json()['data']
+        tasks[task_id]['progress'] = job['progress']
+        if job['status'] == 'succeeded':
+            return {'code': 0, 'msg': job['message'], 'data': job['result']}
+        if job['status'] in ('failed', 'cancelled'):
+            return {'code': -1, 'msg': job['error'] or job['message'], 'data': None}
+        time.sleep(poll_interval)
+
 @app.route('/api/generate', methods=['POST'])
 def api_generate():
     """生成视频"""
@@ -422,7 +426,12 @@ def api_generate():
                 response = requests.post(backend_url, files=files, data=data)
                 response_data = response.json()
             
-            if response.status_code == 200 and response_data.get('code') == 0:
+            # 后端只返回任务ID，轮询任务状态直到结束
+            if response.status_code == 202 and response_data.get('code') == 0:
+                tasks[task_id]['backend_job_id'] = response_data['data']['job_id']
+                response_data = wait_backend_job(response_data['data']['job_id'], task_id)
+            
+            if response_data.get('code') == 0:
                 # 获取生成的视频路径
                 generated_video_path = response_data['data']['本地生成视频路径']
                 
@@ -515,6 +524,13 @@ def get_task_status(task_id):
 def stop_task(task_id):
     """停止任务生成"""
     if task_id in tasks:
+        # 同时取消后端的推理任务
+        backend_job_id = tasks[task_id].get('backend_job_id')
+        if backend_job_id:
+            try:
+                requests.post(f"http://localhost:{BACKEND_PORT}/api/jobs/{backend_job_id}/cancel", timeout=10)
+            except requests.exceptions.RequestException as e:
+                print(f"取消后端任务失败: {e}")
         # 更新任务状态为stopped
         tasks[task_id]['status'] = 'stopped'
         tasks[task_id]['progress'] = 0
@@ -713,6 +729,92 @@ def api_chat():
             'error': str(e)
         }), 400
 
+@app.route('/api/chat-stream', methods=['POST'])
+def api_chat_stream():
+    """流式对话：回复文本、语音和视频按句流水线生成，立即返回会话ID，前端轮询状态并边生成边播放HLS视频"""
+    temp_video_path = None
+    try:
+        user_message = request.form.get('message', '')
+        if not user_message:
+            return jsonify({
+                'success': False,
+                'error': '消息内容不能为空'
+            }), 400
+        if 'reference_audio' not in request.files or 'reference_video' not in request.files:
+            return jsonify({
+                'success': False,
+                'error': '没有上传音频文件或视频文件'
+            }), 400
+        
+        # 参考音频转换为Base64，与语音克隆接口一致
+        import base64
+        audio_base64 = base64.b64encode(request.files['reference_audio'].read()).decode('utf-8')
+        # 参考视频保存到临时位置，后端创建会话时会复制一份，之后即可删除
+        temp_video_path = os.path.join(tempfile.gettempdir(), f"pose_{uuid.uuid4().hex}.mp4")
+        request.files['reference_video'].save(temp_video_path)
+        
+        speed = request.form.get('speed', 1.0)
+        payload = {
+            'message': user_message,
+            'reference_audio': audio_base64,
+            'local_ckpt_dir': request.form.get('model_dir', ''),
+            'drv_pose': temp_video_path,
+            'speed': float(speed) if speed else 1.0,
+            # 选择本地LLM时使用后端的模拟LLM
+            'mock_llm': request.form.get('api', 'OpenAI API') == 'Local LLM',
+            'api_key': OPENAI_API_KEY,
+        }
+        response = requests.post(f'http://localhost:{BACKEND_PORT}/api/conversation', json=payload, timeout=60)
+        if response.status_code != 202:
+            return jsonify({
+                'success': False,
+                'error': f'创建对话失败: {response.status_code} {response.text}'
+            }), 500
+        session = response.json()['data']
+        return jsonify({
+            'success': True,
+            'session_id': session['session_id'],
+            'playlist_url': f"/api/chat-stream/{session['session_id']}/{session['playlist']}"
+        }), 200
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    finally:
+        if temp_video_path is not None and os.path.exists(temp_video_path):
+            os.remove(temp_video_path)
+
+@app.route('/api/chat-stream/<session_id>', methods=['GET'])
+def get_chat_stream_status(session_id):
+    """查询流式对话状态（回复文本、已生成的视频分段数）"""
+    try:
+        response = requests.get(f'http://localhost:{BACKEND_PORT}/api/conversation/{session_id}', timeout=10)
+        if response.status_code != 200:
+            return jsonify({'success': False, 'error': f'会话不存在: {session_id}'}), response.status_code
+        return jsonify({'success': True, **response.json()['data']})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/chat-stream/<session_id>/stop', methods=['POST'])
+def stop_chat_stream(session_id):
+    """停止流式对话"""
+    try:
+        response = requests.post(f'http://localhost:{BACKEND_PORT}/api/conversation/{session_id}/cancel', timeout=10)
+        if response.status_code != 200:
+            return jsonify({'success': False, 'error': f'会话不存在: {session_id}'}), response.status_code
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/chat-stream/<session_id>/<filename>', methods=['GET'])
+def get_chat_stream_file(session_id, filename):
+    """转发HLS播放列表和视频分段"""
+    response = requests.get(f'http://localhost:{BACKEND_PORT}/api/conversation/{session_id}/{filename}', timeout=30)
+    headers = {'Cache-Control': response.headers['Cache-Control']} if 'Cache-Control' in response.headers else None
+    return Response(response.content, status=response.status_code,
+                    mimetype=response.headers.get('Content-Type', 'application/octet-stream'), headers=headers)
+
 # 启动Flask前端服务
 if __name__ == '__main__':
     print("🚀 启动前端服务...")
@@ -1,6 +1,12 @@
 import os
+import time
 from openai import OpenAI
 
+SYSTEM_PROMPT = "你是一个聊天伙伴，用自然口语化的方式回应，内容简洁，像真人聊天一样。请确保你的回答只能使用中文，绝对不能包含任何英文单词或字母。"
+
+# 本地模拟LLM的固定回复，用于在没有API key时测试流式对话流水线
+MOCK_REPLY = "你好呀，很高兴和你聊天！今天过得怎么样？如果有什么想聊的，随时告诉我，我一直都在这里陪着你。"
+
 def generate_llm_response(user_message, api_key, model="deepseek-chat"):
     """
     调用DeepSeek API生成LLM响应 - 使用OpenAI SDK
@@ -24,7 +30,7 @@ def generate_llm_response(user_message, api_key, model="deepseek-chat"):
         response = client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "system", "content": "你是一个聊天伙伴，用自然口语化的方式回应，内容简洁，像真人聊天一样。请确保你的回答只能使用中文，绝对不能包含任何英文单词或字母。"},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": user_message},
             ],
             stream=False
@@ -37,4 +43,57 @@ def generate_llm_response(user_message, api_key, model="deepseek-chat"):
     except Exception as e:
         # 处理异常情况
         print(f"[backend.chat_engine] 生成响应时出错: {str(e)}")
-        return f"生成响应时出错: {str(e)}"
\ No newline at end of file
+        return f"生成响应时出错: {str(e)}"
+
+
+def stream_llm_response(user_message, api_key, model="deepseek-chat"):
+    """
+    流式调用DeepSeek API，边生成边返回文本片段
+    
+    Args:
+        user_message: 用户输入的消息
+        api_key: DeepSeek API密钥
+        model: 使用的模型名称，默认deepseek-chat
+        
+    Yields:
+        str: LLM新生成的文本片段
+    """
+    client = OpenAI(
+        api_key=api_key,
+        base_url="https://api.deepseek.com"
+    )
+    print(f"[backend.chat_engine] 流式调用DeepSeek API处理消息：{user_message[:50]}...")
+    response = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_message},
+        ],
+        stream=True
+    )
+    for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+
+def mock_llm_stream(user_message, reply=None, chunk_size=2, delay=0.05):
+    """
+    本地模拟LLM：按固定间隔逐段吐出回复，不依赖网络和API key，用于测试流式对话
+    
+    Args:
+        user_message: 用户输入的消息（仅打印）
+        reply: 模拟的回复内容，默认MOCK_REPLY
+        chunk_size: 每次吐出的字数
+        delay: 每次吐出的间隔（秒），模拟token生成速度
+        
+    Yields:
+        str: 回复的文本片段
+    """
+    reply = reply or os.getenv("MOCK_LLM_REPLY", MOCK_REPLY)
+    print(f"[backend.chat_engine] 模拟LLM处理消息：{user_message[:50]}...")
+    for i in range(0, len(reply), chunk_size):
+        time.sleep(delay)
+        yield reply[i: i + chunk_size]
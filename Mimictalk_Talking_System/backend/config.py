@@ -8,6 +8,36 @@ class Config:
     CONTAINER_INFER_OUT_DIR = "/app/infer_output"
     CONTAINER_OUTSIDE_DIR = "/app/outside"  # 外部上传文件的容器存储路径
     CONTAINER_OUTSIDE_INFER_DIR = "/app/outside/infer_out"  # 外部输出目录
+    CONTAINER_DATA_ROOT_DIR = "/app/data"
+    # 共享目录（docker-compose中的bind mount）在宿主机上的路径，为空或不存在时回退到docker cp
+    LOCAL_SHARED_DIR = os.getenv("MIMICTALK_SHARED_DIR", "")  # 挂载到 CONTAINER_OUTSIDE_DIR
+    LOCAL_CONTAINER_CKPT_DIR = os.getenv("MIMICTALK_CKPT_MOUNT_DIR", "")  # 挂载到 CONTAINER_CKPT_DIR
+    LOCAL_CONTAINER_DATA_DIR = os.getenv("MIMICTALK_DATA_MOUNT_DIR", "")  # 挂载到 CONTAINER_DATA_ROOT_DIR
+    # 容器内常驻推理进程（inference/mimictalk_infer_worker.py）
+    INFER_WORKER_URL = "http://127.0.0.1:8090"  # 容器暴露的常驻推理进程地址
+    INFER_WORKER_A2M_CKPT = "checkpoints/240112_icl_audio2secc_vox2_cmlr"
+    INFER_WORKER_MAX_CACHED_SPEAKERS = 2  # 常驻显存的说话人模型数量上限
+    INFER_WORKER_MAX_CONCURRENT_JOBS = 2  # 常驻推理进程同时处理的请求数上限
+    INFER_WORKER_START_TIMEOUT = 300  # 等待常驻推理进程加载完成的最长时间（秒）
+    INFER_WORKER_RETRY_BACKOFF = 120  # 启动失败后多久内不再重试（秒），期间的任务直接回退到单次推理
+    # 容器内常驻语音克隆服务（Voice_Model/api_v2.py）
+    VOICE_SERVICE_URL = "http://127.0.0.1:7860"  # 容器暴露的语音克隆服务地址
+    VOICE_SERVICE_START_TIMEOUT = 180  # 等待语音克隆模型加载完成的最长时间（秒）
+    VOICE_SERVICE_IDLE_TIMEOUT = int(os.getenv("VOICE_SERVICE_IDLE_TIMEOUT", "600"))  # 空闲多久后卸载服务释放显存（秒），<=0表示常驻
+    VOICE_SERVICE_POOL_SIZE = 4  # 复用的HTTP连接数
+    VOICE_SERVICE_LOG = "/app/voice_service.log"  # 容器内的服务日志
+    # 流式对话：LLM → 语音克隆 → 数字人视频按句流水线生成，输出HLS分段
+    LLM_API_KEY = os.getenv("DEEPSEEK_API_KEY", "")  # 请求中未带api_key时使用，两者都为空时使用本地模拟LLM
+    CONVERSATION_DIR = "conversations"  # 会话目录（LOCAL_TEMP_DIR 和 CONTAINER_OUTSIDE_DIR 下的子目录）
+    CONVERSATION_QUEUE_SIZE = 4  # 相邻两个阶段之间最多积压的句子数
+    CONVERSATION_MAX_SENTENCE_CHARS = 40  # 每句的最大长度，超过时在逗号处提前切分，缩短首段延迟
+    CONVERSATION_MIN_SENTENCE_CHARS = 4  # 短于该长度的句子并入下一句
+    CONVERSATION_HLS_TARGET_DURATION = 10  # HLS分段的最大时长（秒），更长的句子音频切成几段渲染
+    CONVERSATION_FINISHED_TTL = 3600  # 已结束会话（含视频分段）的保留时间（秒）
+    # 后台任务队列
+    JOB_NUM_WORKERS = 2  # 同时执行的推理任务数
+    JOB_MAX_QUEUE_SIZE = 100  # 排队任务数上限，超出时拒绝提交
+    JOB_FINISHED_TTL = 3600  # 已结束任务的记录保留时间（秒）
     # 本地配置
     LOCAL_API_PORT = 8083
     # 使用绝对路径避免路径解析问题
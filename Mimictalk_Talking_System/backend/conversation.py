@@ -0,0 +1,407 @@
+# 流式对话流水线：LLM边生成边按句切分 → 每句经常驻语音克隆服务合成 → 每句音频交给常驻推理进程渲染成一段HLS视频分段
+# 三个阶段各占一个线程，通过有界队列衔接，互相重叠：第一句的视频在渲染时，后面的句子已在生成和合成，
+# 首帧延迟约等于“第一句”的 LLM + TTS + 渲染时间，而不是整段回复各阶段时间之和
+# 流水线以句为单位：每句最多max_chars个字，用普通（非streaming_mode）的/tts请求合成，拿到完整wav后再渲染；
+# 渲染一段视频需要整句音频，句内流式合成只会多一套手工解析wav头的代码，不会缩短首段延迟
+import os
+import re
+import math
+import time
+import uuid
+import wave
+import queue
+import shutil
+import hashlib
+import threading
+import traceback
+import subprocess
+from config import cfg
+from job_queue import JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED, FINISHED_STATES
+from transfer import put_file, get_file, put_ckpt_dir, put_drv_pose, container_to_local_path, file_sha256
+from utils import start_infer_worker, worker_exec_infer
+from voice_service import get_voice_service
+
+SENTENCE_ENDS = "。！？!?；;…\n"
+SOFT_BREAKS = "，,、：: "
+CLOSING_PUNCS = "”’」』）)\"'"
+VIDEO_FPS = 25  # 与推理进程输出的视频帧率一致
+PLAYLIST_NAME = "index.m3u8"
+
+
+class ConversationCancelled(Exception):
+    """会话被取消或其它阶段已失败"""
+    pass
+
+
+class SentenceSplitter:
+    """
+    把LLM流式输出的文本片段切成句子：遇到句末标点即切出一句（紧跟的引号、括号归入上一句），
+    过短的句子并入下一句；每句不超过max_chars个字，超过时在逗号、空格等处提前切分，没有时直接在max_chars处切分，
+    尽早把第一句交给语音合成，也限制了每个视频分段的时长
+    """
+    def __init__(self, max_chars=40, min_chars=4):
+        self.max_chars = max_chars
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        """输入新生成的文本片段，返回已完整的句子列表"""
+        self.buffer += text
+        sentences = []
+        while True:
+            cut = self.find_cut()
+            if cut is None:
+                break
+            sentence, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if is_speakable(sentence):
+                sentences.append(sentence)
+        return sentences
+
+    def flush(self):
+        """LLM输出结束，返回剩余的句子（同样不超过max_chars个字）"""
+        sentences = []
+        while self.buffer:
+            cut = self.find_cut(final=True)
+            if cut is None:
+                cut = len(self.buffer)
+            sentence, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if is_speakable(sentence):
+                sentences.append(sentence)
+        return sentences
+
+    def find_cut(self, final=False):
+        """
+        final: 后面不会再有文本，句末标点在缓冲区末尾时也直接切分
+        return: 切分位置，还需要等待更多文本时返回None
+        """
+        buf = self.buffer
+        for i, ch in enumerate(buf[:self.max_chars]):
+            # 英文句点只在后面跟空白时才算句末，避免切开小数
+            if ch not in SENTENCE_ENDS and not (ch == "." and (i + 1 == len(buf) and final or i + 1 < len(buf) and buf[i + 1].isspace())):
+                continue
+            end = i + 1
+            while end < len(buf) and (buf[end] in SENTENCE_ENDS or buf[end] in CLOSING_PUNCS):
+                end += 1
+            if end == len(buf) and not final:
+                return None  # 后面可能还有标点或引号，等下一个片段
+            if len(buf[:end].strip()) >= self.min_chars:
+                return end
+        if len(buf) > self.max_chars:
+            soft_break = max(buf.rfind(ch, 0, self.max_chars) for ch in SOFT_BREAKS)
+            if soft_break + 1 >= self.min_chars:
+                return soft_break + 1
+            return self.max_chars
+        return None
+
+
+def is_speakable(text):
+    # 纯标点的句子无法合成语音
+    return re.search(r"\w", text) is not None
+
+
+def split_wav(wav_path, max_duration):
+    """
+    把时长超过max_duration秒的wav等分成若干段，保证每个HLS分段不超过播放列表的目标时长
+    return: [(wav路径, 时长)]，不需要切分时只有原文件一项
+    """
+    with wave.open(wav_path, "rb") as f:
+        params = f.getparams()
+        pcm = f.readframes(params.nframes)
+    duration = params.nframes / params.framerate
+    if duration <= max_duration:
+        return [(wav_path, duration)]
+    num_parts = math.ceil(duration / max_duration)
+    part_nframes = math.ceil(params.nframes / num_parts)
+    frame_size = params.sampwidth * params.nchannels
+    parts = []
+    for i in range(num_parts):
+        part_pcm = pcm[i * part_nframes * frame_size:(i + 1) * part_nframes * frame_size]
+        part_path = f"{os.path.splitext(wav_path)[0]}_{i}.wav"
+        with wave.open(part_path, "wb") as f:
+            f.setnchannels(params.nchannels)
+            f.setsampwidth(params.sampwidth)
+            f.setframerate(params.framerate)
+            f.writeframes(part_pcm)
+        parts.append((part_path, len(part_pcm) / frame_size / params.framerate))
+    os.remove(wav_path)
+    return parts
+
+
+class ConversationSession:
+    _END = None
+
+    def __init__(self, session_id, message, llm_stream, ref_audio_path, local_ckpt_dir="", drv_pose="static", bg_img="",
+                 text_lang="zh", prompt_lang="zh", prompt_text="", speed_factor=1.0):
+        self.session_id = session_id
+        self.message = message
+        self.llm_stream = llm_stream
+        self.ref_audio_path = ref_audio_path
+        self.local_ckpt_dir = local_ckpt_dir
+        self.drv_pose = drv_pose
+        self.bg_img = bg_img
+        self.text_lang = text_lang
+        self.prompt_lang = prompt_lang
+        self.prompt_text = prompt_text
+        self.speed_factor = speed_factor
+        self.local_dir = os.path.join(cfg.LOCAL_TEMP_DIR, cfg.CONVERSATION_DIR, session_id)
+        self.container_dir = f"{cfg.CONTAINER_OUTSIDE_DIR}/{cfg.CONVERSATION_DIR}/{session_id}"
+        self.status = JOB_QUEUED
+        self.reply_text = ""
+        self.sentences = []  # 每句的文本、状态、音频时长和视频分段名
+        self.segments = []  # (分段名（不含扩展名）, 时长)，每个分段有.ts（HLS）和.mp4两种封装
+        self.error = None
+        self.created_at = time.time()
+        self.first_sentence_at = None
+        self.first_segment_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.sentence_queue = queue.Queue(maxsize=cfg.CONVERSATION_QUEUE_SIZE)
+        self.audio_queue = queue.Queue(maxsize=cfg.CONVERSATION_QUEUE_SIZE)
+
+    def start(self):
+        self.status = JOB_RUNNING
+        self.write_playlist()
+        threading.Thread(target=self.run, name=f"conversation-{self.session_id[:8]}", daemon=True).start()
+
+    def run(self):
+        """LLM和TTS阶段各开一个线程，渲染阶段在当前线程执行，全部结束后汇总状态"""
+        stages = [threading.Thread(target=self.run_stage, args=("LLM", self.run_llm_stage), daemon=True),
+                  threading.Thread(target=self.run_stage, args=("语音合成", self.run_tts_stage), daemon=True)]
+        for stage in stages:
+            stage.start()
+        self.run_stage("视频渲染", self.run_render_stage)
+        for stage in stages:
+            stage.join()
+        with self.lock:
+            if self.error is not None:
+                self.status = JOB_FAILED
+            elif self.cancel_event.is_set():
+                self.status = JOB_CANCELLED
+            else:
+                self.status = JOB_SUCCEEDED
+            self.finished_at = time.time()
+        self.write_playlist(ended=True)
+        print(f"✅ 会话{self.session_id}结束：{self.status}，{len(self.segments)}个视频分段")
+
+    def run_stage(self, name, fn):
+        try:
+            fn()
+        except ConversationCancelled:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                if self.error is None:
+                    self.error = f"{name}阶段失败：{str(e)}"
+            # 一个阶段失败时通知其它阶段退出
+            self.cancel_event.set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise ConversationCancelled(self.session_id)
+
+    def put(self, q, item):
+        while True:
+            self.check_cancelled()
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, q):
+        while True:
+            self.check_cancelled()
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    # -------------------------- 阶段1：LLM流式生成并切句 --------------------------
+    def run_llm_stage(self):
+        splitter = SentenceSplitter(max_chars=cfg.CONVERSATION_MAX_SENTENCE_CHARS, min_chars=cfg.CONVERSATION_MIN_SENTENCE_CHARS)
+        for delta in self.llm_stream:
+            self.check_cancelled()
+            with self.lock:
+                self.reply_text += delta
+            for text in splitter.feed(delta):
+                self.add_sentence(text)
+        for text in splitter.flush():
+            self.add_sentence(text)
+        self.put(self.sentence_queue, self._END)
+
+    def add_sentence(self, text):
+        with self.lock:
+            sentence = {"index": len(self.sentences), "text": text, "status": "pending", "duration": 0.0, "num_segments": 0, "segments": []}
+            self.sentences.append(sentence)
+            if self.first_sentence_at is None:
+                self.first_sentence_at = time.time()
+        print(f"💬 会话{self.session_id}第{sentence['index']}句：{text}")
+        self.put(self.sentence_queue, sentence)
+
+    # -------------------------- 阶段2：逐句流式语音合成 --------------------------
+    def run_tts_stage(self):
+        voice_service = get_voice_service()
+        # 服务端按文件名保存上传的参考音频，按内容命名，与/api/clone-voice共用
+        with open(self.ref_audio_path, "rb") as f:
+            ref_audio_name = f"ref_{hashlib.sha1(f.read()).hexdigest()}.wav"
+        while True:
+            sentence = self.get(self.sentence_queue)
+            if sentence is self._END:
+                break
+            sentence["status"] = "synthesizing"
+            wav_path = os.path.join(self.local_dir, f"seg_{sentence['index']:04d}.wav")
+            params = {
+                "text": sentence["text"],
+                "text_lang": self.text_lang,
+                "prompt_lang": self.prompt_lang,
+                "text_split_method": "cut5",
+                "batch_size": 1,
+                "media_type": "wav",
+                "speed_factor": self.speed_factor,
+            }
+            if self.prompt_text:
+                params["prompt_text"] = self.prompt_text
+            response = voice_service.tts(self.ref_audio_path, params, ref_audio_name=ref_audio_name, timeout=60)
+            if response.status_code != 200 or response.content[:4] != b"RIFF":
+                # 单句合成失败时跳过该句，不影响后面的句子
+                print(f"⚠️  会话{self.session_id}第{sentence['index']}句语音合成失败：{response.status_code} {response.text[:200]}")
+                sentence["status"] = "failed"
+                continue
+            with open(wav_path, "wb") as f:
+                f.write(response.content)
+            # 超过目标时长的句子切成几段分别渲染
+            parts = split_wav(wav_path, cfg.CONVERSATION_HLS_TARGET_DURATION)
+            sentence["duration"] = sum(duration for _, duration in parts)
+            sentence["status"] = "synthesized"
+            sentence["num_segments"] = len(parts)
+            for part_path, part_duration in parts:
+                self.put(self.audio_queue, (sentence, part_path, part_duration))
+        self.put(self.audio_queue, self._END)
+
+    # -------------------------- 阶段3：逐句渲染视频分段 --------------------------
+    def run_render_stage(self):
+        container_ckpt_dir = put_ckpt_dir(self.local_ckpt_dir)
+        drv_pose = put_drv_pose("", self.drv_pose)
+        if not start_infer_worker():
+            raise Exception("常驻推理进程不可用，流式对话需要常驻推理进程")
+        pose_offset = 0  # 每段视频接着上一段的头部姿态继续
+        while True:
+            item = self.get(self.audio_queue)
+            if item is self._END:
+                break
+            sentence, wav_path, duration = item
+            sentence["status"] = "rendering"
+            seg_name = os.path.splitext(os.path.basename(wav_path))[0]
+            container_audio_path = f"{self.container_dir}/{seg_name}.wav"
+            container_seg_path = f"{self.container_dir}/{seg_name}.ts"
+            put_file(wav_path, container_audio_path)
+            # 推理进程输出.ts分段时会同时封装一份同名.mp4
+            worker_exec_infer(container_audio_path, container_ckpt_dir, container_seg_path, drv_pose=drv_pose, bg_img=self.bg_img,
+                              pose_offset=pose_offset)
+            for ext in (".ts", ".mp4"):
+                get_file(f"{self.container_dir}/{seg_name}{ext}", os.path.join(self.local_dir, f"{seg_name}{ext}"))
+            pose_offset += int(round(duration * VIDEO_FPS))
+            with self.lock:
+                self.segments.append((seg_name, duration))
+                sentence["segments"].append(seg_name)
+                if len(sentence["segments"]) == sentence["num_segments"]:
+                    sentence["status"] = "done"
+                if self.first_segment_at is None:
+                    self.first_segment_at = time.time()
+                    print(f"🎬 会话{self.session_id}首段视频就绪，耗时{self.first_segment_at - self.created_at:.1f}秒")
+            self.write_playlist()
+
+    def write_playlist(self, ended=False):
+        """
+        写HLS播放列表（EVENT类型，只追加分段）；每段独立编码、时间戳从0开始，段与段之间标记DISCONTINUITY
+        EVENT播放列表的TARGETDURATION不能中途改变，超过目标时长的音频在合成后已被切开
+        """
+        with self.lock:
+            segments = list(self.segments)
+        target_duration = cfg.CONVERSATION_HLS_TARGET_DURATION
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{target_duration}", "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:EVENT"]
+        for i, (seg_name, duration) in enumerate(segments):
+            if i > 0:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines += [f"#EXTINF:{duration:.3f},", f"{seg_name}.ts"]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        os.makedirs(self.local_dir, exist_ok=True)
+        playlist_path = os.path.join(self.local_dir, PLAYLIST_NAME)
+        tmp_path = f"{playlist_path}.tmp_{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, playlist_path)  # 播放器轮询时不会读到写了一半的列表
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "session_id": self.session_id,
+                "status": self.status,
+                "message": self.message,
+                "reply_text": self.reply_text,
+                "sentences": [dict(sentence) for sentence in self.sentences],
+                "num_segments": len(self.segments),
+                "segments": [{"name": seg_name, "duration": duration} for seg_name, duration in self.segments],
+                "playlist": PLAYLIST_NAME,
+                "error": self.error,
+                "created_at": self.created_at,
+                "first_sentence_latency": self.first_sentence_at - self.created_at if self.first_sentence_at else None,
+                "first_segment_latency": self.first_segment_at - self.created_at if self.first_segment_at else None,
+                "finished_at": self.finished_at,
+            }
+
+
+class ConversationManager:
+    """管理流式对话会话，已结束的会话在finished_ttl秒后连同视频分段一起清理"""
+    def __init__(self, finished_ttl=3600):
+        self.finished_ttl = finished_ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create(self, message, llm_stream, ref_audio_data, drv_pose="static", **kwargs):
+        with self.lock:
+            self.prune_finished_sessions()
+        session_id = uuid.uuid4().hex
+        local_dir = os.path.join(cfg.LOCAL_TEMP_DIR, cfg.CONVERSATION_DIR, session_id)
+        os.makedirs(local_dir, exist_ok=True)
+        ref_audio_path = os.path.join(local_dir, "ref.wav")
+        with open(ref_audio_path, "wb") as f:
+            f.write(ref_audio_data)
+        if os.path.isfile(drv_pose):
+            # 复制一份本地参考姿势视频，调用方可以立即删除自己的临时文件；按内容命名，相同视频在容器内只放一份
+            local_pose_path = os.path.join(local_dir, f"drv_pose_{file_sha256(drv_pose)[:16]}{os.path.splitext(drv_pose)[1]}")
+            shutil.copyfile(drv_pose, local_pose_path)
+            drv_pose = local_pose_path
+        session = ConversationSession(session_id, message, llm_stream, ref_audio_path, drv_pose=drv_pose, **kwargs)
+        with self.lock:
+            self.sessions[session_id] = session
+        session.start()
+        return session
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def cancel(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.cancel()
+        return session
+
+    def prune_finished_sessions(self):
+        # 调用方需持有self.lock
+        deadline = time.time() - self.finished_ttl
+        for session_id in [session_id for session_id, session in self.sessions.items()
+                           if session.status in FINISHED_STATES and session.finished_at < deadline]:
+            session = self.sessions.pop(session_id)
+            shutil.rmtree(session.local_dir, ignore_errors=True)
+            shared_dir = container_to_local_path(session.container_dir)
+            if shared_dir is not None:
+                shutil.rmtree(shared_dir, ignore_errors=True)
+            else:
+                subprocess.run(["docker", "exec", cfg.CONTAINER_NAME, "rm", "-rf", session.container_dir], capture_output=True, text=True, timeout=60)
@@ -0,0 +1,219 @@
+# 后台任务队列：提交后立即返回任务ID，任务在有界线程池中按优先级+先进先出执行
+import time
+import uuid
+import queue
+import itertools
+import threading
+import traceback
+
+# 任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+
+class JobCancelled(Exception):
+    """任务在执行过程中被取消"""
+    pass
+
+
+class Job:
+    def __init__(self, job_type, fn, params=None, priority=0, cleanup=None):
+        self.job_id = f"{job_type}_{uuid.uuid4().hex}"
+        self.job_type = job_type
+        self.fn = fn
+        self.params = params or {}
+        self.cleanup = cleanup
+        self.priority = priority
+        self.status = JOB_QUEUED
+        self.progress = 0
+        self.message = "排队中"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    def set_progress(self, progress, message=None):
+        """由任务函数调用，更新进度；同时作为取消检查点"""
+        self.check_cancelled()
+        self.progress = max(0, min(100, int(progress)))
+        if message is not None:
+            self.message = message
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"任务已取消：{self.job_id}")
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            "job_id": self.job_id,
+            "job_type": self.job_type,
+            "status": self.status,
+            "priority": self.priority,
+            "progress": self.progress,
+            "message": self.message,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wait_time": (self.started_at or self.finished_at or now) - self.created_at,
+            "run_time": ((self.finished_at or now) - self.started_at) if self.started_at else 0.0,
+        }
+
+
+class JobManager:
+    """
+    有界线程池 + 优先级FIFO队列：priority越小越先执行，同优先级按提交顺序执行。
+    任务函数签名为 fn(job, **params)，返回值作为任务结果（需可JSON序列化）。
+    cleanup(job) 在任务结束后调用（包括排队时被取消、从未执行的任务），用于删除上传的临时文件等。
+    运行中的任务只能在 job.set_progress / job.check_cancelled 检查点处被取消，
+    检查点之间的长步骤（如一次推理）不会被中断，取消在该步骤结束后生效。
+    """
+    def __init__(self, num_workers=2, max_queue_size=100, finished_job_ttl=3600):
+        self.num_workers = max(1, num_workers)
+        self.max_queue_size = max_queue_size
+        self.finished_job_ttl = finished_job_ttl
+        self.job_queue = queue.PriorityQueue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.workers = []
+        # 指标
+        self.num_submitted = 0
+        self.num_started = 0
+        self.num_ran = 0
+        self.num_finished = {state: 0 for state in FINISHED_STATES}
+        self.total_wait_time = 0.0
+        self.total_run_time = 0.0
+        self.max_wait_time = 0.0
+        self.max_run_time = 0.0
+
+    def start(self):
+        if self.workers:
+            return
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self.worker_loop, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job_type, fn, params=None, priority=0, cleanup=None):
+        with self.lock:
+            self.prune_finished_jobs()
+            if self.queue_depth() >= self.max_queue_size:
+                raise queue.Full(f"任务队列已满（{self.max_queue_size}）")
+            job = Job(job_type, fn, params=params, priority=priority, cleanup=cleanup)
+            self.jobs[job.job_id] = job
+            self.num_submitted += 1
+            self.start()
+        self.job_queue.put((priority, next(self.seq), job.job_id))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        return [job.to_dict() for job in list(self.jobs.values())]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            cancelled_in_queue = job.status == JOB_QUEUED
+            if cancelled_in_queue:
+                # 还在队列里的任务直接标记取消，worker取到后跳过
+                self.finish(job, JOB_CANCELLED, message="任务已取消")
+            elif job.status == JOB_RUNNING:
+                job.cancel_event.set()
+                job.message = "正在取消（当前步骤结束后生效）"
+        if cancelled_in_queue:
+            self.run_cleanup(job)
+        return job
+
+    def queue_depth(self):
+        return sum(1 for job in list(self.jobs.values()) if job.status == JOB_QUEUED)
+
+    def worker_loop(self):
+        while True:
+            _, _, job_id = self.job_queue.get()
+            job = self.jobs.get(job_id)
+            with self.lock:
+                if job is None or job.status != JOB_QUEUED:
+                    continue
+                job.status = JOB_RUNNING
+                job.started_at = time.time()
+                job.message = "运行中"
+                wait_time = job.started_at - job.created_at
+                self.num_started += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+            try:
+                result = job.fn(job, **job.params)
+                job.check_cancelled()
+                with self.lock:
+                    job.result = result
+                    job.progress = 100
+                    self.finish(job, JOB_SUCCEEDED, message="任务完成")
+            except JobCancelled:
+                with self.lock:
+                    self.finish(job, JOB_CANCELLED, message="任务已取消")
+            except Exception as e:
+                traceback.print_exc()
+                with self.lock:
+                    job.error = str(e)
+                    self.finish(job, JOB_FAILED, message=f"任务失败：{str(e)}")
+            finally:
+                self.run_cleanup(job)
+
+    def run_cleanup(self, job):
+        if job.cleanup is None:
+            return
+        try:
+            job.cleanup(job)
+        except Exception:
+            traceback.print_exc()
+
+    def finish(self, job, status, message=None):
+        # 调用方需持有self.lock
+        job.status = status
+        job.finished_at = time.time()
+        if message is not None:
+            job.message = message
+        self.num_finished[status] += 1
+        if job.started_at is not None:
+            run_time = job.finished_at - job.started_at
+            self.num_ran += 1
+            self.total_run_time += run_time
+            self.max_run_time = max(self.max_run_time, run_time)
+
+    def prune_finished_jobs(self):
+        # 调用方需持有self.lock
+        deadline = time.time() - self.finished_job_ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.status in FINISHED_STATES and job.finished_at < deadline]:
+            del self.jobs[job_id]
+
+    def metrics(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+            now = time.time()
+            queued = [job for job in jobs if job.status == JOB_QUEUED]
+            running = [job for job in jobs if job.status == JOB_RUNNING]
+            return {
+                "num_workers": self.num_workers,
+                "queue_depth": len(queued),
+                "running": len(running),
+                "submitted": self.num_submitted,
+                "finished": dict(self.num_finished),
+                "oldest_queued_wait_time": max([now - job.created_at for job in queued], default=0.0),
+                "avg_wait_time": self.total_wait_time / self.num_started if self.num_started > 0 else 0.0,
+                "max_wait_time": self.max_wait_time,
+                "avg_run_time": self.total_run_time / self.num_ran if self.num_ran > 0 else 0.0,
+                "max_run_time": self.max_run_time,
+            }
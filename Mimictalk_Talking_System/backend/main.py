@@ -1,24 +1,29 @@
 import subprocess
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from config import cfg
 import os
 import uuid
 import json
+import hashlib
 from io import BytesIO
 import requests
 from datetime import datetime
 import time
+import queue
 from utils import (
-    docker_cp_local_to_container,
-    docker_cp_container_to_local,
     docker_exec_train,
     docker_exec_infer,
     sync_ckpt_from_container_to_local,
 )
+from job_queue import JobManager, JOB_SUCCEEDED
+from upload import UploadError, parse_multipart_stream, save_stream_to_file
+from transfer import put_file, get_file, list_container_files, put_ckpt_dir, put_drv_pose
+from voice_service import get_voice_service
+from conversation import ConversationManager, PLAYLIST_NAME
+from chat_engine import stream_llm_response, mock_llm_stream
 
-# 语音克隆服务配置
-VOICE_API_URL = "http://127.0.0.1:7860/tts"  # 容器暴露的语音克隆服务接口
 LOCAL_DATA_DIR = os.path.join(os.path.dirname(__file__), "data")  # 本地数据目录
 
 # 确保本地数据目录存在
@@ -26,73 +31,9 @@ os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
 
 app = FastAPI(title="MimicTalk 容器外API（带实时进度）")
 
-# -------------------------- 启动语音克隆服务 --------------------------
-def start_voice_clone_service():
-    """启动容器中的语音克隆API后台"""
-    try:
-        print("🚀 正在启动语音克隆服务...")
-        
-        # 1. 检查容器是否正在运行
-        result = subprocess.run(["docker", "ps", "-q", "-f", "name=mimictalk"], 
-                              capture_output=True, text=True, timeout=60)
-        
-        if not result.stdout.strip():
-            print("⚠️  mimictalk容器未运行，正在启动...")
-            subprocess.run(["docker", "start", "mimictalk"], capture_output=True, text=True, timeout=300)
-            print("✅ mimictalk容器已启动")
-            time.sleep(2)  # 给容器启动留一点时间
-        
-        # 2. 用Popen后台运行（不阻塞脚本）
-        manual_cmd = '''docker exec mimictalk bash -c "export PYTHONUNBUFFERED=1 && source /opt/conda/etc/profile.d/conda.sh && conda activate voice && cd /app/Voice_Model && python api_v2.py"'''
-        
-        # 用Popen后台执行，不会阻塞脚本
-        process = subprocess.Popen(
-            manual_cmd,
-            shell=True,
-            stdout=open("voice_manual.log", "w"),  # 可选：把输出写到本地日志
-            stderr=open("voice_manual_error.log", "w"),
-            text=True
-        )
-        
-        time.sleep(15)  # 等待服务加载（根据你的模型加载速度调整）
-        print("✅ 语音克隆服务命令已后台执行")
-        print(f"📡 语音克隆服务地址: {VOICE_API_URL}")
-        print(f"📄 本地日志: voice_manual.log / voice_manual_error.log")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ 启动语音克隆服务失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
-
-# -------------------------- 关闭语音克隆服务 --------------------------
-def stop_voice_clone_service():
-    """杀掉容器中的语音克隆API后台进程"""
-    try:
-        print("🛑 正在关闭语音克隆服务...")
-        
-        # 查找容器中运行的api_v2.py进程并杀掉
-        kill_cmd = '''docker exec mimictalk bash -c "ps aux | grep 'python api_v2.py' | grep -v grep | awk '{print $2}' | xargs -r kill -9"'''
-        
-        # 执行命令杀掉进程
-        subprocess.run(
-            kill_cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        
-        print("✅ 语音克隆服务已成功关闭")
-        return True
-        
-    except Exception as e:
-        print(f"❌ 关闭语音克隆服务失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
+# 推理任务队列：/api/infer只负责接收上传并提交任务，耗时的docker操作在后台线程中执行
+job_manager = JobManager(num_workers=cfg.JOB_NUM_WORKERS, max_queue_size=cfg.JOB_MAX_QUEUE_SIZE, finished_job_ttl=cfg.JOB_FINISHED_TTL)
+conversation_manager = ConversationManager(finished_ttl=cfg.CONVERSATION_FINISHED_TTL)
 
 # 添加静态文件服务
 from fastapi.staticfiles import StaticFiles
@@ -189,8 +130,41 @@ def get_voice_clone_models():
 @app.post("/api/train", summary="上传视频训练（实时显示进度条）", response_class=StreamingResponse)
 async def train(request: Request):
     try:
-        # 解析请求体
-        data = await request.json()
+        # 1. 接收视频并流式保存到本地临时目录，支持三种上传方式：
+        #    multipart/form-data（video_file文件字段+表单参数）、原始二进制/chunked请求体（参数放在query string）、
+        #    以及旧的JSON+Base64格式（兼容保留）
+        content_type = request.headers.get("Content-Type", "")
+        local_video_name = f"train_{uuid.uuid4().hex}.mp4"
+        local_video_path = os.path.join(cfg.LOCAL_TEMP_DIR, local_video_name)
+        if content_type.startswith("multipart/form-data"):
+            data, files = await parse_multipart_stream(
+                request.stream(), content_type, cfg.LOCAL_TEMP_DIR,
+                file_path_fn=lambda save_dir, field_name, filename: local_video_path if field_name == "video_file" else os.path.join(save_dir, f"upload_{uuid.uuid4().hex}"))
+            for name, uploaded_file in files.items():
+                if name != "video_file":
+                    os.remove(uploaded_file.path)
+            if "video_file" not in files or files["video_file"].size == 0:
+                raise HTTPException(status_code=400, detail="缺少视频文件")
+            video_info = files["video_file"]
+        elif content_type.startswith("application/json"):
+            data = await request.json()
+            video_base64 = data.get("video_file", "")
+            if not video_base64:
+                raise HTTPException(status_code=400, detail="缺少视频文件")
+            import base64
+            with open(local_video_path, "wb") as f:
+                f.write(base64.b64decode(video_base64.split(',')[1] if ',' in video_base64 else video_base64))
+            video_info = None
+        else:
+            data = dict(request.query_params)
+            video_info = await save_stream_to_file(request.stream(), local_video_path)
+            if video_info.size == 0:
+                os.remove(local_video_path)
+                raise HTTPException(status_code=400, detail="缺少视频文件")
+        if video_info is not None:
+            print(f"✅ 本地视频保存：{local_video_path}（{video_info.size}字节，sha256={video_info.sha256}）")
+        else:
+            print(f"✅ 本地视频保存：{local_video_path}")
         
         # 获取参数
         max_updates = int(data.get("max_updates", 5))
@@ -200,25 +174,9 @@ async def train(request: Request):
         lr = float(data.get("lr", 0.001))
         lr_triplane = float(data.get("lr_triplane", 0.005))
         
-        # 获取Base64编码的视频内容
-        video_base64 = data.get("video_file", "")
-        if not video_base64:
-            raise HTTPException(status_code=400, detail="缺少视频文件")
-        
-        # 解码Base64视频内容
-        import base64
-        video_data = base64.b64decode(video_base64.split(',')[1] if ',' in video_base64 else video_base64)
-        
-        # 1. 保存视频到本地临时目录
-        local_video_name = f"train_{uuid.uuid4().hex}.mp4"
-        local_video_path = os.path.join(cfg.LOCAL_TEMP_DIR, local_video_name)
-        with open(local_video_path, "wb") as f:
-            f.write(video_data)
-        print(f"✅ 本地视频保存：{local_video_path}")
-        
         # 2. 复制视频到容器（符合组长要求的路径）
         container_video_path = os.path.join(cfg.CONTAINER_DATA_DIR, local_video_name)
-        docker_cp_local_to_container(local_video_path, container_video_path)
+        await run_in_threadpool(put_file, local_video_path, container_video_path)
         
         # 3. 容器内模型保存路径
         container_work_dir = os.path.join(cfg.CONTAINER_CKPT_DIR, speaker_name)
@@ -250,26 +208,22 @@ async def train(request: Request):
                 frontend_video_path = os.path.join("E:\projects\talking_face_hw_group1\static\videos", f"{speaker_name}_val.mp4")
                 try:
                     # 列出容器内所有val_step*.mp4文件，找出数字最大的那个
-                    list_cmd = ["docker", "exec", "mimictalk", "bash", "-c", f"ls {container_work_dir}/val_step*.mp4 2>/dev/null | sort -V"]
-                    result = subprocess.run(list_cmd, capture_output=True, text=True)
-                    if result.returncode == 0 and result.stdout.strip():
-                        # 获取所有val_step视频文件列表
-                        val_videos = result.stdout.strip().split('\n')
-                        if val_videos:
-                            # 选择最后一个（数字最大的）
-                            container_val_video_path = val_videos[-1].strip()
-                            
-                            docker_cp_container_to_local(container_val_video_path, local_val_video_path)
-                            yield f"📹 验证视频保存到：{local_val_video_path}\n".encode("utf-8")
-                            
-                            # 复制到前端静态目录
-                            import shutil
-                            shutil.copy2(local_val_video_path, frontend_video_path)
-                            yield f"📤 验证视频已复制到前端静态目录：{frontend_video_path}\n".encode("utf-8")
-                            
-                            # 在响应中包含前端可访问的视频URL
-                            video_url = f"/static/videos/{speaker_name}_val.mp4"
-                            yield f"🔗 前端可访问的视频URL：{video_url}\n".encode("utf-8")
+                    val_videos = list_container_files(container_work_dir, "val_step*.mp4")
+                    if val_videos:
+                        # 选择最后一个（数字最大的）
+                        container_val_video_path = val_videos[-1]
+                        
+                        get_file(container_val_video_path, local_val_video_path)
+                        yield f"📹 验证视频保存到：{local_val_video_path}\n".encode("utf-8")
+                        
+                        # 复制到前端静态目录
+                        import shutil
+                        shutil.copy2(local_val_video_path, frontend_video_path)
+                        yield f"📤 验证视频已复制到前端静态目录：{frontend_video_path}\n".encode("utf-8")
+                        
+                        # 在响应中包含前端可访问的视频URL
+                        video_url = f"/static/videos/{speaker_name}_val.mp4"
+                        yield f"🔗 前端可访问的视频URL：{video_url}\n".encode("utf-8")
                     else:
                         yield f"⚠️  容器内未找到val_step*.mp4文件\n".encode("utf-8")
                 except Exception as e:
@@ -308,212 +262,164 @@ async def train(request: Request):
 # -------------------------- 推理接口（生成说话视频）--------------------------
 @app.post("/api/infer", summary="生成说话视频")
 async def infer(request: Request):
+    # 提交任务之前出错时删除已写入本地的上传文件，提交之后由任务的cleanup负责
+    files, submitted = {}, False
     try:
-        # 手动解析multipart/form-data请求，不依赖python-multipart
-        import uuid
-        import base64
-        import os
-        import io
-        import requests
-        from typing import Dict, Tuple
-        
-        # 获取请求体
-        body = await request.body()
-        content_type = request.headers.get("Content-Type", "")
-        
-        # 解析multipart/form-data
-        if not content_type.startswith("multipart/form-data"):
-            raise HTTPException(status_code=400, detail="只支持multipart/form-data格式")
-        
-        # 提取boundary
-        boundary = content_type.split("boundary=")[-1]
-        if not boundary:
-            raise HTTPException(status_code=400, detail="Content-Type中缺少boundary参数")
-        
-        # 手动解析multipart数据
-        def parse_multipart(body: bytes, boundary: str) -> Tuple[Dict[str, str], bytes, bytes]:
-            """解析multipart/form-data，返回表单数据、音频文件内容和视频文件内容"""
-            form_data: Dict[str, str] = {}
-            audio_data: bytes = b""
-            video_data: bytes = b""
-            
-            # 转换boundary格式
-            boundary_bytes = f"--{boundary}".encode("utf-8")
-            parts = body.split(boundary_bytes)
-            
-            for part in parts:
-                if not part or part.strip() == b"--":
-                    continue
-                
-                # 分离头部和内容
-                headers, content = part.split(b"\r\n\r\n", 1)
-                headers = headers.decode("utf-8", errors="ignore")
-                
-                # 解析Content-Disposition头部
-                if "Content-Disposition:" in headers:
-                    cd_header = headers.split("Content-Disposition:", 1)[1].split("\n")[0].strip()
-                    
-                    # 提取name参数
-                    if "name=\"" in cd_header:
-                        name = cd_header.split("name=\"")[1].split("\"")[0]
-                    else:
-                        continue
-                    
-                    # 检查是否是文件
-                    if "filename=\"" in cd_header:
-                        # 移除尾部的\r\n--
-                        content = content.rstrip(b"\r\n--")
-                        if name == "audio_file":
-                            # 这是音频文件
-                            audio_data = content
-                        elif name == "video_file":
-                            # 这是视频文件
-                            video_data = content
-                    else:
-                        # 这是普通表单字段
-                        content = content.decode("utf-8").rstrip("\r\n")
-                        form_data[name] = content
-            
-            return form_data, audio_data, video_data
-        
-        # 解析表单数据、音频文件和视频文件
-        form_data, audio_data, video_data = parse_multipart(body, boundary)
+        # 流式解析multipart/form-data请求，文件part边接收边写入本地临时目录，不依赖python-multipart
+        def upload_file_path(save_dir, field_name, filename):
+            prefix = {"audio_file": "infer", "video_file": "pose"}.get(field_name, "upload")
+            ext = {"audio_file": ".wav", "video_file": ".mp4"}.get(field_name, os.path.splitext(filename)[1])
+            return os.path.join(save_dir, f"{prefix}_{uuid.uuid4().hex}{ext}")
+        
+        form_data, files = await parse_multipart_stream(
+            request.stream(), request.headers.get("Content-Type", ""), cfg.LOCAL_TEMP_DIR, file_path_fn=upload_file_path)
+        # 空文件视为未上传；其余无关的文件part直接删除
+        for name, uploaded_file in list(files.items()):
+            if name not in ("audio_file", "video_file") or uploaded_file.size == 0:
+                os.remove(uploaded_file.path)
+                del files[name]
         
         # 获取参数
         local_ckpt_dir = form_data.get("local_ckpt_dir", "")
         drv_pose = form_data.get("drv_pose", "data/pose/RichardShelby_front_neutral_level1_001.mat")
         bg_img = form_data.get("bg_img", "data/bg/white_bg.png")
-        out_name = form_data.get("out_name", "infer_result")
+        # 未指定out_name时使用任务ID，并发任务的输出互不覆盖
+        out_name = form_data.get("out_name", "")
+        priority = int(form_data.get("priority", 0))
         # 确保out_name不包含.mp4扩展名，避免重复添加
         if out_name.endswith(".mp4"):
             out_name = out_name[:-4]
         
         # 检查音频文件
-        if not audio_data:
+        if "audio_file" not in files:
             raise HTTPException(status_code=400, detail="缺少音频文件")
-        
-        # 保存音频到本地临时目录（直接使用传入的音频文件，不再进行语音克隆）
-        local_audio_name = f"infer_{uuid.uuid4().hex}.wav"
-        local_audio_path = os.path.join(cfg.LOCAL_TEMP_DIR, local_audio_name)
-        with open(local_audio_path, "wb") as f:
-            f.write(audio_data)
-        print(f"✅ 音频文件保存：{local_audio_path}")
-        
-        # 3. 复制最终音频到容器的outside目录
-        container_audio_path = os.path.join(cfg.CONTAINER_OUTSIDE_DIR, local_audio_name).replace('\\', '/')
-        docker_cp_local_to_container(local_audio_path, container_audio_path)
-        
-        # 4. 处理参考视频文件
-        if video_data:
-            # 保存视频到本地临时目录
-            local_video_name = f"pose_{uuid.uuid4().hex}.mp4"
-            local_video_path = os.path.join(cfg.LOCAL_TEMP_DIR, local_video_name)
-            with open(local_video_path, "wb") as f:
-                f.write(video_data)
-            print(f"✅ 视频文件保存：{local_video_path}")
-            
-            # 复制视频到容器的outside目录
-            container_video_path = os.path.join(cfg.CONTAINER_OUTSIDE_DIR, local_video_name).replace('\\', '/')
-            docker_cp_local_to_container(local_video_path, container_video_path)
-            print(f"✅ 视频文件复制到容器：{container_video_path}")
-            
-            # 更新drv_pose为容器中的视频路径
-            drv_pose = container_video_path
-        elif os.path.exists(drv_pose):
-            # 如果drv_pose是本地文件路径，复制到容器
-            local_video_path = drv_pose
-            local_video_name = os.path.basename(local_video_path)
-            container_video_path = os.path.join(cfg.CONTAINER_OUTSIDE_DIR, local_video_name).replace('\\', '/')
-            docker_cp_local_to_container(local_video_path, container_video_path)
-            print(f"✅ 参考视频文件复制到容器：{container_video_path}")
-            
-            # 使用容器中的视频路径作为drv_pose
-            drv_pose = container_video_path
-        else:
-            # 使用默认值
-            print(f"⚠️  使用指定的参考姿势：{drv_pose}")
-        
-        # 3. 复制模型到容器（如果本地模型路径不为空）
-        if local_ckpt_dir:
-            # 检查路径是否存在
-            if not os.path.exists(local_ckpt_dir):
-                raise HTTPException(status_code=404, detail=f"模型目录不存在：{local_ckpt_dir}")
-            
-            # 生成容器内模型路径，确保使用正斜杠分隔符
-            container_ckpt_dir = f"{cfg.CONTAINER_OUTSIDE_DIR}/{os.path.basename(local_ckpt_dir)}"
-            
-            # 只复制必要的文件：配置文件和最新的模型检查点
-            # 1. 复制配置文件 - 支持多种格式
-            config_files = [
-                os.path.join(local_ckpt_dir, "config.yaml"),
-                os.path.join(local_ckpt_dir, "config.yml"),
-                os.path.join(local_ckpt_dir, "hparams.yaml"),
-                os.path.join(local_ckpt_dir, "hparams.yml")
-            ]
-            
-            config_file = None
-            for cfg_file in config_files:
-                if os.path.exists(cfg_file):
-                    config_file = cfg_file
-                    break
-            
-            if config_file:
-                # 获取原始配置文件名
-                config_filename = os.path.basename(config_file)
-                container_config_path = os.path.join(container_ckpt_dir, config_filename).replace('\\', '/')
-                docker_cp_local_to_container(config_file, container_config_path, skip_if_exists=True)
-                print(f"✅ 复制配置文件：{config_file} -> {container_config_path}")
-            else:
-                # 列出目录内容以便调试
-                dir_contents = os.listdir(local_ckpt_dir)
-                print(f"📁 目录内容：{local_ckpt_dir} -> {dir_contents}")
-                raise HTTPException(status_code=404, detail=f"配置文件不存在于目录 {local_ckpt_dir}。请确保目录中包含 config.yaml、config.yml、hparams.yaml 或 hparams.yml 文件")
-            
-            # 2. 找到最新的模型检查点
-            ckpt_files = [f for f in os.listdir(local_ckpt_dir) if f.startswith("model_ckpt_steps_") and f.endswith(".ckpt")]
-            if not ckpt_files:
-                raise HTTPException(status_code=404, detail=f"模型检查点不存在于目录：{local_ckpt_dir}")
-            
-            # 按文件名中的步数排序，选择最新的（最大步数）
-            ckpt_files.sort(key=lambda x: int(x.split("_")[-1].split(".")[0]), reverse=True)
-            latest_ckpt = ckpt_files[0]
-            
-            # 复制最新的模型检查点
-            ckpt_file_path = os.path.join(local_ckpt_dir, latest_ckpt)
-            container_ckpt_path = os.path.join(container_ckpt_dir, latest_ckpt).replace('\\', '/')
-            docker_cp_local_to_container(ckpt_file_path, container_ckpt_path, skip_if_exists=True)
-            print(f"✅ 复制最新模型检查点：{ckpt_file_path} -> {container_ckpt_path}")
-            
-            print(f"✅ 模型文件复制完成：{local_ckpt_dir} -> {container_ckpt_dir}")
-        else:
-            container_ckpt_dir = cfg.CONTAINER_CKPT_DIR
-            print("⚠️  使用容器内默认模型")
-        
-        # 4. 执行推理
-        result = docker_exec_infer(
-            container_audio_path=container_audio_path,
-            container_ckpt_dir=container_ckpt_dir,
-            container_out_path=out_name,
-            drv_pose=drv_pose,
-            bg_img=bg_img
-        )
-        
-        # 5. 同步结果视频到本地（从outside/infer_out目录）
-        # 注意：docker_exec_infer函数会确保输出文件包含.mp4扩展名
-        container_video_path = f"{cfg.CONTAINER_OUTSIDE_INFER_DIR}/{out_name}.mp4"
-        local_video_path = os.path.join(cfg.LOCAL_TEMP_DIR, f"{out_name}.mp4")
-        docker_cp_container_to_local(container_video_path, local_video_path)
-        
+        # 检查模型路径是否存在，尽早返回错误
+        if local_ckpt_dir and not os.path.exists(local_ckpt_dir):
+            raise HTTPException(status_code=404, detail=f"模型目录不存在：{local_ckpt_dir}")
+        
+        # 音频直接使用传入的音频文件，不再进行语音克隆
+        local_audio_path = files["audio_file"].path
+        print(f"✅ 音频文件保存：{local_audio_path}（{files['audio_file'].size}字节，sha256={files['audio_file'].sha256}）")
+        
+        # 参考视频文件
+        local_video_path = ""
+        if "video_file" in files:
+            local_video_path = files["video_file"].path
+            print(f"✅ 视频文件保存：{local_video_path}（{files['video_file'].size}字节，sha256={files['video_file'].sha256}）")
+        
+        # 提交到后台任务队列，立即返回任务ID
+        job = job_manager.submit("infer", run_infer_job, params={
+            "local_audio_path": local_audio_path,
+            "local_video_path": local_video_path,
+            "local_ckpt_dir": local_ckpt_dir,
+            "drv_pose": drv_pose,
+            "bg_img": bg_img,
+            "out_name": out_name,
+        }, priority=priority, cleanup=remove_infer_uploads)
+        submitted = True
         return JSONResponse({
             "code": 0,
-            "msg": "推理成功",
-            "data": {
-                "本地生成视频路径": local_video_path,
-                "容器视频路径": container_video_path
-            }
-        })
+            "msg": "推理任务已提交",
+            "data": {"job_id": job.job_id, "status": job.status}
+        }, status_code=202)
+    except queue.Full as e:
+        return JSONResponse({"code": -1, "msg": str(e), "data": None}, status_code=503)
+    except UploadError as e:
+        return JSONResponse({"code": -1, "msg": f"推理失败：{str(e)}", "data": None}, status_code=400)
+    except HTTPException as e:
+        return JSONResponse({"code": -1, "msg": f"推理失败：{e.detail}", "data": None}, status_code=e.status_code)
     except Exception as e:
         return JSONResponse({"code": -1, "msg": f"推理失败：{str(e)}", "data": None}, status_code=500)
+    finally:
+        if not submitted:
+            for uploaded_file in files.values():
+                if os.path.exists(uploaded_file.path):
+                    os.remove(uploaded_file.path)
+
+def run_infer_job(job, local_audio_path, local_video_path, local_ckpt_dir, drv_pose, bg_img, out_name):
+    """
+    在后台任务线程中执行推理：复制输入到容器、推理、把结果复制回本地
+    取消只在各步骤之间生效：推理步骤（常驻推理进程或docker exec单次推理）一旦开始不会被中断，取消在推理结束后生效
+    """
+    out_name = out_name or job.job_id
+    # 1. 复制音频到容器的outside目录
+    job.set_progress(5, "复制音频到容器")
+    local_audio_name = os.path.basename(local_audio_path)
+    container_audio_path = os.path.join(cfg.CONTAINER_OUTSIDE_DIR, local_audio_name).replace('\\', '/')
+    put_file(local_audio_path, container_audio_path)
+    
+    # 2. 处理参考视频文件
+    job.set_progress(10, "复制参考视频到容器")
+    drv_pose = put_drv_pose(local_video_path, drv_pose)
+    
+    # 3. 复制模型到容器（如果本地模型路径不为空）
+    job.set_progress(20, "复制模型到容器")
+    container_ckpt_dir = put_ckpt_dir(local_ckpt_dir)
+    
+    # 4. 执行推理
+    job.set_progress(30, "推理中")
+    docker_exec_infer(
+        container_audio_path=container_audio_path,
+        container_ckpt_dir=container_ckpt_dir,
+        container_out_path=out_name,
+        drv_pose=drv_pose,
+        bg_img=bg_img
+    )
+    
+    # 5. 同步结果视频到本地（从outside/infer_out目录）
+    # 注意：docker_exec_infer函数会确保输出文件包含.mp4扩展名
+    job.set_progress(90, "复制结果视频到本地")
+    container_video_path = f"{cfg.CONTAINER_OUTSIDE_INFER_DIR}/{out_name}.mp4"
+    local_video_path = os.path.join(cfg.LOCAL_TEMP_DIR, f"{out_name}.mp4")
+    get_file(container_video_path, local_video_path)
+    
+    return {
+        "本地生成视频路径": local_video_path,
+        "容器视频路径": container_video_path
+    }
+
+def remove_infer_uploads(job):
+    """推理任务结束（含取消）后删除本地上传的音频和参考视频，已复制到容器的文件不受影响"""
+    for path in (job.params["local_audio_path"], job.params["local_video_path"]):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+# -------------------------- 任务接口 --------------------------
+def get_job_or_404(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在！")
+    return job
+
+@app.get("/api/jobs", summary="任务列表")
+def list_jobs():
+    return JSONResponse({"code": 0, "msg": "成功", "data": job_manager.list_jobs()})
+
+@app.get("/api/jobs/{job_id}", summary="查询任务状态和进度")
+def get_job(job_id: str):
+    job = get_job_or_404(job_id)
+    return JSONResponse({"code": 0, "msg": job.message, "data": job.to_dict()})
+
+@app.post("/api/jobs/{job_id}/cancel", summary="取消任务")
+def cancel_job(job_id: str):
+    job = get_job_or_404(job_id)
+    job_manager.cancel(job_id)
+    return JSONResponse({"code": 0, "msg": job.message, "data": job.to_dict()})
+
+@app.get("/api/jobs/{job_id}/result", summary="下载任务结果视频")
+def download_job_result(job_id: str):
+    job = get_job_or_404(job_id)
+    if job.status != JOB_SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"任务尚未完成：{job.status}")
+    local_video_path = job.result["本地生成视频路径"]
+    if not os.path.exists(local_video_path):
+        raise HTTPException(status_code=404, detail="文件不存在！")
+    return FileResponse(local_video_path, filename=os.path.basename(local_video_path))
+
+@app.get("/api/metrics", summary="任务队列指标")
+def get_metrics():
+    return JSONResponse({"code": 0, "msg": "成功", "data": job_manager.metrics()})
+
 # -------------------------- 下载接口 --------------------------
 @app.get("/api/download", summary="下载文件")
 async def download(file_path: str):
@@ -529,8 +435,9 @@ async def download(file_path: str):
 async def clone_voice(request: Request):
     """
     语音克隆接口 - 根据参考音频克隆语音
-    每次调用时启动容器中的语音克隆API后台，完成后杀掉进程
+    语音克隆服务常驻容器内，首次调用时启动，之后的请求复用同一进程，空闲超时后自动卸载
     """
+    temp_ref_path = None
     try:
         # 解析请求体
         data = await request.json()
@@ -542,8 +449,8 @@ async def clone_voice(request: Request):
         
         print(f"收到语音克隆任务：文本='{text}'")
         
-        # 生成唯一的音频文件名
-        generated_audio_filename = f"clone_voice_{int(datetime.now().timestamp())}.wav"
+        # 生成唯一的音频文件名（并发请求互不覆盖）
+        generated_audio_filename = f"clone_voice_{int(datetime.now().timestamp())}_{uuid.uuid4().hex[:8]}.wav"
         local_save_path = os.path.join(LOCAL_DATA_DIR, generated_audio_filename)
         
         # 获取Base64编码的参考音频内容
@@ -556,49 +463,23 @@ async def clone_voice(request: Request):
         audio_data = base64.b64decode(audio_base64.split(',')[1] if ',' in audio_base64 else audio_base64)
         
         # 保存参考音频到临时文件
-        temp_ref_path = os.path.join(LOCAL_DATA_DIR, f"temp_ref_{int(datetime.now().timestamp())}.wav")
+        temp_ref_path = os.path.join(LOCAL_DATA_DIR, f"temp_ref_{uuid.uuid4().hex}.wav")
         with open(temp_ref_path, "wb") as f:
             f.write(audio_data)
         
-        # 启动语音克隆服务
-        if not start_voice_clone_service():
-            # 删除临时文件
-            if os.path.exists(temp_ref_path):
-                os.remove(temp_ref_path)
-            return JSONResponse({
-                "success": False,
-                "message": "启动语音克隆服务失败"
-            })
-        
-        # 发送请求到语音克隆服务
-        try:
-            with open(temp_ref_path, 'rb') as audio_file:
-                files = {'ref_audio': ("reference.wav", audio_file, 'audio/wav')}
-                data = {
-                    "text": text,
-                    "text_lang": text_lang,
-                    "prompt_lang": prompt_lang,  
-                    "text_split_method": "cut5",
-                    "batch_size": 1
-                }
-                
-                # 添加超时和重试机制
-                try:
-                    response = requests.post(VOICE_API_URL, data=data, files=files, timeout=60)  # 增加超时时间
-                    print(f"语音克隆服务响应状态码: {response.status_code}")
-                except requests.exceptions.ConnectionError as e:
-                    print(f"连接语音克隆服务失败: {str(e)}")
-                    raise
-                except requests.exceptions.Timeout as e:
-                    print(f"请求语音克隆服务超时: {str(e)}")
-                    raise
-        finally:
-                # 无论成功失败，都关闭语音克隆服务
-            stop_voice_clone_service()
-        
-        # 删除临时文件
-        if os.path.exists(temp_ref_path):
-            os.remove(temp_ref_path)
+        # 发送请求到常驻语音克隆服务（未启动或已崩溃时自动启动），阻塞调用放到线程池中执行
+        params = {
+            "text": text,
+            "text_lang": text_lang,
+            "prompt_lang": prompt_lang,
+            "text_split_method": "cut5",
+            "batch_size": 1
+        }
+        # 服务端按文件名保存上传的参考音频，按内容命名，并发请求互不覆盖，同一参考音频也不会重复堆积
+        ref_audio_name = f"ref_{hashlib.sha1(audio_data).hexdigest()}.wav"
+        response = await run_in_threadpool(get_voice_service().tts, temp_ref_path, params,
+                                           ref_audio_name=ref_audio_name, timeout=60)
+        print(f"语音克隆服务响应状态码: {response.status_code}")
         
         if response.status_code == 200:
             # 保存生成的语音到本地
@@ -619,13 +500,87 @@ async def clone_voice(request: Request):
     except Exception as e:
         import traceback
         traceback.print_exc()
-        # 确保服务被关闭
-        stop_voice_clone_service()
         return JSONResponse({
             "success": False,
             "message": "连接语音服务失败",
             "detail": str(e)
         })
+    finally:
+        # 删除临时文件
+        if temp_ref_path is not None and os.path.exists(temp_ref_path):
+            os.remove(temp_ref_path)
+
+# -------------------------- 流式对话接口 --------------------------
+@app.post("/api/conversation", summary="流式对话：LLM回复按句合成语音并渲染成HLS视频分段")
+async def create_conversation(request: Request):
+    """
+    LLM生成、语音克隆、视频渲染三个阶段按句流水线执行，立即返回会话ID；
+    客户端轮询会话状态获取回复文本，第一段视频生成后即可开始播放 /api/conversation/{session_id}/index.m3u8
+    """
+    data = await request.json()
+    message = data.get("message", "").strip()
+    if not message:
+        raise HTTPException(status_code=400, detail="缺少对话内容")
+    audio_base64 = data.get("reference_audio", "")
+    if not audio_base64:
+        raise HTTPException(status_code=400, detail="缺少参考音频文件")
+    import base64
+    ref_audio_data = base64.b64decode(audio_base64.split(',')[1] if ',' in audio_base64 else audio_base64)
+    local_ckpt_dir = data.get("local_ckpt_dir", "")
+    if local_ckpt_dir and not os.path.exists(local_ckpt_dir):
+        raise HTTPException(status_code=404, detail=f"模型目录不存在：{local_ckpt_dir}")
+    
+    # 请求和配置中都没有api_key，或显式要求时，使用本地模拟LLM
+    api_key = data.get("api_key") or cfg.LLM_API_KEY
+    if data.get("mock_llm") or not api_key:
+        llm_stream = mock_llm_stream(message)
+    else:
+        llm_stream = stream_llm_response(message, api_key)
+    
+    session = await run_in_threadpool(
+        conversation_manager.create, message, llm_stream, ref_audio_data,
+        drv_pose=data.get("drv_pose", "static"),
+        local_ckpt_dir=local_ckpt_dir,
+        bg_img=data.get("bg_img", ""),
+        text_lang=data.get("text_lang", "zh"),
+        prompt_lang=data.get("prompt_lang", "zh"),
+        prompt_text=data.get("prompt_text", ""),
+        speed_factor=float(data.get("speed", 1.0)))
+    print(f"💬 创建流式对话会话：{session.session_id}")
+    return JSONResponse({"code": 0, "msg": "会话已创建", "data": session.to_dict()}, status_code=202)
+
+def get_conversation_or_404(session_id):
+    session = conversation_manager.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="会话不存在！")
+    return session
+
+@app.get("/api/conversation/{session_id}", summary="查询流式对话状态")
+def get_conversation(session_id: str):
+    session = get_conversation_or_404(session_id)
+    return JSONResponse({"code": 0, "msg": session.status, "data": session.to_dict()})
+
+@app.post("/api/conversation/{session_id}/cancel", summary="取消流式对话")
+def cancel_conversation(session_id: str):
+    session = get_conversation_or_404(session_id)
+    conversation_manager.cancel(session_id)
+    return JSONResponse({"code": 0, "msg": session.status, "data": session.to_dict()})
+
+SEGMENT_MEDIA_TYPES = {".ts": "video/mp2t", ".mp4": "video/mp4"}
+
+@app.get("/api/conversation/{session_id}/{filename}", summary="获取HLS播放列表和视频分段（.ts供HLS播放，.mp4供不支持HLS的浏览器逐段播放）")
+def get_conversation_file(session_id: str, filename: str):
+    session = get_conversation_or_404(session_id)
+    ext = os.path.splitext(filename)[1]
+    if filename != os.path.basename(filename) or not (filename == PLAYLIST_NAME or ext in SEGMENT_MEDIA_TYPES):
+        raise HTTPException(status_code=403, detail="禁止访问！")
+    file_path = os.path.join(session.local_dir, filename)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="文件不存在！")
+    media_type = "application/vnd.apple.mpegurl" if filename == PLAYLIST_NAME else SEGMENT_MEDIA_TYPES[ext]
+    # 播放列表会持续追加分段，禁止缓存
+    headers = {"Cache-Control": "no-cache"} if filename == PLAYLIST_NAME else None
+    return FileResponse(file_path, media_type=media_type, headers=headers)
 
 if __name__ == "__main__": 
     import uvicorn
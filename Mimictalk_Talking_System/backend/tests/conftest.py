@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 后端模块之间按 `from config import cfg` 的方式导入，测试时把backend目录加入sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
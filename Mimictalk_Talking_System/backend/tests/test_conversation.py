@@ -0,0 +1,156 @@
+import os
+import wave
+import struct
+import pytest
+
+pytest.importorskip("requests")
+
+import conversation
+from conversation import SentenceSplitter, split_wav, ConversationSession, PLAYLIST_NAME
+from config import cfg
+
+
+def split(text, chunk_size=1, **kwargs):
+    # 按chunk_size个字一段模拟LLM流式输出
+    splitter = SentenceSplitter(**kwargs)
+    sentences = []
+    for i in range(0, len(text), chunk_size):
+        sentences += splitter.feed(text[i:i + chunk_size])
+    return sentences + splitter.flush()
+
+
+def write_wav(path, num_frames, sample_rate=16000):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(struct.pack(f"<{num_frames}h", *[i % 100 for i in range(num_frames)]))
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1000])
+def test_splitter_cuts_at_sentence_ends(chunk_size):
+    text = "你好呀。今天天气不错！我们去公园吧？“好的。”走吧"
+    assert split(text, chunk_size) == ["你好呀。", "今天天气不错！", "我们去公园吧？", "“好的。”", "走吧"]
+
+
+def test_splitter_merges_short_sentences_and_keeps_decimals():
+    assert split("好。我们出发吧。价格是3.5元. OK") == ["好。我们出发吧。", "价格是3.5元.", "OK"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_splitter_caps_sentence_length(chunk_size):
+    text = "这是一句很长很长的话，中间只有逗号，一直没有句号" * 5 + "。结尾"
+    sentences = split(text, chunk_size, max_chars=20)
+    assert "".join(sentences) == text
+    assert all(len(sentence) <= 20 for sentence in sentences)
+
+
+def test_splitter_cuts_at_max_chars_without_breaks():
+    # 没有任何标点时在max_chars处硬切，flush也不例外
+    sentences = split("字" * 95, 1000, max_chars=40)
+    assert [len(sentence) for sentence in sentences] == [40, 40, 15]
+
+
+def test_splitter_prefers_spaces_in_english():
+    sentences = split("one two three four five six seven eight", 1000, max_chars=20)
+    assert sentences == ["one two three four", "five six seven eight"]
+
+
+def test_splitter_drops_punctuation_only():
+    assert split("……。") == []
+
+
+def test_split_wav_keeps_short_audio(tmp_path):
+    wav_path = write_wav(tmp_path / "seg_0000.wav", 16000 * 10)
+    assert split_wav(wav_path, 10) == [(wav_path, 10.0)]
+
+
+@pytest.mark.parametrize("num_frames, num_parts", [(16000 * 10 + 1, 2), (16000 * 25, 3), (16000 * 30 + 7, 4)])
+def test_split_wav_caps_part_duration(tmp_path, num_frames, num_parts):
+    wav_path = write_wav(tmp_path / "seg_0001.wav", num_frames)
+    with wave.open(wav_path, "rb") as f:
+        pcm = f.readframes(num_frames)
+    parts = split_wav(wav_path, 10)
+    assert [os.path.basename(path) for path, _ in parts] == [f"seg_0001_{i}.wav" for i in range(num_parts)]
+    assert not os.path.exists(wav_path)
+    assert sum(duration for _, duration in parts) == pytest.approx(num_frames / 16000)
+    joined = b""
+    for path, duration in parts:
+        # HLS要求EXTINF四舍五入后不超过TARGETDURATION
+        assert round(duration) <= 10
+        with wave.open(path, "rb") as f:
+            assert f.getnframes() / f.getframerate() == duration
+            joined += f.readframes(f.getnframes())
+    assert joined == pcm
+
+
+def test_playlist_target_duration_is_constant(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "LOCAL_TEMP_DIR", str(tmp_path))
+    session = ConversationSession("sid", "你好", iter([]), "")
+    playlist_path = os.path.join(session.local_dir, PLAYLIST_NAME)
+    session.write_playlist()
+    with open(playlist_path) as f:
+        first = f.read().splitlines()
+    session.segments = [("seg_0000", 3.2), ("seg_0001_0", 9.6), ("seg_0001_1", 9.6)]
+    session.write_playlist(ended=True)
+    with open(playlist_path) as f:
+        lines = f.read().splitlines()
+    target = f"#EXT-X-TARGETDURATION:{cfg.CONVERSATION_HLS_TARGET_DURATION}"
+    assert target in first and target in lines
+    assert [line for line in lines if line.endswith(".ts")] == ["seg_0000.ts", "seg_0001_0.ts", "seg_0001_1.ts"]
+    assert lines.count("#EXT-X-DISCONTINUITY") == 2 and lines[-1] == "#EXT-X-ENDLIST"
+    assert session.to_dict()["segments"][1] == {"name": "seg_0001_0", "duration": 9.6}
+
+
+class FakeResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode("utf-8", errors="ignore")
+
+
+class FakeVoiceService:
+    """按句子文本返回预先准备的响应，记录请求参数"""
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def tts(self, ref_audio_path, params, **kwargs):
+        self.calls.append((params, kwargs))
+        return self.responses[params["text"]]
+
+
+def test_tts_stage(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "LOCAL_TEMP_DIR", str(tmp_path))
+    monkeypatch.setattr(cfg, "CONVERSATION_QUEUE_SIZE", 8)  # 没有渲染阶段消费，4个分段加结束标记要一次放下
+    ref_audio_path = write_wav(tmp_path / "ref.wav", 1600)
+    wav_bytes = {}
+    for name, seconds in [("short", 2), ("long", 25)]:
+        with open(write_wav(tmp_path / f"{name}.wav", 16000 * seconds), "rb") as f:
+            wav_bytes[name] = f.read()
+    voice_service = FakeVoiceService({
+        "第一句。": FakeResponse(200, wav_bytes["short"]),
+        "合成失败的一句。": FakeResponse(500, "error".encode()),
+        "很长的一句。": FakeResponse(200, wav_bytes["long"]),
+    })
+    monkeypatch.setattr(conversation, "get_voice_service", lambda: voice_service)
+    session = ConversationSession("sid", "你好", iter([]), ref_audio_path)
+    os.makedirs(session.local_dir)
+    sentences = [{"index": i, "text": text, "status": "pending", "duration": 0.0, "num_segments": 0, "segments": []}
+                 for i, text in enumerate(["第一句。", "合成失败的一句。", "很长的一句。"])]
+    for sentence in sentences + [session._END]:
+        session.sentence_queue.put(sentence)
+    session.run_tts_stage()
+    # 普通请求，不再使用streaming_mode
+    assert all("streaming_mode" not in params and not kwargs.get("stream") for params, kwargs in voice_service.calls)
+    assert [sentence["status"] for sentence in sentences] == ["synthesized", "failed", "synthesized"]
+    assert sentences[0]["duration"] == pytest.approx(2) and sentences[2]["duration"] == pytest.approx(25)
+    items = []
+    while True:
+        item = session.audio_queue.get_nowait()
+        if item is session._END:
+            break
+        items.append((item[0]["index"], os.path.basename(item[1]), item[2]))
+    assert [item[:2] for item in items] == [(0, "seg_0000.wav"), (2, "seg_0002_0.wav"), (2, "seg_0002_1.wav"), (2, "seg_0002_2.wav")]
+    assert sentences[2]["num_segments"] == 3 and all(duration <= 10 for _, _, duration in items)
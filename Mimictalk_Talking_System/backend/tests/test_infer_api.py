@@ -0,0 +1,78 @@
+import os
+import queue
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("openai")  # main导入chat_engine
+pytest.importorskip("httpx")  # TestClient
+from fastapi.testclient import TestClient
+
+import main
+from config import cfg
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "LOCAL_TEMP_DIR", str(tmp_path / "temp"))
+    return TestClient(main.app)
+
+
+def post_infer(client, data, audio=True, video=True):
+    files = {}
+    if audio:
+        files["audio_file"] = ("a.wav", b"RIFF" + b"\0" * 100, "audio/wav")
+    if video:
+        files["video_file"] = ("v.mp4", b"\0" * 200, "video/mp4")
+    files["extra"] = ("x.bin", b"extra", "application/octet-stream")
+    return client.post("/api/infer", data=data, files=files)
+
+
+def uploads(tmp_path):
+    temp_dir = tmp_path / "temp"
+    return sorted(os.listdir(temp_dir)) if temp_dir.exists() else []
+
+
+def test_missing_ckpt_dir_removes_uploads(client, tmp_path):
+    response = post_infer(client, {"local_ckpt_dir": str(tmp_path / "missing")})
+    assert response.status_code == 404
+    assert uploads(tmp_path) == []
+
+
+def test_missing_audio_removes_uploads(client, tmp_path):
+    response = post_infer(client, {}, audio=False)
+    assert response.status_code == 400
+    assert uploads(tmp_path) == []
+
+
+def test_bad_priority_removes_uploads(client, tmp_path):
+    response = post_infer(client, {"priority": "high"})
+    assert response.status_code == 500
+    assert uploads(tmp_path) == []
+
+
+def test_full_queue_removes_uploads(client, tmp_path, monkeypatch):
+    def submit(*args, **kwargs):
+        raise queue.Full("任务队列已满（1）")
+    monkeypatch.setattr(main.job_manager, "submit", submit)
+    response = post_infer(client, {})
+    assert response.status_code == 503
+    assert uploads(tmp_path) == []
+
+
+def test_submitted_job_keeps_uploads(client, tmp_path, monkeypatch):
+    submitted = []
+
+    class FakeJob:
+        job_id = "job1"
+        status = "queued"
+
+    def submit(job_type, fn, params=None, priority=0, cleanup=None):
+        submitted.append((params, cleanup))
+        return FakeJob()
+    monkeypatch.setattr(main.job_manager, "submit", submit)
+    response = post_infer(client, {"local_ckpt_dir": str(tmp_path), "priority": "2"})
+    assert response.status_code == 202
+    params, cleanup = submitted[0]
+    # 只保留音频和参考视频，交给任务结束后的cleanup删除
+    assert uploads(tmp_path) == sorted(os.path.basename(params[k]) for k in ("local_audio_path", "local_video_path"))
+    assert cleanup is main.remove_infer_uploads
@@ -0,0 +1,117 @@
+import time
+import queue
+import threading
+import pytest
+from job_queue import JobManager, JobCancelled, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def blocking_job(job, release):
+    release.wait(5)
+    return "blocked"
+
+
+def test_jobs_run_by_priority_then_fifo():
+    manager = JobManager(num_workers=1)
+    release = threading.Event()
+    blocker = manager.submit("block", blocking_job, params={"release": release})
+    assert wait_until(lambda: blocker.status == JOB_RUNNING)
+    order = []
+    jobs = [manager.submit("t", lambda job, name: order.append(name), params={"name": name}, priority=priority)
+            for name, priority in [("a", 1), ("b", 0), ("c", 1), ("d", 0)]]
+    release.set()
+    assert wait_until(lambda: all(job.status == JOB_SUCCEEDED for job in jobs))
+    assert order == ["b", "d", "a", "c"]
+
+
+def test_cancel_queued_job_never_runs_and_is_cleaned_up():
+    manager = JobManager(num_workers=1)
+    release = threading.Event()
+    blocker = manager.submit("block", blocking_job, params={"release": release})
+    assert wait_until(lambda: blocker.status == JOB_RUNNING)
+    ran, cleaned = [], []
+    job = manager.submit("t", lambda job: ran.append(job.job_id), cleanup=lambda job: cleaned.append(job.job_id))
+    assert job.status == JOB_QUEUED
+    manager.cancel(job.job_id)
+    assert job.status == JOB_CANCELLED
+    assert cleaned == [job.job_id]
+    release.set()
+    assert wait_until(lambda: blocker.status == JOB_SUCCEEDED)
+    time.sleep(0.05)
+    assert ran == []
+    assert cleaned == [job.job_id]
+
+
+def test_cancel_running_job_stops_at_next_checkpoint():
+    manager = JobManager(num_workers=1)
+    started, release, cleaned = threading.Event(), threading.Event(), []
+
+    def fn(job):
+        started.set()
+        release.wait(5)
+        job.set_progress(50, "下一步")
+        return "not reached"
+
+    job = manager.submit("t", fn, cleanup=lambda job: cleaned.append(job.status))
+    assert started.wait(5)
+    manager.cancel(job.job_id)
+    assert job.status == JOB_RUNNING  # 检查点之前不会中断
+    release.set()
+    assert wait_until(lambda: job.status == JOB_CANCELLED)
+    assert job.result is None
+    assert wait_until(lambda: cleaned == [JOB_CANCELLED])
+
+
+def test_failed_job_records_error_and_runs_cleanup():
+    manager = JobManager(num_workers=1)
+    cleaned = []
+
+    def fn(job):
+        raise ValueError("boom")
+
+    job = manager.submit("t", fn, cleanup=lambda job: cleaned.append(job.job_id))
+    assert wait_until(lambda: job.status == JOB_FAILED)
+    assert job.error == "boom"
+    assert wait_until(lambda: cleaned == [job.job_id])
+    assert manager.metrics()["finished"][JOB_FAILED] == 1
+
+
+def test_submit_rejects_when_queue_is_full():
+    manager = JobManager(num_workers=1, max_queue_size=1)
+    release = threading.Event()
+    blocker = manager.submit("block", blocking_job, params={"release": release})
+    assert wait_until(lambda: blocker.status == JOB_RUNNING)
+    manager.submit("t", lambda job: None)
+    with pytest.raises(queue.Full):
+        manager.submit("t", lambda job: None)
+    release.set()
+
+
+def test_finished_jobs_are_pruned_after_ttl():
+    manager = JobManager(num_workers=1, finished_job_ttl=60)
+    job = manager.submit("t", lambda job: "ok")
+    assert wait_until(lambda: job.status == JOB_SUCCEEDED)
+    assert manager.get(job.job_id) is job
+    job.finished_at -= 61
+    manager.submit("t", lambda job: "ok")
+    assert manager.get(job.job_id) is None
+
+
+def test_set_progress_clamps_and_checks_cancellation():
+    manager = JobManager(num_workers=1)
+    release = threading.Event()
+    job = manager.submit("block", blocking_job, params={"release": release})
+    job.set_progress(150, "x")
+    assert job.progress == 100 and job.message == "x"
+    job.cancel_event.set()
+    with pytest.raises(JobCancelled):
+        job.set_progress(10)
+    release.set()
@@ -0,0 +1,123 @@
+import os
+import hashlib
+import subprocess
+import pytest
+
+pytest.importorskip("requests")
+
+import transfer
+from config import cfg
+
+
+def write(path, data):
+    # 先写临时文件再替换，与重新保存模型一样生成新文件；共享目录里的硬链接仍指向旧内容
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+    return str(path)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def shared_dir(tmp_path, monkeypatch):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    monkeypatch.setattr(cfg, "LOCAL_SHARED_DIR", str(shared))
+    monkeypatch.setattr(cfg, "LOCAL_CONTAINER_CKPT_DIR", "")
+    monkeypatch.setattr(cfg, "LOCAL_CONTAINER_DATA_DIR", "")
+    return shared
+
+
+class FakeContainer:
+    """docker cp回退路径：用字典模拟容器内的文件，响应stat和sha256sum"""
+    def __init__(self, monkeypatch):
+        self.files = {}
+        self.copies = []
+        monkeypatch.setattr(cfg, "LOCAL_SHARED_DIR", "")
+        monkeypatch.setattr(cfg, "LOCAL_CONTAINER_CKPT_DIR", "")
+        monkeypatch.setattr(cfg, "LOCAL_CONTAINER_DATA_DIR", "")
+        monkeypatch.setattr(transfer, "_docker_copied", {})
+        monkeypatch.setattr(transfer, "docker_cp_local_to_container", self.docker_cp)
+        monkeypatch.setattr(transfer.subprocess, "run", self.run)
+
+    def docker_cp(self, local_path, container_path, skip_if_exists=False):
+        self.copies.append(container_path)
+        self.files[container_path] = read(local_path)
+        return True
+
+    def run(self, cmd, **kwargs):
+        path = cmd[-1]
+        if path not in self.files:
+            return subprocess.CompletedProcess(cmd, 1, "", "No such file")
+        data = self.files[path]
+        if cmd[3] == "stat":
+            return subprocess.CompletedProcess(cmd, 0, f"{len(data)}\n", "")
+        return subprocess.CompletedProcess(cmd, 0, f"{hashlib.sha256(data).hexdigest()}  {path}\n", "")
+
+
+def test_container_to_local_path(shared_dir):
+    assert transfer.container_to_local_path(f"{cfg.CONTAINER_OUTSIDE_DIR}/a/b.wav") == os.path.join(str(shared_dir), "a", "b.wav")
+    assert transfer.container_to_local_path(cfg.CONTAINER_OUTSIDE_DIR) == str(shared_dir)
+    assert transfer.container_to_local_path(f"{cfg.CONTAINER_OUTSIDE_DIR}_other/b.wav") is None
+    assert transfer.container_to_local_path("/app/elsewhere/b.wav") is None
+
+
+def test_put_file_through_shared_dir_dedups_by_content(tmp_path, shared_dir):
+    local_path = write(tmp_path / "local" / "a.wav", b"abc")
+    container_path = f"{cfg.CONTAINER_OUTSIDE_DIR}/x/a.wav"
+    assert transfer.put_file(local_path, container_path) is True
+    assert read(shared_dir / "x" / "a.wav") == b"abc"
+    assert transfer.put_file(local_path, container_path) is False
+    write(local_path, b"abd")  # 同样大小、不同内容
+    assert transfer.put_file(local_path, container_path) is True
+    assert read(shared_dir / "x" / "a.wav") == b"abd"
+
+
+def test_get_file_through_shared_dir(tmp_path, shared_dir):
+    write(shared_dir / "out.mp4", b"video")
+    local_path = str(tmp_path / "local" / "out.mp4")
+    transfer.get_file(f"{cfg.CONTAINER_OUTSIDE_DIR}/out.mp4", local_path)
+    assert read(local_path) == b"video"
+    with pytest.raises(Exception):
+        transfer.get_file(f"{cfg.CONTAINER_OUTSIDE_DIR}/missing.mp4", local_path)
+
+
+def test_docker_fallback_skips_only_identical_content(tmp_path, monkeypatch):
+    container = FakeContainer(monkeypatch)
+    container_path = "/app/elsewhere/model_ckpt_steps_10.ckpt"
+    local_path = write(tmp_path / "model_ckpt_steps_10.ckpt", b"retrained")
+    container.files[container_path] = b"old_ckpt!"  # 同名、同大小、不同内容
+    assert transfer.put_file(local_path, container_path, skip_if_exists=True) is True
+    assert container.files[container_path] == b"retrained"
+    # 新进程（内存记录为空）遇到内容相同的同名文件时跳过
+    monkeypatch.setattr(transfer, "_docker_copied", {})
+    assert transfer.put_file(local_path, container_path, skip_if_exists=True) is False
+    assert container.copies == [container_path]
+
+
+def test_docker_fallback_remembers_copied_content(tmp_path, monkeypatch):
+    container = FakeContainer(monkeypatch)
+    local_path = write(tmp_path / "a.wav", b"abc")
+    assert transfer.put_file(local_path, "/app/elsewhere/a.wav") is True
+    assert transfer.put_file(local_path, "/app/elsewhere/a.wav") is False
+    write(local_path, b"abcd")
+    assert transfer.put_file(local_path, "/app/elsewhere/a.wav") is True
+    assert container.copies == ["/app/elsewhere/a.wav"] * 2
+
+
+def test_put_ckpt_dir_puts_config_and_latest_ckpt(tmp_path, shared_dir):
+    ckpt_dir = tmp_path / "speaker"
+    write(ckpt_dir / "config.yaml", b"cfg")
+    write(ckpt_dir / "model_ckpt_steps_200.ckpt", b"200")
+    write(ckpt_dir / "model_ckpt_steps_1000.ckpt", b"1000")
+    container_dir = transfer.put_ckpt_dir(str(ckpt_dir))
+    assert container_dir == f"{cfg.CONTAINER_OUTSIDE_DIR}/speaker"
+    assert sorted(os.listdir(shared_dir / "speaker")) == ["config.yaml", "model_ckpt_steps_1000.ckpt"]
+    assert transfer.put_ckpt_dir("") == cfg.CONTAINER_CKPT_DIR
+    with pytest.raises(Exception):
+        transfer.put_ckpt_dir(str(tmp_path / "missing"))
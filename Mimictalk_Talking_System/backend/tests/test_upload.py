@@ -0,0 +1,84 @@
+import os
+import asyncio
+import hashlib
+import pytest
+
+from upload import UploadError, parse_multipart_stream, save_stream_to_file
+
+BOUNDARY = "----WebKitFormBoundaryx1y2z3"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+# 文件内容里夹带分隔符的前缀，解析器不能提前截断
+FILE_DATA = os.urandom(5000) + b"\r\n--" + BOUNDARY[:-1].encode() + os.urandom(3000) + b"\r\n-"
+
+
+def build_body(parts, epilogue=True):
+    body = b"preamble\r\n"
+    for headers, data in parts:
+        body += f"--{BOUNDARY}\r\n".encode() + headers.encode() + b"\r\n\r\n" + data + b"\r\n"
+    if epilogue:
+        body += f"--{BOUNDARY}--\r\n".encode()
+    return body
+
+
+BODY = build_body([
+    ('Content-Disposition: form-data; name="out_name"', "数字人".encode()),
+    ('Content-Disposition: form-data; name="audio_file"; filename="a.wav"\r\nContent-Type: audio/wav', FILE_DATA),
+    ('Content-Disposition: form-data; name="empty"; filename=""', b""),
+    ('Content-Disposition: form-data; name="drv_pose"', b"static"),
+])
+
+
+async def chunked(data, chunk_size):
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+def parse(body, stream_chunk_size, save_dir, **kwargs):
+    # stream_chunk_size是网络上收到的块大小，kwargs里的chunk_size是写盘的块大小
+    return asyncio.run(parse_multipart_stream(chunked(body, stream_chunk_size), CONTENT_TYPE, str(save_dir), **kwargs))
+
+
+@pytest.mark.parametrize("stream_chunk_size", [1, 2, 3, 7, len(BOUNDARY) + 3, len(BOUNDARY) + 4, len(BOUNDARY) + 5, 1000, 4096, len(BODY)])
+def test_parses_across_chunk_boundaries(tmp_path, stream_chunk_size):
+    form_data, files = parse(BODY, stream_chunk_size, tmp_path, chunk_size=1024)
+    assert form_data == {"out_name": "数字人", "drv_pose": "static"}
+    assert set(files) == {"audio_file", "empty"}
+    audio = files["audio_file"]
+    assert audio.filename == "a.wav" and audio.content_type == "audio/wav"
+    assert audio.size == len(FILE_DATA) and audio.sha256 == hashlib.sha256(FILE_DATA).hexdigest()
+    with open(audio.path, "rb") as f:
+        assert f.read() == FILE_DATA
+    assert files["empty"].size == 0
+
+
+def test_custom_file_path(tmp_path):
+    _, files = parse(BODY, 100, tmp_path, file_path_fn=lambda save_dir, field_name, filename: os.path.join(save_dir, f"{field_name}.bin"))
+    assert files["audio_file"].path == str(tmp_path / "audio_file.bin")
+
+
+@pytest.mark.parametrize("cut", [10, len(BODY) // 2, len(BODY) - 5])
+def test_truncated_body_removes_files(tmp_path, cut):
+    with pytest.raises(UploadError):
+        parse(BODY[:cut], 512, tmp_path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_field_size_limit(tmp_path):
+    body = build_body([('Content-Disposition: form-data; name="text"', b"x" * (1024 * 1024 + 1))])
+    with pytest.raises(UploadError):
+        parse(body, 64 * 1024, tmp_path)
+
+
+def test_rejects_bad_content_type(tmp_path):
+    with pytest.raises(UploadError):
+        asyncio.run(parse_multipart_stream(chunked(BODY, 100), "application/json", str(tmp_path)))
+    with pytest.raises(UploadError):
+        asyncio.run(parse_multipart_stream(chunked(BODY, 100), "multipart/form-data", str(tmp_path)))
+
+
+def test_save_stream_to_file(tmp_path):
+    path = str(tmp_path / "raw.bin")
+    uploaded_file = asyncio.run(save_stream_to_file(chunked(FILE_DATA, 333), path, chunk_size=1000))
+    assert uploaded_file.size == len(FILE_DATA) and uploaded_file.sha256 == hashlib.sha256(FILE_DATA).hexdigest()
+    with open(path, "rb") as f:
+        assert f.read() == FILE_DATA
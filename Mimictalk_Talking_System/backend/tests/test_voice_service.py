@@ -0,0 +1,81 @@
+import pytest
+
+requests = pytest.importorskip("requests")
+
+from voice_service import VoiceService
+
+
+class FakeResponse:
+    def __init__(self):
+        self.status_code = 200
+        self.num_closed = 0
+
+    def close(self):
+        self.num_closed += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeSession:
+    def __init__(self, errors=0):
+        self.errors = errors
+        self.streams = []
+
+    def post(self, url, data=None, files=None, timeout=None, stream=False):
+        if self.errors > 0:
+            self.errors -= 1
+            raise requests.exceptions.ConnectionError("connection refused")
+        self.streams.append(stream)
+        return FakeResponse()
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    service = VoiceService("http://localhost:9880", idle_timeout=0)
+    service.session = FakeSession()
+    service.running = True
+    monkeypatch.setattr(service, "start", lambda: True)
+    ref_audio = tmp_path / "ref.wav"
+    ref_audio.write_bytes(b"RIFF")
+    service.ref_audio = str(ref_audio)
+    return service
+
+
+def test_buffered_request_releases_on_return(service):
+    response = service.tts(service.ref_audio, {"text": "你好"})
+    assert service.session.streams == [False]
+    assert service.num_active == 0
+    response.close()
+    assert service.num_active == 0
+
+
+def test_stream_request_active_until_closed(service):
+    response = service.tts(service.ref_audio, {"text": "你好"}, stream=True)
+    # 正文还没读完，服务不能被空闲卸载
+    assert service.num_active == 1
+    with response:
+        pass
+    assert response.num_closed == 1
+    assert service.num_active == 0
+    response.close()
+    assert response.num_closed == 2
+    assert service.num_active == 0
+
+
+def test_failed_request_releases(service):
+    service.session = FakeSession(errors=2)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        service.tts(service.ref_audio, {"text": "你好"}, stream=True)
+    assert service.num_active == 0
+
+
+def test_retry_after_connection_error(service):
+    service.session = FakeSession(errors=1)
+    response = service.tts(service.ref_audio, {"text": "你好"}, stream=True)
+    assert service.num_active == 1
+    response.close()
+    assert service.num_active == 0
@@ -0,0 +1,230 @@
+# 宿主机与容器之间的文件传输层：
+# 优先通过bind mount的共享目录直接读写（硬链接/本地复制），按内容哈希去重，已存在的相同文件不再复制；
+# 容器路径不在共享目录下时回退到docker cp
+import os
+import re
+import glob
+import shutil
+import subprocess
+import hashlib
+import threading
+from config import cfg
+from utils import docker_cp_local_to_container, docker_cp_container_to_local
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+_hash_cache = {}  # (绝对路径, inode, mtime_ns, size) -> sha256，避免每次请求都重新哈希大模型文件
+_docker_copied = {}  # 回退路径下已复制到容器的文件：容器路径 -> sha256
+_lock = threading.Lock()
+
+
+def get_mounts():
+    """容器内目录 -> 宿主机目录，只返回宿主机上实际存在的共享目录"""
+    mounts = {
+        cfg.CONTAINER_OUTSIDE_DIR: cfg.LOCAL_SHARED_DIR,
+        cfg.CONTAINER_CKPT_DIR: cfg.LOCAL_CONTAINER_CKPT_DIR,
+        cfg.CONTAINER_DATA_ROOT_DIR: cfg.LOCAL_CONTAINER_DATA_DIR,
+    }
+    return {container_dir.rstrip('/'): local_dir for container_dir, local_dir in mounts.items() if local_dir and os.path.isdir(local_dir)}
+
+
+def container_to_local_path(container_path):
+    """把容器路径映射到共享目录下的宿主机路径，不在共享目录下时返回None"""
+    container_path = container_path.replace('\\', '/')
+    # 优先匹配最长的前缀
+    for container_dir, local_dir in sorted(get_mounts().items(), key=lambda x: -len(x[0])):
+        if container_path == container_dir or container_path.startswith(container_dir + '/'):
+            rel_path = container_path[len(container_dir):].lstrip('/')
+            return os.path.join(local_dir, *rel_path.split('/')) if rel_path else local_dir
+    return None
+
+
+def file_sha256(path):
+    stat = os.stat(path)
+    # 带上inode：替换写入的新文件即使mtime落在同一个时钟刻度内也不会命中旧哈希
+    key = (os.path.abspath(path), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        if key in _hash_cache:
+            return _hash_cache[key]
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    sha256 = hasher.hexdigest()
+    with _lock:
+        _hash_cache[key] = sha256
+    return sha256
+
+
+def is_same_file(src_path, dst_path):
+    """大小不同直接判定不同；大小相同再比较内容哈希"""
+    if not os.path.isfile(dst_path):
+        return False
+    if os.path.samefile(src_path, dst_path):
+        return True
+    if os.path.getsize(src_path) != os.path.getsize(dst_path):
+        return False
+    return file_sha256(src_path) == file_sha256(dst_path)
+
+
+def link_or_copy(src_path, dst_path):
+    """同一文件系统内用硬链接（零复制），否则复制到临时文件后原子替换"""
+    os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+    tmp_path = f"{dst_path}.tmp_{os.getpid()}_{threading.get_ident()}"
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def container_file_matches(container_path, local_path):
+    """docker cp回退路径下比较容器内文件与本地文件：大小不同直接判定不同；大小相同再比较内容哈希"""
+    result = subprocess.run(["docker", "exec", cfg.CONTAINER_NAME, "stat", "-c", "%s", container_path], capture_output=True, text=True, timeout=60)
+    if result.returncode != 0 or result.stdout.strip() != str(os.path.getsize(local_path)):
+        return False
+    result = subprocess.run(["docker", "exec", cfg.CONTAINER_NAME, "sha256sum", container_path], capture_output=True, text=True, timeout=600)
+    return result.returncode == 0 and result.stdout.split()[:1] == [file_sha256(local_path)]
+
+
+def put_file(local_path, container_path, skip_if_exists=False):
+    """
+    把本地文件放到容器路径下，内容相同的文件不重复复制；返回是否实际发生了复制
+    skip_if_exists只作用于docker cp回退路径：容器内已有同名文件时比较大小和sha256，内容相同才跳过，
+    用于其它进程（如上次启动的后端）可能已复制过的大文件
+    """
+    container_path = container_path.replace('\\', '/')
+    shared_path = container_to_local_path(container_path)
+    if shared_path is not None:
+        if is_same_file(local_path, shared_path):
+            print(f"✅ 共享目录中已存在相同内容的文件，跳过复制：{container_path}")
+            return False
+        link_or_copy(local_path, shared_path)
+        print(f"📤 通过共享目录传输：{local_path} -> {container_path}")
+        return True
+    # 回退：docker cp，同一进程内复制过相同内容的文件不再复制
+    sha256 = file_sha256(local_path)
+    if _docker_copied.get(container_path) == sha256:
+        print(f"✅ 容器内已有相同内容的文件，跳过复制：{container_path}")
+        return False
+    if skip_if_exists and container_file_matches(container_path, local_path):
+        print(f"✅ 容器内已有相同内容的文件，跳过复制：{container_path}")
+        _docker_copied[container_path] = sha256
+        return False
+    docker_cp_local_to_container(local_path, container_path)
+    _docker_copied[container_path] = sha256
+    return True
+
+
+def get_file(container_path, local_path):
+    """把容器内文件取到本地路径"""
+    container_path = container_path.replace('\\', '/')
+    shared_path = container_to_local_path(container_path)
+    if shared_path is not None:
+        if not os.path.isfile(shared_path):
+            raise Exception(f"共享目录中不存在文件：{shared_path}（容器路径：{container_path}）")
+        if not is_same_file(shared_path, local_path):
+            link_or_copy(shared_path, local_path)
+        print(f"📥 通过共享目录传输：{container_path} -> {local_path}")
+        return local_path
+    return docker_cp_container_to_local(container_path, local_path)
+
+
+def sync_dir_to_local(container_dir, local_dir):
+    """把容器内目录同步到本地目录，只传输新增或内容变化的文件；返回传输的文件数"""
+    container_dir = container_dir.replace('\\', '/')
+    shared_dir = container_to_local_path(container_dir)
+    os.makedirs(local_dir, exist_ok=True)
+    if shared_dir is None:
+        cmd = f"docker cp mimictalk:{container_dir}/. {local_dir}/"
+        print(f"📥 同步目录命令：{cmd}")
+        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=1000)
+        if result.returncode != 0:
+            raise Exception(f"目录从容器复制到本地失败：命令={cmd}，错误={result.stderr}")
+        return -1
+    num_transferred = 0
+    for root, _, fnames in os.walk(shared_dir):
+        for fname in fnames:
+            src_path = os.path.join(root, fname)
+            dst_path = os.path.join(local_dir, os.path.relpath(src_path, shared_dir))
+            if not is_same_file(src_path, dst_path):
+                link_or_copy(src_path, dst_path)
+                num_transferred += 1
+    print(f"📥 通过共享目录同步：{container_dir} -> {local_dir}，传输{num_transferred}个文件")
+    return num_transferred
+
+
+def list_container_files(container_dir, pattern):
+    """列出容器目录下匹配pattern的文件（容器路径），按文件名自然排序"""
+    container_dir = container_dir.replace('\\', '/')
+    shared_dir = container_to_local_path(container_dir)
+    if shared_dir is not None:
+        fnames = [os.path.basename(path) for path in glob.glob(os.path.join(shared_dir, pattern))]
+    else:
+        result = subprocess.run(["docker", "exec", "mimictalk", "bash", "-c", f"cd {container_dir} && ls {pattern} 2>/dev/null"],
+                                capture_output=True, text=True, timeout=60)
+        fnames = result.stdout.split() if result.returncode == 0 else []
+    # 与sort -V一致：按文件名中的数字排序
+    natural_key = lambda x: [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', x)]
+    return [f"{container_dir}/{fname}" for fname in sorted(fnames, key=natural_key)]
+
+
+def put_drv_pose(local_video_path, drv_pose):
+    """把参考姿势视频放到容器的outside目录，返回推理用的drv_pose（容器路径，或static等内置选项）"""
+    if not local_video_path and os.path.exists(drv_pose):
+        # drv_pose是本地文件路径
+        local_video_path = drv_pose
+    if not local_video_path:
+        # 使用默认值
+        print(f"⚠️  使用指定的参考姿势：{drv_pose}")
+        return drv_pose
+    container_video_path = os.path.join(cfg.CONTAINER_OUTSIDE_DIR, os.path.basename(local_video_path)).replace('\\', '/')
+    put_file(local_video_path, container_video_path)
+    print(f"✅ 参考视频文件复制到容器：{container_video_path}")
+    return container_video_path
+
+
+def put_ckpt_dir(local_ckpt_dir):
+    """
+    把本地模型目录中推理需要的文件（配置文件和最新的模型检查点）放到容器内，返回容器内模型目录
+    local_ckpt_dir为空时使用容器内默认模型
+    """
+    if not local_ckpt_dir:
+        print("⚠️  使用容器内默认模型")
+        return cfg.CONTAINER_CKPT_DIR
+    # 检查路径是否存在
+    if not os.path.exists(local_ckpt_dir):
+        raise Exception(f"模型目录不存在：{local_ckpt_dir}")
+    
+    # 生成容器内模型路径，确保使用正斜杠分隔符
+    container_ckpt_dir = f"{cfg.CONTAINER_OUTSIDE_DIR}/{os.path.basename(local_ckpt_dir)}"
+    
+    # 1. 复制配置文件 - 支持多种格式
+    config_files = [
+        os.path.join(local_ckpt_dir, "config.yaml"),
+        os.path.join(local_ckpt_dir, "config.yml"),
+        os.path.join(local_ckpt_dir, "hparams.yaml"),
+        os.path.join(local_ckpt_dir, "hparams.yml")
+    ]
+    config_file = next((cfg_file for cfg_file in config_files if os.path.exists(cfg_file)), None)
+    if config_file is None:
+        # 列出目录内容以便调试
+        dir_contents = os.listdir(local_ckpt_dir)
+        print(f"📁 目录内容：{local_ckpt_dir} -> {dir_contents}")
+        raise Exception(f"配置文件不存在于目录 {local_ckpt_dir}。请确保目录中包含 config.yaml、config.yml、hparams.yaml 或 hparams.yml 文件")
+    container_config_path = os.path.join(container_ckpt_dir, os.path.basename(config_file)).replace('\\', '/')
+    put_file(config_file, container_config_path, skip_if_exists=True)
+    print(f"✅ 复制配置文件：{config_file} -> {container_config_path}")
+    
+    # 2. 找到最新的模型检查点（按文件名中的步数排序，选择最大步数）
+    ckpt_files = [f for f in os.listdir(local_ckpt_dir) if f.startswith("model_ckpt_steps_") and f.endswith(".ckpt")]
+    if not ckpt_files:
+        raise Exception(f"模型检查点不存在于目录：{local_ckpt_dir}")
+    latest_ckpt = max(ckpt_files, key=lambda x: int(x.split("_")[-1].split(".")[0]))
+    ckpt_file_path = os.path.join(local_ckpt_dir, latest_ckpt)
+    container_ckpt_path = os.path.join(container_ckpt_dir, latest_ckpt).replace('\\', '/')
+    put_file(ckpt_file_path, container_ckpt_path, skip_if_exists=True)
+    print(f"✅ 复制最新模型检查点：{ckpt_file_path} -> {container_ckpt_path}")
+    
+    print(f"✅ 模型文件复制完成：{local_ckpt_dir} -> {container_ckpt_dir}")
+    return container_ckpt_dir
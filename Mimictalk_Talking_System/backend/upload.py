@@ -0,0 +1,197 @@
+# 流式上传处理：边接收请求体边按块写入磁盘，并同时计算内容哈希，不把整个请求读进内存
+import os
+import uuid
+import hashlib
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 每次写盘的块大小
+MAX_FIELD_SIZE = 1024 * 1024  # 普通表单字段的大小上限
+MAX_HEADER_SIZE = 16 * 1024  # 每个part头部的大小上限
+
+
+class UploadError(Exception):
+    """上传内容格式错误"""
+    pass
+
+
+class UploadedFile:
+    """已写入磁盘的上传文件"""
+    def __init__(self, path, filename="", content_type=""):
+        self.path = path
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.sha256 = ""
+
+    def to_dict(self):
+        return {"path": self.path, "filename": self.filename, "size": self.size, "sha256": self.sha256}
+
+
+class ChunkedFileWriter:
+    """把数据按固定大小的块写入文件，同时计算sha256"""
+    def __init__(self, uploaded_file, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.uploaded_file = uploaded_file
+        self.chunk_size = chunk_size
+        self.hasher = hashlib.sha256()
+        self.buffer = bytearray()
+        self.f = open(uploaded_file.path, "wb")
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.hasher.update(self.buffer)
+            self.f.write(self.buffer)
+            self.uploaded_file.size += len(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.uploaded_file.sha256 = self.hasher.hexdigest()
+        return self.uploaded_file
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.uploaded_file.path):
+            os.remove(self.uploaded_file.path)
+
+
+def get_boundary(content_type):
+    """从Content-Type中提取multipart的boundary参数"""
+    if not content_type.startswith("multipart/form-data"):
+        raise UploadError("只支持multipart/form-data格式")
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary" and value:
+            return value.strip('"')
+    raise UploadError("Content-Type中缺少boundary参数")
+
+
+def parse_part_headers(raw_headers):
+    """解析part头部，返回 (字段名, 文件名或None, Content-Type)"""
+    name, filename, content_type = None, None, ""
+    for line in raw_headers.decode("utf-8", errors="ignore").split("\r\n"):
+        key, _, value = line.partition(":")
+        key = key.strip().lower()
+        if key == "content-disposition":
+            for param in value.split(";")[1:]:
+                p_key, _, p_value = param.strip().partition("=")
+                p_value = p_value.strip().strip('"')
+                if p_key == "name":
+                    name = p_value
+                elif p_key == "filename":
+                    filename = p_value
+        elif key == "content-type":
+            content_type = value.strip()
+    return name, filename, content_type
+
+
+def default_file_path(save_dir, field_name, filename):
+    ext = os.path.splitext(filename or "")[1]
+    return os.path.join(save_dir, f"upload_{field_name}_{uuid.uuid4().hex}{ext}")
+
+
+async def parse_multipart_stream(stream, content_type, save_dir, file_path_fn=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    流式解析multipart/form-data请求体
+    :param stream: 异步字节流，例如 starlette 的 request.stream()
+    :param content_type: 请求的Content-Type头
+    :param save_dir: 文件part的保存目录
+    :param file_path_fn: (save_dir, 字段名, 原始文件名) -> 保存路径，默认生成唯一文件名
+    :return: (表单字段dict, {字段名: UploadedFile})
+    """
+    delimiter = b"--" + get_boundary(content_type).encode("utf-8")
+    body_delimiter = b"\r\n" + delimiter
+    file_path_fn = file_path_fn or default_file_path
+    os.makedirs(save_dir, exist_ok=True)
+
+    form_data, files = {}, {}
+    buf = bytearray()
+    state = "preamble"
+    part_name, field_buf, writer = None, None, None
+    finished = False
+    try:
+        async for data in stream:
+            buf += data
+            while not finished:
+                if state == "preamble":
+                    idx = buf.find(delimiter)
+                    if idx < 0:
+                        del buf[:max(0, len(buf) - len(delimiter))]
+                        break
+                    del buf[:idx + len(delimiter)]
+                    state = "after_delimiter"
+                elif state == "after_delimiter":
+                    if len(buf) < 2:
+                        break
+                    if buf[:2] == b"--": # 结束分隔符
+                        finished = True
+                        break
+                    if buf[:2] != b"\r\n":
+                        raise UploadError("multipart分隔符格式错误")
+                    del buf[:2]
+                    state = "headers"
+                elif state == "headers":
+                    idx = buf.find(b"\r\n\r\n")
+                    if idx < 0:
+                        if len(buf) > MAX_HEADER_SIZE:
+                            raise UploadError("multipart头部过大")
+                        break
+                    part_name, filename, part_content_type = parse_part_headers(bytes(buf[:idx]))
+                    del buf[:idx + 4]
+                    if filename is not None:
+                        uploaded_file = UploadedFile(file_path_fn(save_dir, part_name, filename), filename, part_content_type)
+                        writer = ChunkedFileWriter(uploaded_file, chunk_size)
+                    else:
+                        field_buf = bytearray()
+                    state = "body"
+                elif state == "body":
+                    idx = buf.find(body_delimiter)
+                    # 没有找到分隔符时，保留末尾可能是分隔符前缀的部分，其余直接写出
+                    end = idx if idx >= 0 else max(0, len(buf) - len(body_delimiter))
+                    if writer is not None:
+                        writer.write(bytes(buf[:end]))
+                    else:
+                        field_buf += buf[:end]
+                        if len(field_buf) > MAX_FIELD_SIZE:
+                            raise UploadError(f"表单字段过大：{part_name}")
+                    del buf[:end]
+                    if idx < 0:
+                        break
+                    del buf[:len(body_delimiter)]
+                    if writer is not None:
+                        if part_name is not None:
+                            files[part_name] = writer.close()
+                        else:
+                            writer.abort()
+                        writer = None
+                    elif part_name is not None:
+                        form_data[part_name] = field_buf.decode("utf-8")
+                    state = "after_delimiter"
+            if finished:
+                break
+        if not finished:
+            raise UploadError("multipart请求体不完整")
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        for uploaded_file in files.values():
+            if os.path.exists(uploaded_file.path):
+                os.remove(uploaded_file.path)
+        raise
+    return form_data, files
+
+
+async def save_stream_to_file(stream, path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """把原始二进制请求体（含chunked传输）流式写入文件"""
+    writer = ChunkedFileWriter(UploadedFile(path), chunk_size)
+    try:
+        async for data in stream:
+            writer.write(data)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
@@ -1,6 +1,9 @@
 import os
 import uuid
+import time
+import threading
 import subprocess
+import requests
 from config import cfg
 def docker_cp_local_to_container(local_path, container_path, skip_if_exists=False):
     """本地文件复制到容器内"""
@@ -87,8 +90,86 @@ def docker_exec_train(container_video_path, max_updates, container_work_dir, tor
     
     return "".join(all_output)
 
+def is_infer_worker_alive(timeout=3):
+    """检查容器内常驻推理进程是否可用"""
+    try:
+        response = requests.get(f"{cfg.INFER_WORKER_URL}/health", timeout=timeout)
+        return response.status_code == 200
+    except requests.exceptions.RequestException:
+        return False
+
+_infer_worker_lock = threading.Lock()  # 并发任务只启动一次常驻推理进程
+_infer_worker_failed_at = 0.0  # 上次启动失败的时间，退避期内不再重复启动和等待
+
+def start_infer_worker():
+    """后台启动容器内常驻推理进程，轮询健康检查直到模型加载完成"""
+    global _infer_worker_failed_at
+    if is_infer_worker_alive():
+        return True
+    with _infer_worker_lock:
+        # 等锁期间其它任务可能已经启动完成
+        if is_infer_worker_alive():
+            return True
+        retry_after = _infer_worker_failed_at + cfg.INFER_WORKER_RETRY_BACKOFF - time.time()
+        if retry_after > 0:
+            print(f"⚠️  常驻推理进程最近启动失败，{retry_after:.0f}秒内不再重试")
+            return False
+        if launch_infer_worker():
+            _infer_worker_failed_at = 0.0
+            return True
+        _infer_worker_failed_at = time.time()
+        return False
+
+def launch_infer_worker():
+    port = cfg.INFER_WORKER_URL.rsplit(":", 1)[-1]
+    worker_cmd = f"source /opt/conda/etc/profile.d/conda.sh && conda activate mimictalk && cd /app && export PYTHONPATH=./ && python inference/mimictalk_infer_worker.py --a2m_ckpt {cfg.INFER_WORKER_A2M_CKPT} --port {port} --max_cached_speakers {cfg.INFER_WORKER_MAX_CACHED_SPEAKERS} --max_concurrent_jobs {cfg.INFER_WORKER_MAX_CONCURRENT_JOBS} > /app/infer_worker.log 2>&1"
+    print(f"🚀 启动常驻推理进程：docker exec -d mimictalk bash -c '{worker_cmd}'")
+    result = subprocess.run(["docker", "exec", "-d", "mimictalk", "bash", "-c", worker_cmd], capture_output=True, text=True, timeout=60)
+    if result.returncode != 0:
+        print(f"⚠️  常驻推理进程启动失败：{result.stderr}")
+        return False
+    deadline = time.time() + cfg.INFER_WORKER_START_TIMEOUT
+    while time.time() < deadline:
+        if is_infer_worker_alive():
+            print(f"✅ 常驻推理进程已就绪：{cfg.INFER_WORKER_URL}")
+            return True
+        time.sleep(2)
+    print(f"⚠️  等待常驻推理进程超时（{cfg.INFER_WORKER_START_TIMEOUT}秒），日志见容器内 /app/infer_worker.log")
+    return False
+
+def worker_exec_infer(container_audio_path, container_ckpt_dir, full_out_path, drv_pose="static", bg_img="", **extra_inp):
+    """把推理请求发给容器内常驻推理进程（模型常驻，无需每次重新加载）；extra_inp为其它推理参数，如pose_offset"""
+    inp = {
+        "drv_audio_name": container_audio_path,  # 常驻进程内部会自行重采样到16k
+        "torso_ckpt": container_ckpt_dir,
+        "drv_pose_name": drv_pose,
+        "drv_talking_style_name": drv_pose,
+        "bg_image_name": bg_img,
+        "out_name": full_out_path,
+        "out_mode": "final",
+    }
+    inp.update(extra_inp)
+    print(f"\n🚀 发送推理请求到常驻推理进程：{cfg.INFER_WORKER_URL}/infer {inp}")
+    response = requests.post(f"{cfg.INFER_WORKER_URL}/infer", json=inp, timeout=6000)
+    result = response.json()
+    if response.status_code != 200 or result.get("code") != 0:
+        raise Exception(f"推理失败：{result.get('msg')}")
+    return True
+
 def docker_exec_infer(container_audio_path, container_ckpt_dir, container_out_path, drv_pose="static", bg_img=""):
-    """执行容器内推理命令"""
+    """执行容器内推理命令（优先使用常驻推理进程，不可用时回退到docker exec单次推理）"""
+    container_out_dir = cfg.CONTAINER_OUTSIDE_INFER_DIR
+    
+    # 将输出目录与文件名合并，因为脚本不支持--out_dir参数
+    # 确保文件名包含.mp4扩展名，以便FFmpeg正确识别输出格式
+    full_out_path = f"{container_out_dir}/{container_out_path}"
+    if not full_out_path.endswith('.mp4'):
+        full_out_path += '.mp4'
+    
+    if start_infer_worker():
+        return worker_exec_infer(container_audio_path, container_ckpt_dir, full_out_path, drv_pose=drv_pose, bg_img=bg_img)
+    print("⚠️  常驻推理进程不可用，回退到单次推理进程")
+    
     container_audio_16k = container_audio_path.replace(".wav", "_16k.wav").replace(".mp3", "_16k.wav")
     
     # 1. 转码音频（简化命令，避免引号问题）
@@ -104,14 +185,6 @@ def docker_exec_infer(container_audio_path, container_ckpt_dir, container_out_pa
     
     # 2. 推理命令（简化命令，避免引号问题）
     bg_arg = f"--bg_img {bg_img}" if bg_img else ""
-    container_out_dir = cfg.CONTAINER_OUTSIDE_INFER_DIR
-    
-    # 将输出目录与文件名合并，因为脚本不支持--out_dir参数
-    # 确保文件名包含.mp4扩展名，以便FFmpeg正确识别输出格式
-    full_out_path = f"{container_out_dir}/{container_out_path}"
-    if not full_out_path.endswith('.mp4'):
-        full_out_path += '.mp4'
-    
     infer_cmd = f"source /opt/conda/etc/profile.d/conda.sh && conda activate mimictalk && cd /app && mkdir -p {container_out_dir} && export PYTHONPATH=./ && python inference/mimictalk_infer.py --drv_aud {container_audio_16k} --torso_ckpt {container_ckpt_dir} --drv_pose {drv_pose} --drv_style {drv_pose} --out_name {full_out_path} --out_mode final {bg_arg}"
     print(f"\n🚀 执行推理命令：docker exec mimictalk bash -c '{infer_cmd}'")
     result = subprocess.run(
@@ -124,24 +197,9 @@ def docker_exec_infer(container_audio_path, container_ckpt_dir, container_out_pa
     return True
 
 def sync_ckpt_from_container_to_local(container_ckpt_dir, local_speaker_name):
-    """训练完成后，自动把容器内模型复制到本地"""
+    """训练完成后，把容器内模型同步到本地（优先走共享目录，只传输新增或变化的文件）"""
+    from transfer import sync_dir_to_local
     local_ckpt_dir = os.path.join(cfg.LOCAL_CKPT_SAVE_DIR, local_speaker_name)
-    os.makedirs(local_ckpt_dir, exist_ok=True)
-    cmd = f"docker cp mimictalk:{container_ckpt_dir}/. {local_ckpt_dir}/"
-    print(f"📥 同步模型命令：{cmd}")
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=1000)
-    if result.returncode != 0:
-        raise Exception(f"模型从容器复制到本地失败：命令={cmd}，错误={result.stderr}")
+    sync_dir_to_local(container_ckpt_dir, local_ckpt_dir)
     print(f"✅ 模型已保存到本地：{local_ckpt_dir}")
     return local_ckpt_dir
-def sync_ckpt_from_local_to_container(local_ckpt_dir):
-    """推理前，自动把本地模型复制到容器内临时路径"""
-    container_temp_ckpt_dir = f"/app/checkpoints_mimictalk/local_sync_ckpt"
-    print(f"🗑️  清理容器内旧模型：docker exec mimictalk rm -rf {container_temp_ckpt_dir}")
-    subprocess.run(f"docker exec mimictalk rm -rf {container_temp_ckpt_dir}", shell=True, capture_output=True, text=True, timeout=10)
-    cmd = f"docker cp {local_ckpt_dir}/. mimictalk:{container_temp_ckpt_dir}/"
-    print(f"📤 同步本地模型到容器：{cmd}")
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=600)
-    if result.returncode != 0:
-        raise Exception(f"本地模型复制到容器失败：命令={cmd}，错误={result.stderr}")
-    return container_temp_ckpt_dir
\ No newline at end of file
@@ -0,0 +1,171 @@
+# 语音克隆服务（容器内 GPT-SoVITS 的 Voice_Model/api_v2.py）常驻管理：
+# 首次请求时启动一次，轮询/health判断模型是否加载完成；之后所有请求复用同一进程和同一个连接池，
+# 进程崩溃时自动重启并重试，空闲超过 VOICE_SERVICE_IDLE_TIMEOUT 秒后卸载以释放显存
+import time
+import threading
+import subprocess
+import requests
+from requests.adapters import HTTPAdapter
+from config import cfg
+
+
+class VoiceServiceError(Exception):
+    """语音克隆服务无法启动或不可用"""
+    pass
+
+
+class VoiceService:
+    def __init__(self, base_url, start_timeout=180, idle_timeout=600, pool_size=4):
+        self.base_url = base_url.rstrip("/")
+        self.start_timeout = start_timeout
+        self.idle_timeout = idle_timeout  # <=0 表示常驻不卸载
+        self.lifecycle_lock = threading.Lock()  # 启动/关闭互斥，并发请求只会触发一次启动
+        self.state_lock = threading.Lock()
+        self.num_active = 0  # 正在进行的请求数，不为0时不卸载
+        self.last_used = time.time()
+        self.running = False
+        self.reaper = None
+        # 复用TCP连接，避免每个请求重新建连
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def is_alive(self, timeout=3):
+        """检查语音克隆服务是否已加载完成"""
+        try:
+            response = self.session.get(f"{self.base_url}/health", timeout=timeout)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def start(self):
+        """启动语音克隆服务（已在运行时直接返回），轮询健康检查直到模型加载完成"""
+        with self.lifecycle_lock:
+            if self.is_alive():
+                self._mark_running()
+                return True
+            print("🚀 正在启动语音克隆服务...")
+            # 1. 检查容器是否正在运行
+            result = subprocess.run(["docker", "ps", "-q", "-f", f"name={cfg.CONTAINER_NAME}"], capture_output=True, text=True, timeout=60)
+            if not result.stdout.strip():
+                print(f"⚠️  {cfg.CONTAINER_NAME}容器未运行，正在启动...")
+                subprocess.run(["docker", "start", cfg.CONTAINER_NAME], capture_output=True, text=True, timeout=300)
+            # 2. 清理崩溃或卡死的旧进程，避免占用端口
+            self._kill_process()
+            port = self.base_url.rsplit(":", 1)[-1]
+            service_cmd = f"export PYTHONUNBUFFERED=1 && source /opt/conda/etc/profile.d/conda.sh && conda activate voice && cd /app/Voice_Model && python api_v2.py -p {port} > {cfg.VOICE_SERVICE_LOG} 2>&1"
+            print(f"🚀 启动语音克隆服务：docker exec -d {cfg.CONTAINER_NAME} bash -c '{service_cmd}'")
+            result = subprocess.run(["docker", "exec", "-d", cfg.CONTAINER_NAME, "bash", "-c", service_cmd], capture_output=True, text=True, timeout=60)
+            if result.returncode != 0:
+                print(f"⚠️  语音克隆服务启动失败：{result.stderr}")
+                return False
+            # 3. 轮询健康检查，模型加载完成即返回，不再固定等待
+            start_time = time.time()
+            while time.time() - start_time < self.start_timeout:
+                if self.is_alive():
+                    print(f"✅ 语音克隆服务已就绪（{time.time() - start_time:.1f}秒）：{self.base_url}")
+                    self._mark_running()
+                    return True
+                time.sleep(1)
+            print(f"⚠️  等待语音克隆服务超时（{self.start_timeout}秒），日志见容器内 {cfg.VOICE_SERVICE_LOG}")
+            self._kill_process()
+            return False
+
+    def stop(self):
+        """卸载语音克隆服务，释放显存"""
+        with self.lifecycle_lock:
+            print("🛑 正在关闭语音克隆服务...")
+            self._kill_process()
+            self.running = False
+            print("✅ 语音克隆服务已关闭")
+
+    def _kill_process(self):
+        kill_cmd = "ps aux | grep 'python api_v2.py' | grep -v grep | awk '{print $2}' | xargs -r kill -9"
+        subprocess.run(["docker", "exec", cfg.CONTAINER_NAME, "bash", "-c", kill_cmd], capture_output=True, text=True, timeout=60)
+
+    def _mark_running(self):
+        self.running = True
+        self.last_used = time.time()
+        if self.idle_timeout > 0 and (self.reaper is None or not self.reaper.is_alive()):
+            self.reaper = threading.Thread(target=self._reap_idle, daemon=True)
+            self.reaper.start()
+
+    def _reap_idle(self):
+        """后台线程：空闲超时后卸载服务"""
+        while True:
+            time.sleep(min(30, self.idle_timeout))
+            with self.lifecycle_lock:
+                if not self.running:
+                    return
+                with self.state_lock:
+                    idle_time = time.time() - self.last_used
+                    if self.num_active > 0 or idle_time < self.idle_timeout:
+                        continue
+                print(f"💤 语音克隆服务已空闲{idle_time:.0f}秒，卸载以释放显存")
+                self._kill_process()
+                self.running = False
+                return
+
+    def tts(self, ref_audio_path, params, ref_audio_name="reference.wav", timeout=60, stream=False):
+        """
+        用参考音频合成语音，返回requests.Response
+        服务未启动时先启动；连接失败（进程崩溃）时重启服务并重试一次
+        stream=True时（配合streaming_mode参数）边合成边返回，由调用方用iter_content读取，并且必须调用close()（或用with），
+        响应关闭前请求一直计入num_active，服务不会被空闲卸载
+        """
+        with self.state_lock:
+            self.num_active += 1
+        handed_off = False
+        try:
+            for attempt in range(2):
+                if (not self.running or attempt > 0) and not self.start():
+                    raise VoiceServiceError("启动语音克隆服务失败")
+                try:
+                    with open(ref_audio_path, "rb") as audio_file:
+                        files = {"ref_audio": (ref_audio_name, audio_file, "audio/wav")}
+                        response = self.session.post(f"{self.base_url}/tts", data=params, files=files, timeout=timeout, stream=stream)
+                    if stream:
+                        self._release_on_close(response)
+                        handed_off = True
+                    return response
+                except requests.exceptions.ConnectionError as e:
+                    if attempt > 0:
+                        raise
+                    print(f"⚠️  连接语音克隆服务失败，重启后重试：{str(e)}")
+        finally:
+            if not handed_off:
+                self._release()
+
+    def _release(self):
+        with self.state_lock:
+            self.num_active -= 1
+            self.last_used = time.time()
+
+    def _release_on_close(self, response):
+        """流式响应的正文还在生成，等调用方关闭响应时才结束本次请求；重复close只释放一次"""
+        close = response.close
+        released = [False]
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                with self.state_lock:
+                    first_close, released[0] = not released[0], True
+                if first_close:
+                    self._release()
+
+        response.close = close_and_release
+
+_voice_service = None
+_voice_service_lock = threading.Lock()
+
+
+def get_voice_service():
+    global _voice_service
+    with _voice_service_lock:
+        if _voice_service is None:
+            _voice_service = VoiceService(cfg.VOICE_SERVICE_URL, start_timeout=cfg.VOICE_SERVICE_START_TIMEOUT,
+                                          idle_timeout=cfg.VOICE_SERVICE_IDLE_TIMEOUT, pool_size=cfg.VOICE_SERVICE_POOL_SIZE)
+        return _voice_service
@@ -3,6 +3,9 @@
 // 生成状态跟踪变量
 let isGenerating = false;
 let currentTaskId = null;
+// 流式对话会话ID和视频分段播放器
+let currentSessionId = null;
+let streamPlayer = null;
 // 添加模拟进度变量
 let simulateProgress = 0;
 let simulateProgressInterval = null;
@@ -362,6 +365,10 @@ function updateProgress(progress) {
 
 // 停止生成
 function stopGeneration() {
+    if (isGenerating && currentSessionId) {
+        stopChatStream();
+        return;
+    }
     if (isGenerating && currentTaskId) {
         // 发送停止生成请求
         fetch(`/api/task/${currentTaskId}/stop`, {
@@ -393,8 +400,257 @@ function stopGeneration() {
 
 // 处理用户消息
 function processUserMessage(userMessage) {
-    // 调用LLM生成回复
-    generateLLMResponse(userMessage);
+    if (uploadedAudioFile && uploadedVideoFile) {
+        // 已上传参考音频和视频：回复文本、语音和视频按句流水线生成，边生成边播放
+        startChatStream(userMessage);
+    } else {
+        // 调用LLM生成回复
+        generateLLMResponse(userMessage);
+    }
+}
+
+// 开始流式对话
+function startChatStream(userMessage) {
+    isGenerating = true;
+    updateGenerationUI(true);
+    showNotification('正在生成回复...', 'info');
+    
+    const modelDir = document.getElementById('modelDir').value;
+    localStorage.setItem('modelDir', modelDir);
+    
+    const formData = new FormData();
+    formData.append('message', userMessage);
+    formData.append('reference_audio', uploadedAudioFile);
+    formData.append('reference_video', uploadedVideoFile);
+    formData.append('model_dir', modelDir);
+    formData.append('api', document.getElementById('apiSelect').value);
+    formData.append('speed', document.getElementById('speedControl').value);
+    
+    fetch('/api/chat-stream', {
+        method: 'POST',
+        body: formData
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            currentSessionId = data.session_id;
+            // 回复文本随生成逐步更新
+            const messageElement = addMessage('', 'bot');
+            pollChatStream(data.session_id, data.playlist_url, messageElement);
+        } else {
+            showNotification('流式对话失败: ' + data.error, 'error');
+            finishChatStream(false);
+        }
+    })
+    .catch(error => {
+        console.error('流式对话API调用错误:', error);
+        showNotification('流式对话API调用失败: ' + error.message, 'error');
+        finishChatStream(false);
+    });
+}
+
+// 轮询流式对话状态：更新回复文本，第一段视频生成后开始播放
+function pollChatStream(sessionId, playlistUrl, messageElement) {
+    let playerStarted = false;
+    const checkStatus = () => {
+        // 会话已被停止
+        if (currentSessionId !== sessionId) {
+            return;
+        }
+        fetch(`/api/chat-stream/${sessionId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.error);
+                }
+                messageElement.firstChild.textContent = data.reply_text;
+                if (!playerStarted && data.num_segments > 0) {
+                    playerStarted = true;
+                    console.log(`首段视频就绪，耗时${data.first_segment_latency.toFixed(1)}秒`);
+                    playStreamVideo(playlistUrl);
+                }
+                if (playerStarted) {
+                    pushSegments(streamPlayer, data.segments);
+                }
+                if (['succeeded', 'failed', 'cancelled'].includes(data.status)) {
+                    if (data.status === 'failed') {
+                        showNotification('流式对话失败: ' + data.error, 'error');
+                    }
+                    if (playerStarted) {
+                        endSegmentPlayer(streamPlayer);
+                    }
+                    // 已开始播放时等视频播放结束再恢复界面
+                    finishChatStream(playerStarted);
+                    return;
+                }
+                setTimeout(checkStatus, 500);
+            })
+            .catch(error => {
+                console.error('获取对话状态失败:', error);
+                showNotification('获取对话状态失败: ' + error.message, 'error');
+                finishChatStream(playerStarted);
+            });
+    };
+    checkStatus();
+}
+
+// 停止流式对话
+function stopChatStream() {
+    fetch(`/api/chat-stream/${currentSessionId}/stop`, {
+        method: 'POST'
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            showNotification('已停止视频生成', 'info');
+        } else {
+            showNotification('停止生成失败: ' + data.error, 'error');
+        }
+    })
+    .catch(error => {
+        console.error('停止生成请求错误:', error);
+        showNotification('停止生成请求失败: ' + error.message, 'error');
+    })
+    .finally(() => {
+        finishChatStream(false);
+    });
+}
+
+// 流式对话结束
+function finishChatStream(keepPlaying) {
+    currentSessionId = null;
+    isGenerating = false;
+    if (!keepPlaying) {
+        characterVideoPlaying = false;
+        updateGenerationUI(false);
+    }
+}
+
+// 播放流式对话的视频：原生支持HLS的浏览器（Safari）直接播放随生成追加分段的播放列表，
+// 其它浏览器用两个<video>交替逐段播放每个分段的MP4封装，一个播放时另一个预加载下一段
+function playStreamVideo(playlistUrl) {
+    const characterVideo = document.getElementById('characterVideo');
+    stopSimulateProgress();
+    
+    const probe = document.createElement('video');
+    if (probe.canPlayType('application/vnd.apple.mpegurl')) {
+        characterVideo.innerHTML = `
+            <video controls style="width: 100%; height: 100%; object-fit: contain;">
+                你的浏览器不支持视频播放，请更换浏览器重试。
+            </video>
+        `;
+        const video = characterVideo.querySelector('video');
+        video.autoplay = true;
+        video.playsInline = true;
+        video.src = playlistUrl;
+        video.onended = onStreamVideoEnded;
+        // 分段由播放器自己从播放列表读取
+        streamPlayer = null;
+    } else {
+        // 分段与播放列表在同一目录下
+        streamPlayer = createSegmentPlayer(characterVideo, playlistUrl.substring(0, playlistUrl.lastIndexOf('/') + 1));
+    }
+    
+    characterVideoPlaying = true;
+}
+
+// 视频全部播放完毕
+function onStreamVideoEnded() {
+    characterVideoPlaying = false;
+    // 生成已结束才恢复界面，否则等待新的分段
+    if (!isGenerating) {
+        updateGenerationUI(false);
+    }
+}
+
+// 创建MP4分段播放器
+function createSegmentPlayer(container, baseUrl) {
+    container.innerHTML = `
+        <video controls style="width: 100%; height: 100%; object-fit: contain; display: none;"></video>
+        <video controls style="width: 100%; height: 100%; object-fit: contain; display: none;"></video>
+    `;
+    const player = {
+        videos: Array.from(container.querySelectorAll('video')),
+        baseUrl: baseUrl,
+        queue: [],          // 待播放分段的URL
+        numPushed: 0,       // 已加入队列的分段数
+        active: 1,          // 正在播放的<video>下标，第一段从下标0开始
+        playing: false,
+        ended: false        // 不会再有新的分段
+    };
+    player.videos.forEach(video => {
+        video.playsInline = true;
+        video.preload = 'auto';
+        video.onended = function() {
+            if (video === player.videos[player.active]) {
+                playNextSegment(player);
+            }
+        };
+    });
+    return player;
+}
+
+// 把状态轮询返回的新分段加入播放队列；原生HLS播放时player为null，不需要处理
+function pushSegments(player, segments) {
+    if (!player || !segments) {
+        return;
+    }
+    segments.slice(player.numPushed).forEach(segment => {
+        player.queue.push(`${player.baseUrl}${segment.name}.mp4`);
+    });
+    player.numPushed = segments.length;
+    if (player.playing) {
+        preloadNextSegment(player);
+    } else {
+        playNextSegment(player);
+    }
+}
+
+// 生成结束，播完队列中的分段后结束播放
+function endSegmentPlayer(player) {
+    if (!player) {
+        return;
+    }
+    player.ended = true;
+    if (!player.playing) {
+        onStreamVideoEnded();
+    }
+}
+
+// 切换到预加载好的另一个<video>播放下一段
+function playNextSegment(player) {
+    if (player.queue.length === 0) {
+        // 下一段还没生成完，等待状态轮询加入
+        player.playing = false;
+        if (player.ended) {
+            onStreamVideoEnded();
+        }
+        return;
+    }
+    const url = player.queue.shift();
+    const current = player.videos[player.active];
+    const next = player.videos[1 - player.active];
+    if (next.dataset.src !== url) {
+        next.src = url;
+        next.dataset.src = url;
+    }
+    current.pause();
+    current.style.display = 'none';
+    next.style.display = '';
+    next.play().catch(error => console.error('播放视频分段失败:', error));
+    player.active = 1 - player.active;
+    player.playing = true;
+    preloadNextSegment(player);
+}
+
+// 用空闲的<video>预加载下一段，减少分段切换时的停顿
+function preloadNextSegment(player) {
+    const idle = player.videos[1 - player.active];
+    if (player.queue.length > 0 && idle.dataset.src !== player.queue[0]) {
+        idle.src = player.queue[0];
+        idle.dataset.src = player.queue[0];
+        idle.load();
+    }
 }
 
 // 调用LLM生成回复
@@ -673,6 +929,7 @@ function addMessage(message, sender) {
     // 自动滚动到底部
     const chatDisplay = document.getElementById('chatDisplay');
     chatDisplay.scrollTop = chatDisplay.scrollHeight;
+    return messageElement;
 }
 
 // 播放角色回应